@@ -94,10 +94,13 @@ class TransferBuffer(actions.ActionPlugin):
     # send limit.
     self.ChargeBytesToSession(len(data))
 
-    # Now return the data to the server into the special TransferStore well
-    # known flow.
-    self.grr_worker.SendReply(
-        result, session_id=rdfvalue.SessionID(flow_name="TransferStore"))
+    # Now return the data to the server. If we can, we upload it directly into
+    # the blob store, otherwise it goes into the special TransferStore well
+    # known flow through the poll loop.
+    uploader = self.grr_worker.blob_uploader
+    if not (uploader and uploader.UploadBlobs([result])):
+      self.grr_worker.SendReply(
+          result, session_id=rdfvalue.SessionID(flow_name="TransferStore"))
 
     # Now report the hash of this blob to our flow as well as the offset and
     # length.
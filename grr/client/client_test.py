@@ -2,6 +2,7 @@
 """Tests for the client."""
 
 
+import itertools
 
 # Need to import client to add the flags.
 from grr.client import actions
@@ -176,6 +177,62 @@ class BasicContextTests(test_lib.GRRBaseTest):
       result.append(item)
     self.assertEqual(result, ["C"] * 10 + ["A", "B"] * 10)
 
+  def testSizeQueueLanes(self):
+    queue = comms.SizeQueue(maxsize=10000000)
+    bulk_item = "B" * comms.SizeQueue.LANE_QUANTUM
+
+    for _ in range(10):
+      queue.Put(bulk_item, lane=comms.SizeQueue.BULK_LANE)
+    queue.Put("normal", lane=comms.SizeQueue.NORMAL_LANE)
+    queue.Put("control", lane=comms.SizeQueue.CONTROL_LANE)
+
+    # The control and normal messages are not held up by the bulk backlog.
+    result = []
+    for item in queue.Get():
+      result.append(item)
+      if len(result) == 3:
+        break
+
+    self.assertEqual(result, ["control", "normal", bulk_item])
+    self.assertEqual(queue.Size(), 9 * len(bulk_item))
+
+    # The rest of the backlog is still there.
+    self.assertEqual(list(queue.Get()), [bulk_item] * 9)
+    self.assertEqual(queue.Size(), 0)
+
+  def testSizeQueueWeightedDraining(self):
+    queue = comms.SizeQueue(maxsize=10000000)
+    item = "X" * (comms.SizeQueue.LANE_QUANTUM - 1)
+
+    for _ in range(20):
+      queue.Put(item + "B", lane=comms.SizeQueue.BULK_LANE)
+      queue.Put(item + "N", lane=comms.SizeQueue.NORMAL_LANE)
+
+    # The normal lane gets four times the share of the bulk lane.
+    result = [x[-1] for x in itertools.islice(queue.Get(), 10)]
+    self.assertEqual(result.count("N"), 8)
+    self.assertEqual(result.count("B"), 2)
+
+  def testSizeQueueOrderingKey(self):
+    queue = comms.SizeQueue(maxsize=10000000)
+    bulk_item = "B" * comms.SizeQueue.LANE_QUANTUM * 2
+
+    queue.Put("unrelated bulk", lane=comms.SizeQueue.BULK_LANE)
+    queue.Put(bulk_item, lane=comms.SizeQueue.BULK_LANE, ordering_key="req")
+    queue.Put("reply", lane=comms.SizeQueue.NORMAL_LANE, ordering_key="req")
+    queue.Put("status", lane=comms.SizeQueue.CONTROL_LANE, ordering_key="req")
+    queue.Put("other status", lane=comms.SizeQueue.CONTROL_LANE,
+              ordering_key="other_req")
+
+    # Messages for the same key must not overtake the bulk data.
+    self.assertEqual(list(queue.Get()), ["other status", "unrelated bulk",
+                                         bulk_item, "reply", "status"])
+
+    # Once the bulk data is gone, the key can use the fast lanes again.
+    queue.Put("bulk", lane=comms.SizeQueue.BULK_LANE)
+    queue.Put("status", lane=comms.SizeQueue.CONTROL_LANE, ordering_key="req")
+    self.assertEqual(list(queue.Get()), ["status", "bulk"])
+
 
 def main(argv):
   test_lib.main(argv)
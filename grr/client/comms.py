@@ -49,6 +49,9 @@ The client goes through a state machine:
 5) When not in FAST POLL mode, the polling frequency is controlled by the
    Timer() object. It is currently a geometrically decreasing function which
    starts at the Client.poll_min and approaches the Client.poll_max setting.
+   The server may send a load hint and a requested poll delay with each
+   response. The client honours the delay (with Client.poll_jitter applied and
+   capped at Client.poll_max) unless it is in FAST POLL mode.
 
 6) If a 500 error occurs in the CONNECTED state, the client will assume that the
    server is temporarily down. The client will switch to the RETRY state and
@@ -80,6 +83,7 @@ import os
 import pdb
 import posixpath
 import Queue
+import random
 import socket
 import sys
 import threading
@@ -120,6 +124,8 @@ class HTTPObject(object):
     self.code = code
     # Contains the decoded data from the 'control' endpoint.
     self.messages = self.source = self.nonce = None
+    # Load hints the server sent along with the 'control' response.
+    self.server_load = self.next_poll_delay = 0
     self.duration = duration
 
   def Success(self):
@@ -392,6 +398,9 @@ class Timer(object):
     self.poll_min = config_lib.CONFIG["Client.poll_min"]
     self.sleep_time = self.poll_max = config_lib.CONFIG["Client.poll_max"]
     self.poll_slew = config_lib.CONFIG["Client.poll_slew"]
+    self.poll_jitter = config_lib.CONFIG["Client.poll_jitter"]
+    # The last load estimate the server sent us.
+    self.server_load = 0
 
   def FastPoll(self):
     """Switch to fast poll mode."""
@@ -401,6 +410,29 @@ class Timer(object):
     """Switch to slow poll mode."""
     self.sleep_time = self.poll_max
 
+  def ApplyServerHints(self, server_load, next_poll_delay):
+    """Honours the load hints the server sent with its last response.
+
+    The server may ask us to wait before polling again. We randomize the
+    requested delay so clients which were told to back off at the same time do
+    not all come back at the same time. The delay is capped by poll_max so the
+    server can never make us poll less often than we do when idle.
+
+    Args:
+      server_load: The server load estimate in the range [0, 1].
+      next_poll_delay: Seconds the server wants us to wait, 0 means no
+          preference.
+    """
+    self.server_load = server_load
+    stats.STATS.SetGaugeValue("grr_client_server_load", float(server_load))
+
+    if next_poll_delay <= 0:
+      return
+
+    delay = next_poll_delay * (
+        1 + random.uniform(-self.poll_jitter, self.poll_jitter))
+    self.sleep_time = max(self.sleep_time, min(self.poll_max, delay))
+
   def Wait(self):
     """Wait until the next action is needed."""
     time.sleep(self.sleep_time - int(self.sleep_time))
@@ -427,6 +459,8 @@ class CommsInit(registry.InitHook):
     stats.STATS.RegisterCounterMetric("grr_client_slave_restarts")
     stats.STATS.RegisterCounterMetric("grr_client_sent_bytes")
     stats.STATS.RegisterCounterMetric("grr_client_sent_messages")
+    stats.STATS.RegisterCounterMetric("grr_client_uploaded_bytes")
+    stats.STATS.RegisterGaugeMetric("grr_client_server_load", float)
 
 
 class Status(object):
@@ -460,6 +494,10 @@ class GRRClientWorker(object):
 
   stats_collector = None
 
+  # If set, a BlobUploader which actions can use to send bulk data to the
+  # server outside the poll loop.
+  blob_uploader = None
+
   IDLE_THRESHOLD = 0.3
 
   sent_bytes_per_flow = {}
@@ -499,6 +537,9 @@ class GRRClientWorker(object):
     # client action from here if needed.
     self.suspended_actions = {}
 
+    # The (session_id, request_id) of the request currently being processed.
+    self._current_request_key = None
+
     # Use this to control the nanny transaction log.
     self.nanny_controller = client_utils.NannyController()
     self.nanny_controller.StartNanny()
@@ -688,6 +729,8 @@ class GRRClientWorker(object):
 
         action = action_cls(grr_worker=self)
 
+      self._current_request_key = (str(message.session_id), message.request_id)
+
       # Write the message to the transaction log.
       self.nanny_controller.WriteTransactionLog(message)
 
@@ -699,6 +742,7 @@ class GRRClientWorker(object):
       self.nanny_controller.CleanTransactionLog()
     finally:
       self._is_active = False
+      self._current_request_key = None
       # We want to send ClientStats when client action is complete.
       self._send_stats_on_check = True
 
@@ -821,14 +865,35 @@ class SizeQueue(object):
   on. In the client we want to limit the total memory footprint, hence we need
   to use the total size as a measure of how full the queue is.
 
+  Items are kept in separate lanes so that a large backlog of bulk data does
+  not delay small control messages (e.g. status messages or heartbeats to well
+  known flows). Get() drains the lanes in a weighted round robin fashion, each
+  lane receiving a share of the bytes proportional to its weight. Within a lane,
+  items are ordered by priority.
+
+  Items may carry an ordering key (e.g. the request they belong to). An item is
+  never put into a faster lane than earlier items with the same key which are
+  still queued, so items with the same key are never reordered across lanes.
+
   TODO(user): this class needs some attention to ensure it is thread safe.
   """
   total_size = 0
 
+  CONTROL_LANE = 0
+  NORMAL_LANE = 1
+  BULK_LANE = 2
+
+  # The relative share of bytes each lane gets when all lanes have data.
+  LANE_WEIGHTS = (16, 4, 1)
+
+  # The number of bytes a lane of weight 1 may send per round.
+  LANE_QUANTUM = 64 * 1024
+
   def __init__(self, maxsize=1024, nanny=None):
     self.lock = threading.RLock()
-    self.queue = []
-    self._reversed = []
+    self._lanes = [[] for _ in self.LANE_WEIGHTS]
+    # Maps ordering keys to the number of queued items in each lane.
+    self._pending_by_key = {}
     self.total_size = 0
     self.maxsize = maxsize
     self.nanny = nanny
@@ -837,7 +902,9 @@ class SizeQueue(object):
           item,
           priority=rdf_flows.GrrMessage.Priority.MEDIUM_PRIORITY,
           block=True,
-          timeout=1000):
+          timeout=1000,
+          lane=NORMAL_LANE,
+          ordering_key=None):
     """Put an item on the queue, blocking if it is too full.
 
     This is a slightly modified Queue.put method which blocks when the queue
@@ -848,6 +915,9 @@ class SizeQueue(object):
       priority: The priority of this message.
       block: If True we block indefinitely.
       timeout: Maximum time we spend waiting on the queue (1 sec resolution).
+      lane: The lane this item should be queued in.
+      ordering_key: If set, the item is queued in a lane no faster than the
+          lanes holding earlier items with the same key.
 
     Raises:
       Queue.Full: if the queue is full and block is False, or
@@ -877,25 +947,68 @@ class SizeQueue(object):
           raise Queue.Full
 
     with self.lock:
-      self.queue.append((-1 * priority, item))
+      if ordering_key is not None:
+        pending = self._pending_by_key.setdefault(ordering_key,
+                                                  [0] * len(self._lanes))
+        for slower_lane in xrange(len(pending) - 1, lane, -1):
+          if pending[slower_lane]:
+            lane = slower_lane
+            break
+
+        pending[lane] += 1
+
+      self._lanes[lane].append((-1 * priority, item, ordering_key))
       self.total_size += len(item)
 
+  def _Remove(self, lane, ordering_key, item):
+    """Updates the accounting for an item leaving the queue."""
+    self.total_size -= len(item)
+
+    if ordering_key is not None:
+      pending = self._pending_by_key[ordering_key]
+      pending[lane] -= 1
+      if not any(pending):
+        del self._pending_by_key[ordering_key]
+
   def Get(self):
-    """Retrieves the items from the queue."""
-    with self.lock:
-      if self._reversed:
-        # We have leftovers from a partial Get().
-        self._reversed.reverse()
-        self.queue = self._reversed + self.queue
+    """Retrieves the items from the queue.
+
+    This is a generator, callers may stop consuming it at any time. Items which
+    were not consumed stay on the queue.
 
-      self.queue.sort(key=lambda msg: msg[0])  # by priority only.
-      self.queue.reverse()
-      self._reversed, self.queue = self.queue, []
+    Yields:
+      The queued items.
+    """
+    with self.lock:
+      for lane in self._lanes:
+        lane.sort(key=lambda msg: msg[0])  # by priority only.
 
-      while self._reversed:
-        item = self._reversed.pop()[1]
-        self.total_size -= len(item)
-        yield item
+      # Deficit round robin over the lanes: each round, every lane is credited
+      # with its quantum and sends items while the credit lasts.
+      positions = [0] * len(self._lanes)
+      credits = [0] * len(self._lanes)
+      try:
+        while any(pos < len(lane) for pos, lane in zip(positions, self._lanes)):
+          for lane_id, lane in enumerate(self._lanes):
+            if positions[lane_id] >= len(lane):
+              credits[lane_id] = 0
+              continue
+
+            credits[lane_id] += self.LANE_WEIGHTS[lane_id] * self.LANE_QUANTUM
+            while positions[lane_id] < len(lane):
+              _, item, ordering_key = lane[positions[lane_id]]
+              if len(item) > credits[lane_id]:
+                break
+
+              credits[lane_id] -= len(item)
+              positions[lane_id] += 1
+              self._Remove(lane_id, ordering_key, item)
+              yield item
+
+      finally:
+        # Drop the consumed items, leftovers from a partial Get() are kept.
+        for lane_id, lane in enumerate(self._lanes):
+          del lane[:positions[lane_id]]
 
   def Size(self):
     return self.total_size
@@ -954,7 +1067,8 @@ class GRRThreadedWorker(GRRClientWorker, threading.Thread):
     """Return a GrrQueue message list from the queue, draining it.
 
     This is used to get the messages going _TO_ the server when the
-    client connects.
+    client connects. The output queue lanes are drained in a weighted fashion
+    so control messages are not held up by bulk data.
 
     Args:
        max_size: The size (in bytes) of the returned protobuf will be at most
@@ -981,7 +1095,37 @@ class GRRThreadedWorker(GRRClientWorker, threading.Thread):
                     priority=rdf_flows.GrrMessage.Priority.MEDIUM_PRIORITY,
                     blocking=True):
     """Push the Serialized Message on the output queue."""
-    self._out_queue.Put(message, priority=priority, block=blocking)
+    lane = self._GetOutQueueLane(message)
+
+    if message.request_id:
+      ordering_key = (str(message.session_id), message.request_id)
+    elif lane == SizeQueue.BULK_LANE:
+      # Bulk data sent to well known flows (e.g. TransferStore) is referenced
+      # by the replies to the request being processed, it must not be
+      # overtaken by them.
+      ordering_key = self._current_request_key
+    else:
+      ordering_key = None
+
+    self._out_queue.Put(message,
+                        priority=priority,
+                        block=blocking,
+                        lane=lane,
+                        ordering_key=ordering_key)
+
+  def _GetOutQueueLane(self, message):
+    """Decides which lane of the output queue a message should use."""
+    if message.type == rdf_flows.GrrMessage.Type.STATUS:
+      return SizeQueue.CONTROL_LANE
+
+    # Messages to well known flows have no request.
+    if not message.request_id:
+      if message.session_id and message.session_id.FlowName() == "TransferStore":
+        return SizeQueue.BULK_LANE
+
+      return SizeQueue.CONTROL_LANE
+
+    return SizeQueue.NORMAL_LANE
 
   def QueueMessages(self, messages):
     """Push the message to the input queue."""
@@ -1144,6 +1288,12 @@ class GRRHTTPClient(object):
     else:
       self.client_worker = GRRThreadedWorker()
 
+    if config_lib.CONFIG["Client.use_upload_channel"]:
+      self.client_worker.blob_uploader = BlobUploader(
+          self.communicator,
+          self.http_manager_class(
+              heart_beat_cb=self.client_worker.nanny_controller.Heartbeat))
+
   def VerifyServerPEM(self, http_object):
     """Check the server PEM for validity.
 
@@ -1198,13 +1348,18 @@ class GRRHTTPClient(object):
 
     # Try to decrypt the message into the http_object.
     try:
-      http_object.messages, http_object.source, http_object.nonce = (
-          self.communicator.DecryptMessage(http_object.data))
+      response_comms = rdf_flows.ClientCommunication(http_object.data)
+      http_object.messages, http_object.source, signed_message_list = (
+          self.communicator.DecodeSignedMessages(response_comms))
+      http_object.nonce = signed_message_list.timestamp
+      http_object.server_load = signed_message_list.server_load
+      http_object.next_poll_delay = signed_message_list.next_poll_delay
 
       return True
 
     # Something went wrong - the response seems invalid!
-    except communicator.DecodingError as e:
+    except (communicator.DecodingError, rdfvalue.DecodeError,
+            type_info.TypeValueError, ValueError, AttributeError) as e:
       logging.info("Protobuf decode error: %s.", e)
       return False
 
@@ -1253,9 +1408,11 @@ class GRRHTTPClient(object):
       message_list = rdf_flows.MessageList()
 
     # If any outbound messages require fast poll we switch to fast poll mode.
+    fastpoll = False
     for message in message_list.job:
       if message.require_fastpoll:
         self.timer.FastPoll()
+        fastpoll = True
         break
 
     # Make new encrypted ClientCommunication rdfvalue.
@@ -1322,8 +1479,14 @@ class GRRHTTPClient(object):
     for message in response.messages:
       if message.require_fastpoll:
         self.timer.FastPoll()
+        fastpoll = True
         break
 
+    # The server may ask us to back off when it is loaded, unless we were asked
+    # to fast poll.
+    self.timer.ApplyServerHints(response.server_load,
+                                0 if fastpoll else response.next_poll_delay)
+
     # Process all messages. Messages can be processed by clients in
     # any order since clients do not have state.
     self.client_worker.QueueMessages(response.messages)
@@ -1448,6 +1611,84 @@ class GRRHTTPClient(object):
                                         flow_name="Enrol"))
 
 
+class BlobUploader(object):
+  """Sends blobs to the frontend's upload endpoint.
+
+  Bulk data (e.g. TransferBuffer results) does not need to go through the
+  client's outbound queue and the regular poll bundles. Instead, the blobs are
+  posted directly to the 'upload' endpoint of the frontend which writes them
+  into the blob store. Once a blob was acknowledged, only its hash has to be
+  reported to the flow.
+
+  The uploader is used from the worker thread and therefore has its own
+  HTTPManager. The communicator is shared with the comms thread.
+  """
+
+  def __init__(self, client_communicator, http_manager):
+    self.communicator = client_communicator
+    self.http_manager = http_manager
+
+  def _VerifyUploadResponse(self, http_object):
+    """Checks that the frontend acknowledged the upload."""
+    if http_object.code != 200:
+      return False
+
+    try:
+      _, http_object.source, http_object.nonce = (
+          self.communicator.DecryptMessage(http_object.data))
+      return True
+
+    except communicator.DecodingError as e:
+      logging.info("Upload response decode error: %s.", e)
+      return False
+
+  def UploadBlobs(self, blobs):
+    """Uploads a batch of blobs.
+
+    The frontend stores all the blobs before it acknowledges the request, so
+    once this method returns True the blobs can be referenced by hash. If the
+    upload fails, nothing is lost: callers are expected to fall back to sending
+    the blobs through the regular poll loop.
+
+    Args:
+      blobs: A list of DataBlob rdfvalues.
+
+    Returns:
+      True if the frontend has stored all the blobs.
+    """
+    if not self.communicator.server_name:
+      return False
+
+    message_list = rdf_flows.MessageList()
+    for blob in blobs:
+      message_list.job.Append(rdf_flows.GrrMessage(
+          payload=blob,
+          session_id=rdfvalue.SessionID(flow_name="TransferStore")))
+
+    payload = rdf_flows.ClientCommunication()
+    nonce = self.communicator.EncodeMessages(message_list, payload)
+    payload_data = payload.SerializeToString()
+
+    response = self.http_manager.OpenServerEndpoint(
+        path="upload?api=%s" % config_lib.CONFIG["Network.api"],
+        verify_cb=self._VerifyUploadResponse,
+        data=payload_data,
+        request_opts={"Content-Type": "binary/octet-stream"})
+
+    if response.code != 200 or response.nonce != nonce:
+      logging.info("Blob upload failed with status %s.", response.code)
+      return False
+
+    if response.source != self.communicator.server_name:
+      logging.info("Upload acknowledged by %s, expected %s.", response.source,
+                   self.communicator.server_name)
+      return False
+
+    stats.STATS.IncrementCounter("grr_client_uploaded_bytes",
+                                 len(payload_data))
+    return True
+
+
 class ClientCommunicator(communicator.Communicator):
   """A communicator implementation for clients.
 
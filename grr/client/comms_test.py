@@ -229,6 +229,47 @@ class HTTPManagerTest(test_lib.GRRBaseTest):
     self.assertEqual(manager.consecutive_connection_errors, 0)
 
 
+class TimerTest(test_lib.GRRBaseTest):
+  """Tests the client poll timer."""
+
+  def setUp(self):
+    super(TimerTest, self).setUp()
+    self.config_overrider = test_lib.ConfigOverrider({
+        "Client.poll_min": 1,
+        "Client.poll_max": 600,
+        "Client.poll_jitter": 0.1
+    })
+    self.config_overrider.Start()
+
+  def tearDown(self):
+    super(TimerTest, self).tearDown()
+    self.config_overrider.Stop()
+
+  def testServerHintsWithoutDelayDoNotChangePolling(self):
+    timer = comms.Timer()
+    timer.FastPoll()
+    timer.ApplyServerHints(0.5, 0)
+
+    self.assertEqual(timer.sleep_time, 1)
+    self.assertEqual(timer.server_load, 0.5)
+
+  def testServerHintsSlowDownPolling(self):
+    timer = comms.Timer()
+    timer.FastPoll()
+    timer.ApplyServerHints(1.0, 100)
+
+    # The requested delay is honoured with up to 10% of jitter.
+    self.assertGreaterEqual(timer.sleep_time, 90)
+    self.assertLessEqual(timer.sleep_time, 110)
+
+  def testServerHintsAreCappedByPollMax(self):
+    timer = comms.Timer()
+    timer.FastPoll()
+    timer.ApplyServerHints(1.0, 100000)
+
+    self.assertEqual(timer.sleep_time, 600)
+
+
 def main(argv):
   test_lib.main(argv)
 
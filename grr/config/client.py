@@ -105,6 +105,11 @@ config_lib.DEFINE_float("Client.error_poll_min", 15,
 
 config_lib.DEFINE_float("Client.poll_slew", 1.15, "Slew of poll time.")
 
+config_lib.DEFINE_float("Client.poll_jitter", 0.2,
+                        "Relative jitter applied to poll delays requested by "
+                        "the server, so clients told to back off at the same "
+                        "time do not all return at the same time.")
+
 config_lib.DEFINE_integer("Client.connection_error_limit", 60 * 24,
                           "If the client encounters this many connection "
                           "errors, it exits and restarts. Retries are one "
@@ -123,6 +128,12 @@ config_lib.DEFINE_list(
 config_lib.DEFINE_integer("Client.max_post_size", 40000000,
                           "Maximum size of the post.")
 
+config_lib.DEFINE_bool("Client.use_upload_channel", False,
+                       "If set, file buffers are posted directly to the "
+                       "frontend's upload endpoint instead of being sent "
+                       "through the regular poll loop. Only enable this if "
+                       "all frontends support the upload endpoint.")
+
 config_lib.DEFINE_integer("Client.max_out_queue", 51200000,
                           "Maximum size of the output queue.")
 
@@ -142,3 +142,23 @@ config_lib.DEFINE_integer("HTTPDataStore.retry_time",
                           5,
                           help=("Number of seconds to wait in-between attempts"
                                 "to reconnect to the database."))
+
+# Packfile blob store.
+config_lib.DEFINE_string("PackfileBlobstore.location",
+                         default="%(Config.prefix)/var/grr-blobstore",
+                         help="Directory the packfile blob store writes to.")
+
+config_lib.DEFINE_integer("PackfileBlobstore.max_packfile_size",
+                          default=256 * 1024 * 1024,
+                          help=("Size in bytes after which blobs are appended "
+                                "to a new packfile."))
+
+config_lib.DEFINE_float("PackfileBlobstore.compaction_ratio",
+                        default=0.5,
+                        help=("Fraction of deleted bytes in a packfile which "
+                              "triggers its compaction."))
+
+config_lib.DEFINE_integer("PackfileBlobstore.compaction_interval",
+                          default=600,
+                          help=("Interval (in seconds) between checks for "
+                                "packfiles to compact."))
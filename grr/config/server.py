@@ -74,6 +74,37 @@ config_lib.DEFINE_integer("Frontend.throttle_average_interval", 60,
                           "Time interval over which average request rate is "
                           "calculated when throttling is enabled.")
 
+config_lib.DEFINE_float("Frontend.poll_hint_max_delay", 600,
+                        "The longest poll delay (in seconds) the frontend "
+                        "will ask clients to observe when it is fully loaded. "
+                        "The delay sent to clients scales with the current "
+                        "load estimate.")
+
+config_lib.DEFINE_float("Frontend.load_estimate_decay", 0.05,
+                        "Weight given to each new bundle when updating the "
+                        "frontend load estimate sent to clients.")
+
+config_lib.DEFINE_bool("Frontend.admission_control", False,
+                       "If set, frontends publish health signals to the data "
+                       "store and limit the work they take on based on the "
+                       "signals published by all frontends.")
+
+config_lib.DEFINE_integer("Frontend.health_update_interval", 30,
+                          "Seconds between health signal updates when "
+                          "admission control is enabled.")
+
+config_lib.DEFINE_integer("Frontend.max_shard_backlog", 10000,
+                          "Worker notification backlog per queue shard above "
+                          "which frontends start handing out fewer tasks.")
+
+config_lib.DEFINE_float("Frontend.max_datastore_latency", 0.5,
+                        "99th percentile data store latency (in seconds) above "
+                        "which frontends start handing out fewer tasks.")
+
+config_lib.DEFINE_float("Frontend.max_blobstore_latency", 1.0,
+                        "99th percentile blob store write latency (in seconds) "
+                        "above which frontends start handing out fewer tasks.")
+
 config_lib.DEFINE_list("Frontend.well_known_flows", ["TransferStore", "Stats"],
                        "Allow these well known flows to run directly on the "
                        "frontend. Other flows are scheduled as normal.")
@@ -86,6 +117,18 @@ config_lib.DEFINE_string(
     "Frontend.static_url_path_prefix", "/static/",
     "The URL prefix for all streams served publicly from the frontend.")
 
+config_lib.DEFINE_float("Hunt.max_client_rate", 0,
+                        "The most clients per minute a single hunt starts, "
+                        "0 for no limit. Applies to hunts with a client_rate "
+                        "of 0 too. With frontend admission control enabled, "
+                        "rates are scaled down while the cluster is "
+                        "overloaded.")
+
+config_lib.DEFINE_integer("Hunt.client_start_burst", 1,
+                          "How many client starts a rate limited hunt saves "
+                          "up while no new clients arrive. These clients are "
+                          "started right away when they do arrive.")
+
 # Smtp settings.
 config_lib.DEFINE_string("Worker.smtp_server", "localhost",
                          "The smtp server for sending email alerts.")
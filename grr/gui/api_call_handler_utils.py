@@ -3,6 +3,7 @@
 
 
 
+import base64
 import cStringIO
 import itertools
 import os
@@ -258,3 +259,66 @@ def FilterAff4Collection(collection, offset, count=0, filter_value=None):
     items = list(itertools.islice(collection.GenerateItems(offset), count))
 
   return items
+
+
+def EncodeCollectionCursor(key):
+  """Encodes a (timestamp, suffix) collection key as an opaque cursor."""
+  return base64.urlsafe_b64encode("%d:%d" % key)
+
+
+def DecodeCollectionCursor(cursor):
+  """Decodes a cursor, returns a (timestamp, suffix) key or None."""
+  if not cursor:
+    return None
+
+  try:
+    timestamp, suffix = base64.urlsafe_b64decode(utils.SmartStr(
+        cursor)).split(":")
+    return (int(timestamp), int(suffix))
+  except (TypeError, ValueError):
+    raise ValueError("Invalid cursor: %s" % cursor)
+
+
+def FilterSequentialCollection(collection, cursor, count=0, filter_value=None):
+  """Gets count elements of a sequential collection following the cursor.
+
+  Unlike FilterAff4Collection, this continues the scan right where the
+  previous page ended, so the cost of fetching a page doesn't depend on how
+  deep into the collection the page is.
+
+  Args:
+    collection: A SequentialCollection.
+    cursor: A cursor returned by a previous call. If empty, elements are
+      returned from the start of the collection.
+    count: The maximum number of elements to return.
+    filter_value: If set, only elements whose serialized form contains this
+      string are returned.
+
+  Returns:
+    A pair (items, next_cursor) where next_cursor continues the scan after
+    the last element looked at.
+
+  Raises:
+    ValueError: If count is negative or the cursor is invalid.
+  """
+  if count < 0:
+    raise ValueError("Count needs to be greater than or equal to zero")
+
+  count = count or sys.maxint
+  items = []
+  next_cursor = cursor or ""
+  for key, item in collection.Scan(
+      after_timestamp=DecodeCollectionCursor(cursor),
+      include_suffix=True,
+      max_records=None if filter_value else count):
+    next_cursor = EncodeCollectionCursor(key)
+    if filter_value:
+      serialized_item = item.SerializeToString()
+      if not re.search(re.escape(filter_value), serialized_item, re.I):
+        continue
+
+    items.append(item)
+    if len(items) >= count:
+      break
+
+  return items, next_cursor
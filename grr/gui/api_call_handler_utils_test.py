@@ -18,6 +18,7 @@ from grr.lib import aff4
 from grr.lib import flags
 from grr.lib import test_lib
 from grr.lib.aff4_objects import collects
+from grr.lib.aff4_objects import sequential_collection
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import crypto as rdf_crypto
 from grr.lib.rdfvalues import paths as rdf_paths
@@ -284,6 +285,57 @@ class FilterAff4CollectionTest(test_lib.GRRBaseTest):
     self.assertEqual(data[0].path, "/var/os/tmp-8")
 
 
+class FilterSequentialCollectionTest(test_lib.GRRBaseTest):
+  """Test for FilterSequentialCollection."""
+
+  def setUp(self):
+    super(FilterSequentialCollectionTest, self).setUp()
+
+    with aff4.FACTORY.Create("aff4:/tmp/foo/bar",
+                             sequential_collection.GeneralIndexedCollection,
+                             token=self.token) as fd:
+      for i in range(10):
+        fd.Add(rdf_paths.PathSpec(path="/var/os/tmp-%d" % i, pathtype="OS"),
+               timestamp=i + 1)
+
+    self.fd = aff4.FACTORY.Open("aff4:/tmp/foo/bar", token=self.token)
+
+  def testPagesThroughCollection(self):
+    paths = []
+    cursor = ""
+    for _ in range(4):
+      data, cursor = api_call_handler_utils.FilterSequentialCollection(
+          self.fd, cursor, 3, None)
+      paths.extend(item.path for item in data)
+
+    self.assertEqual(paths, ["/var/os/tmp-%d" % i for i in range(10)])
+
+    # At the end, the cursor stays put until new items arrive.
+    data, next_cursor = api_call_handler_utils.FilterSequentialCollection(
+        self.fd, cursor, 3, None)
+    self.assertEqual(data, [])
+    self.assertEqual(next_cursor, cursor)
+
+  def testFiltersByFilterString(self):
+    data, cursor = api_call_handler_utils.FilterSequentialCollection(
+        self.fd, "", 1, "tmp-8")
+    self.assertEqual(len(data), 1)
+    self.assertEqual(data[0].path, "/var/os/tmp-8")
+
+    data, _ = api_call_handler_utils.FilterSequentialCollection(
+        self.fd, cursor, 0, "tmp-")
+    self.assertEqual(len(data), 1)
+    self.assertEqual(data[0].path, "/var/os/tmp-9")
+
+  def testRaisesOnInvalidCursor(self):
+    with self.assertRaises(ValueError):
+      api_call_handler_utils.FilterSequentialCollection(self.fd, "foo", 0, None)
+
+  def testRaisesOnNegativeCount(self):
+    with self.assertRaises(ValueError):
+      api_call_handler_utils.FilterSequentialCollection(self.fd, "", -10, None)
+
+
 def main(argv):
   test_lib.main(argv)
 
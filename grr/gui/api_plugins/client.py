@@ -38,6 +38,29 @@ class InterrogateOperationNotFoundError(
 class ApiClient(rdf_structs.RDFProtoStruct):
   protobuf = api_pb2.ApiClient
 
+  # The client attributes read by InitFromAff4Object().
+  CLIENT_ATTRIBUTES = [
+      aff4_grr.VFSGRRClient.SchemaCls.CLIENT_INFO,
+      aff4_grr.VFSGRRClient.SchemaCls.HARDWARE_INFO,
+      aff4_grr.VFSGRRClient.SchemaCls.SYSTEM,
+      aff4_grr.VFSGRRClient.SchemaCls.HOSTNAME,
+      aff4_grr.VFSGRRClient.SchemaCls.OS_RELEASE,
+      aff4_grr.VFSGRRClient.SchemaCls.OS_VERSION,
+      aff4_grr.VFSGRRClient.SchemaCls.KERNEL,
+      aff4_grr.VFSGRRClient.SchemaCls.ARCH,
+      aff4_grr.VFSGRRClient.SchemaCls.FQDN,
+      aff4_grr.VFSGRRClient.SchemaCls.INSTALL_DATE,
+      aff4_grr.VFSGRRClient.SchemaCls.FIRST_SEEN,
+      aff4_grr.VFSGRRClient.SchemaCls.PING,
+      aff4_grr.VFSGRRClient.SchemaCls.LAST_BOOT_TIME,
+      aff4_grr.VFSGRRClient.SchemaCls.CLOCK,
+      aff4_grr.VFSGRRClient.SchemaCls.LAST_CRASH,
+      aff4_grr.VFSGRRClient.SchemaCls.LABELS,
+      aff4_grr.VFSGRRClient.SchemaCls.LAST_INTERFACES,
+      aff4_grr.VFSGRRClient.SchemaCls.KNOWLEDGE_BASE,
+      aff4_grr.VFSGRRClient.SchemaCls.VOLUMES,
+  ]
+
   def InitFromAff4Object(self, client_obj):
     self.urn = client_obj.urn
 
@@ -105,7 +128,9 @@ class ApiSearchClientsHandler(api_call_handler_base.ApiCallHandler):
                                 token=token)
     result_urns = sorted(
         index.LookupClients(keywords), key=str)[args.offset:args.offset + end]
-    result_set = aff4.FACTORY.MultiOpen(result_urns, token=token)
+    result_set = aff4.FACTORY.MultiOpen(result_urns,
+                                        attributes=ApiClient.CLIENT_ATTRIBUTES,
+                                        token=token)
 
     api_clients = []
     for child in result_set:
@@ -157,6 +182,7 @@ class ApiLabelsRestrictedSearchClientsHandler(
     all_objs = aff4.FACTORY.MultiOpen(
         sorted(all_urns, key=str),
         aff4_type=aff4_grr.VFSGRRClient,
+        attributes=ApiClient.CLIENT_ATTRIBUTES,
         token=token)
 
     api_clients = []
@@ -21,6 +21,7 @@ from grr.lib import rdfvalue
 from grr.lib import utils
 from grr.lib.aff4_objects import aff4_grr
 from grr.lib.aff4_objects import collects
+from grr.lib.aff4_objects import sequential_collection
 from grr.lib.aff4_objects import users as aff4_users
 
 from grr.lib.flows.general import export
@@ -84,7 +85,7 @@ class ApiHunt(rdf_structs.RDFProtoStruct):
     self.description = context.args.description
     self.is_robot = context.creator == "GRRWorker"
 
-    hunt_stats = context.usage_stats
+    hunt_stats = hunt.GetClientResourcesStats()
     self.total_cpu_usage = hunt_stats.user_cpu_stats.sum
     self.total_net_usage = hunt_stats.network_bytes_sent_stats.sum
 
@@ -303,13 +304,22 @@ class ApiListHuntResultsHandler(api_call_handler_base.ApiCallHandler):
         HUNTS_ROOT_PATH.Add(args.hunt_id).Add("Results"),
         mode="r",
         token=token)
-    items = api_call_handler_utils.FilterAff4Collection(results_collection,
-                                                        args.offset, args.count,
-                                                        args.filter)
+
+    next_cursor = None
+    if args.HasField("cursor") and isinstance(
+        results_collection, sequential_collection.SequentialCollection):
+      items, next_cursor = api_call_handler_utils.FilterSequentialCollection(
+          results_collection, args.cursor, args.count, args.filter)
+    else:
+      items = api_call_handler_utils.FilterAff4Collection(
+          results_collection, args.offset, args.count, args.filter)
     wrapped_items = [ApiHuntResult().InitFromGrrMessage(item) for item in items]
 
-    return ApiListHuntResultsResult(items=wrapped_items,
-                                    total_count=len(results_collection))
+    result = ApiListHuntResultsResult(items=wrapped_items,
+                                      total_count=len(results_collection))
+    if next_cursor is not None:
+      result.next_cursor = next_cursor
+    return result
 
 
 class ApiListHuntCrashesArgs(rdf_structs.RDFProtoStruct):
@@ -626,12 +636,22 @@ class ApiGetHuntClientCompletionStatsHandler(
         mode="r",
         token=token)
 
-    clients_by_status = hunt.GetClientsByStatus()
-    started_clients = clients_by_status["STARTED"]
-    completed_clients = clients_by_status["COMPLETED"]
+    counters = hunt.client_counters
+    if counters is not None:
+      histograms = counters.GetHistograms()
+      (start_stats, complete_stats) = self._SampleHistograms(
+          counters,
+          histograms[implementation.HuntClientCounters.STARTED],
+          histograms[implementation.HuntClientCounters.COMPLETED])
+    else:
+      # Older hunts don't keep client counters, their client lists have to be
+      # read in full.
+      clients_by_status = hunt.GetClientsByStatus()
+      started_clients = clients_by_status["STARTED"]
+      completed_clients = clients_by_status["COMPLETED"]
 
-    (start_stats, complete_stats) = self._SampleClients(started_clients,
-                                                        completed_clients)
+      (start_stats, complete_stats) = self._SampleClients(started_clients,
+                                                          completed_clients)
 
     if len(start_stats) > target_size:
       # start_stats and complete_stats are equally big, so resample both
@@ -641,6 +661,32 @@ class ApiGetHuntClientCompletionStatsHandler(
     return ApiGetHuntClientCompletionStatsResult().InitFromDataPoints(
         start_stats, complete_stats)
 
+  def _SampleHistograms(self, counters, start_histogram, complete_histogram):
+    """Turns hunt client histograms into cumulative data points."""
+    if not start_histogram and not complete_histogram:
+      return ([], [])
+
+    all_buckets = set(start_histogram) | set(complete_histogram)
+    t0 = min(all_buckets)
+
+    times = [0.0]
+    cl = [0]
+    fi = [0]
+    cl_count = 0
+    fi_count = 0
+
+    # Data points are placed at the end of the buckets, in hours from the
+    # start of the first bucket.
+    for bucket in sorted(all_buckets):
+      cl_count += start_histogram.get(bucket, 0)
+      fi_count += complete_histogram.get(bucket, 0)
+
+      times.append((counters.GetBucketEnd(bucket) - t0) / 3600.0)
+      cl.append(cl_count)
+      fi.append(fi_count)
+
+    return (zip(times, cl), zip(times, fi))
+
   def _SampleClients(self, started_clients, completed_clients):
     # immediately return on empty client data
     if not started_clients and not completed_clients:
@@ -890,9 +936,13 @@ class ApiGetHuntStatsHandler(api_call_handler_base.ApiCallHandler):
         aff4_type=hunts.GRRHunt,
         token=token)
 
-    stats = hunt.GetRunner().context.usage_stats
+    context = hunt.GetRunner().context
+    scheduler = implementation.HuntClientScheduler(context, token=token)
 
-    return ApiGetHuntStatsResult(stats=stats)
+    return ApiGetHuntStatsResult(
+        stats=hunt.GetClientResourcesStats(),
+        current_client_rate=scheduler.GetCurrentRate(),
+        target_client_rate=scheduler.GetTargetRate())
 
 
 class ApiListHuntClientsArgs(rdf_structs.RDFProtoStruct):
@@ -251,9 +251,9 @@ class ApiGetHuntHandlerRegressionTest(api_test_lib.ApiCallHandlerRegressionTest,
       with self.CreateHunt(description="the hunt") as hunt_obj:
         hunt_urn = hunt_obj.urn
 
-        hunt_stats = hunt_obj.state.context.usage_stats
-        hunt_stats.user_cpu_stats.sum = 5000
-        hunt_stats.network_bytes_sent_stats.sum = 1000000
+        hunt_obj.RegisterClientResources(rdf_client.ClientResources(
+            cpu_usage=rdf_client.CpuSeconds(user_cpu_time=5000),
+            network_bytes_sent=1000000))
 
     self.Check("GET",
                "/api/hunts/" + hunt_urn.Basename(),
@@ -835,7 +835,7 @@ class ApiGetHuntStatsHandlerRegressionTest(
     # Create replace dictionary.
     replace = {hunt_urn.Basename(): "H:123456"}
     with aff4.FACTORY.Open(hunt_urn, mode="r", token=self.token) as hunt:
-      stats = hunt.GetRunner().context.usage_stats
+      stats = hunt.GetClientResourcesStats()
       for performance in stats.worst_performers:
         session_id = performance.session_id.Basename()
         replace[session_id] = "<replaced session value>"
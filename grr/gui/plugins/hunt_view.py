@@ -487,7 +487,7 @@ class HuntOverviewRenderer(AbstractLogRenderer):
         if self.hunt.state.Empty():
           raise IOError("No valid state could be found.")
 
-        hunt_stats = self.hunt.state.context.usage_stats
+        hunt_stats = self.hunt.GetClientResourcesStats()
         self.cpu_sum = "%.2f" % hunt_stats.user_cpu_stats.sum
         self.net_sum = hunt_stats.network_bytes_sent_stats.sum
 
@@ -751,7 +751,7 @@ class HuntStatsRenderer(renderers.TemplateRenderer):
         if hunt.state.Empty():
           raise IOError("No valid state could be found.")
 
-        self.stats = hunt.state.context.usage_stats
+        self.stats = hunt.GetClientResourcesStats()
 
         self.user_cpu_json_data = self._HistogramToJSON(
             self.stats.user_cpu_stats.histogram)
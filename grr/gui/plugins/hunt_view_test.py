@@ -489,9 +489,9 @@ class TestHuntView(test_lib.GRRSeleniumTest):
     """Test the detailed client view works."""
     with self.ACLChecksDisabled():
       with self.CreateSampleHunt() as hunt:
-        hunt_stats = hunt.state.context.usage_stats
-        hunt_stats.user_cpu_stats.sum = 5000
-        hunt_stats.network_bytes_sent_stats.sum = 1000000
+        hunt.RegisterClientResources(rdf_client.ClientResources(
+            cpu_usage=rdf_client.CpuSeconds(user_cpu_time=5000),
+            network_bytes_sent=1000000))
 
     # Open up and click on View Hunts then the first Hunt.
     self.Open("/")
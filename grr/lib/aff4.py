@@ -75,7 +75,7 @@ class MissingChunksError(Exception):
 class DeletionPool(object):
   """Pool used to optimize deletion of large object hierarchies."""
 
-  def __init__(self, token=None):
+  def __init__(self, token=None, progress_callback=None):
     super(DeletionPool, self).__init__()
 
     if token is None:
@@ -86,6 +86,11 @@ class DeletionPool(object):
     self._urns_for_deletion = set()
 
     self._token = token
+    self._progress_callback = progress_callback
+
+  def _ReportProgress(self):
+    if self._progress_callback is not None:
+      self._progress_callback()
 
   def _ObjectKey(self, urn, mode):
     return u"%s:%s" % (mode, utils.SmartUnicode(urn))
@@ -130,8 +135,19 @@ class DeletionPool(object):
 
     return obj
 
-  def MultiOpen(self, urns, aff4_type=None, mode="r"):
-    """Opens many urns efficiently, returning cached objects when possible."""
+  def MultiOpen(self, urns, aff4_type=None, mode="r", attributes=None):
+    """Opens many urns efficiently, returning cached objects when possible.
+
+    Args:
+      urns: The urns to open.
+      aff4_type: If set, only objects of this type are returned.
+      mode: The mode to open the objects with.
+      attributes: If set, only these attributes are read from the data store
+        for objects which are not cached yet. See Factory.MultiOpen().
+
+    Yields:
+      The opened AFF4Object instances.
+    """
     not_opened_urns = []
     aff4_type = _ValidateAFF4Type(aff4_type)
 
@@ -150,7 +166,8 @@ class DeletionPool(object):
       for obj in FACTORY.MultiOpen(not_opened_urns,
                                    follow_symlinks=False,
                                    mode=mode,
-                                   token=self._token):
+                                   token=self._token,
+                                   attributes=attributes):
         key = self._ObjectKey(obj.urn, mode)
         self._objects_cache[key] = obj
 
@@ -215,6 +232,7 @@ class DeletionPool(object):
     for urn, children in FACTORY.RecursiveMultiListChildren(not_cached_urns,
                                                             token=self._token):
       result[urn] = self._children_lists_cache[urn] = children
+      self._ReportProgress()
 
     return result
 
@@ -229,8 +247,11 @@ class DeletionPool(object):
     urns += list(itertools.chain.from_iterable(all_children_urns.values()))
     self._urns_for_deletion.update(urns)
 
-    for obj in self.MultiOpen(urns):
+    # Objects are only opened to run their OnDelete() handlers. Most of them
+    # don't look at their attributes, those that do read them lazily.
+    for obj in self.MultiOpen(urns, attributes=[]):
       obj.OnDelete(deletion_pool=self)
+    self._ReportProgress()
 
   @property
   def root_urns_for_deletion(self):
@@ -244,10 +265,10 @@ class DeletionPool(object):
       for root in roots:
         str_root = utils.SmartUnicode(root)
 
-        if str_urn.startswith(str_root):
+        if str_urn == str_root or str_urn.startswith(str_root + "/"):
           new_root = False
           break
-        elif str_root.startswith(str_urn):
+        elif str_root.startswith(str_urn + "/"):
           fake_roots.append(root)
 
       if new_root:
@@ -262,6 +283,31 @@ class DeletionPool(object):
     return self._urns_for_deletion
 
 
+def _AttributePredicates(attributes):
+  """Returns the predicates to fetch for an attribute projection.
+
+  Args:
+    attributes: A list of Attribute instances or predicate names, or None to
+      fetch all attributes.
+
+  Returns:
+    A set of predicates or None if all attributes should be fetched. The type
+    and last modification time of the object are always included.
+  """
+  if attributes is None:
+    return None
+
+  predicates = set([AFF4Object.SchemaCls.TYPE.predicate,
+                    AFF4Object.SchemaCls.LAST.predicate])
+  for attribute in attributes:
+    if isinstance(attribute, basestring):
+      predicates.add(attribute)
+    else:
+      predicates.add(attribute.predicate)
+
+  return predicates
+
+
 def _ValidateAFF4Type(aff4_type):
   """Validates and normalizes aff4_type to class object."""
   if aff4_type is None:
@@ -284,6 +330,12 @@ class Factory(object):
     self.cache = utils.AgeBasedCache(
         max_size=config_lib.CONFIG["AFF4.cache_max_size"],
         max_age=config_lib.CONFIG["AFF4.cache_age"])
+    # Subjects which were found not to exist, keyed by urn. Each entry is the
+    # set of cache keys the subject is missing for, so that writes can expire
+    # them without scanning the whole cache.
+    self.missing_cache = utils.AgeBasedCache(
+        max_size=config_lib.CONFIG["AFF4.cache_max_size"],
+        max_age=config_lib.CONFIG["AFF4.cache_age"])
     self.intermediate_cache = utils.AgeBasedCache(
         max_size=config_lib.CONFIG["AFF4.intermediate_cache_max_size"],
         max_age=config_lib.CONFIG["AFF4.intermediate_cache_age"])
@@ -320,16 +372,43 @@ class Factory(object):
                     urns,
                     ignore_cache=False,
                     token=None,
-                    age=NEWEST_TIME):
-    """Retrieves all the attributes for all the urns."""
+                    age=NEWEST_TIME,
+                    attribute_prefixes=AFF4_PREFIXES):
+    """Retrieves all the attributes for all the urns.
+
+    Subjects which do not exist are not returned. This is cached as well, so
+    repeatedly asking for missing subjects does not hit the data store. Only
+    writes made by this process (Create(), SetAttributes() and MultiDelete())
+    expire a cached absence, subjects created elsewhere stay hidden for up to
+    AFF4.cache_age.
+
+    Args:
+      urns: The urns to retrieve.
+      ignore_cache: Forces a data store read.
+      token: The Security Token to use.
+      age: The age policy of the attributes to retrieve.
+      attribute_prefixes: Only retrieve attributes starting with these.
+
+    Yields:
+      (subject, values) tuples, where values are lists of
+      (attribute, value, timestamp) sorted newest first.
+    """
     urns = set([utils.SmartUnicode(u) for u in urns])
     if not ignore_cache:
       for subject in list(urns):
-        key = self._MakeCacheInvariant(subject, token, age)
+        key = self._MakeCacheInvariant(subject, token, age,
+                                       attribute_prefixes=attribute_prefixes)
 
         try:
           yield subject, self.cache.Get(key)
           urns.remove(subject)
+          continue
+        except KeyError:
+          pass
+
+        try:
+          if key in self.missing_cache.Get(subject):
+            urns.remove(subject)
         except KeyError:
           pass
 
@@ -337,7 +416,7 @@ class Factory(object):
     if urns:
       for subject, values in data_store.DB.MultiResolvePrefix(
           urns,
-          AFF4_PREFIXES,
+          attribute_prefixes,
           timestamp=self.ParseAgeSpecification(age),
           token=token,
           limit=None):
@@ -345,10 +424,23 @@ class Factory(object):
         # Ensure the values are sorted.
         values.sort(key=lambda x: x[-1], reverse=True)
 
-        key = self._MakeCacheInvariant(subject, token, age)
+        subject = utils.SmartUnicode(subject)
+        urns.discard(subject)
+
+        key = self._MakeCacheInvariant(subject, token, age,
+                                       attribute_prefixes=attribute_prefixes)
         self.cache.Put(key, values)
 
-        yield utils.SmartUnicode(subject), values
+        yield subject, values
+
+      # Remember the subjects which do not exist.
+      for subject in urns:
+        key = self._MakeCacheInvariant(subject, token, age,
+                                       attribute_prefixes=attribute_prefixes)
+        try:
+          self.missing_cache.Get(subject).add(key)
+        except KeyError:
+          self.missing_cache.Put(subject, set([key]))
 
   def SetAttributes(self,
                     urn,
@@ -360,12 +452,7 @@ class Factory(object):
                     token=None):
     """Sets the attributes in the data store and update the cache."""
     # Force a data_store lookup next.
-    try:
-      # Expire all entries in the cache for this urn (for all tokens, and
-      # timestamps)
-      self.cache.ExpirePrefix(utils.SmartStr(urn) + ":")
-    except KeyError:
-      pass
+    self._ExpireCachedAttributes(urn)
 
     attributes[AFF4Object.SchemaCls.LAST] = [
         rdfvalue.RDFDatetime().Now().SerializeToDataStore()
@@ -388,6 +475,20 @@ class Factory(object):
     if add_child_index:
       self._UpdateChildIndex(urn, token, mutation_pool=mutation_pool)
 
+  def _ExpireCachedAbsence(self, urn):
+    """Expires the cached absence of urn, if any."""
+    self.missing_cache.ExpireObject(utils.SmartUnicode(urn))
+
+  def _ExpireCachedAttributes(self, urn):
+    """Expires the cached attributes of urn, including a cached absence."""
+    self._ExpireCachedAbsence(urn)
+    try:
+      # Expire all entries in the cache for this urn (for all tokens, and
+      # timestamps)
+      self.cache.ExpirePrefix(utils.SmartStr(urn) + ":")
+    except KeyError:
+      pass
+
   def _UpdateChildIndex(self, urn, token, mutation_pool=None):
     """Update the child indexes.
 
@@ -438,6 +539,8 @@ class Factory(object):
                                    replace=True,
                                    sync=False)
 
+          # The parent may have been cached as not existing.
+          self._ExpireCachedAttributes(dirname)
           self.intermediate_cache.Put(urn, 1)
 
           urn = dirname
@@ -469,6 +572,8 @@ class Factory(object):
       if mutation_pool is None:
         pool.Flush()
 
+      self._ExpireCachedAttributes(dirname)
+
     except access_control.UnauthorizedAccess:
       pass
 
@@ -484,12 +589,12 @@ class Factory(object):
     """
 
     x = ROOT_URN
-    for component in rdfvalue.RDFURN(urn).Path().split("/"):
-      if component:
-        x = x.Add(component)
-        unique_urns.add(x)
+    for component in rdfvalue.RDFURN(urn).Split():
+      x = x.Add(component)
+      unique_urns.add(x)
 
-  def _MakeCacheInvariant(self, urn, token, age):
+  def _MakeCacheInvariant(self, urn, token, age,
+                          attribute_prefixes=AFF4_PREFIXES):
     """Returns an invariant key for an AFF4 object.
 
     The object will be cached based on this key. This function is specifically
@@ -501,12 +606,17 @@ class Factory(object):
        token: The access token used to receive the object.
        age: The age policy used to build this object. Should be one
             of ALL_TIMES, NEWEST_TIME or a range.
+       attribute_prefixes: The attribute prefixes the object was read with.
 
     Returns:
        A key into the cache.
     """
-    return "%s:%s:%s" % (utils.SmartStr(urn), utils.SmartStr(token),
-                         self.ParseAgeSpecification(age))
+    key = "%s:%s:%s" % (utils.SmartStr(urn), utils.SmartStr(token),
+                        self.ParseAgeSpecification(age))
+    if attribute_prefixes is not AFF4_PREFIXES:
+      key += ":%s" % ",".join(sorted(attribute_prefixes))
+
+    return key
 
   def CreateWithLock(self,
                      urn,
@@ -702,7 +812,8 @@ class Factory(object):
            local_cache=None,
            age=NEWEST_TIME,
            follow_symlinks=True,
-           transaction=None):
+           transaction=None,
+           attributes=None):
     """Opens the named object.
 
     This instantiates the object from the AFF4 data store.
@@ -737,6 +848,9 @@ class Factory(object):
 
       follow_symlinks: If object opened is a symlink, follow it.
       transaction: A transaction in case this object is opened under lock.
+      attributes: If set, only these attributes (and the type of the object)
+         are read from the data store. Other attributes are read on first
+         access.
 
     Returns:
       An AFF4Object instance.
@@ -767,6 +881,8 @@ class Factory(object):
     if token is None:
       token = data_store.default_token
 
+    predicates = _AttributePredicates(attributes)
+
     if "r" in mode and (local_cache is None or urn not in local_cache):
       # Warm up the cache. The idea is to prefetch all the path components in
       # the same round trip and make sure this data is in cache, so that as each
@@ -774,10 +890,12 @@ class Factory(object):
       # than round tripping to the data store.
       unique_urn = set()
       self._ExpandURNComponents(urn, unique_urn)
-      local_cache = dict(self.GetAttributes(unique_urn,
-                                            age=age,
-                                            ignore_cache=ignore_cache,
-                                            token=token))
+      local_cache = dict(self.GetAttributes(
+          unique_urn,
+          age=age,
+          ignore_cache=ignore_cache,
+          token=token,
+          attribute_prefixes=predicates or AFF4_PREFIXES))
 
     # Read the row from the table. We know the object already exists if there is
     # some data in the local_cache already for this object.
@@ -788,7 +906,8 @@ class Factory(object):
                         age=age,
                         follow_symlinks=follow_symlinks,
                         object_exists=bool(local_cache.get(urn)),
-                        transaction=transaction)
+                        transaction=transaction,
+                        loaded_predicates=predicates)
 
     result.aff4_type = aff4_type
 
@@ -816,8 +935,25 @@ class Factory(object):
                 token=None,
                 aff4_type=None,
                 age=NEWEST_TIME,
-                follow_symlinks=True):
-    """Opens a bunch of urns efficiently."""
+                follow_symlinks=True,
+                attributes=None):
+    """Opens a bunch of urns efficiently.
+
+    Args:
+      urns: The urns to open.
+      mode: The mode to open the objects with.
+      ignore_cache: Forces a data store read.
+      token: The Security Token to use for opening the objects.
+      aff4_type: If set, only objects of this type are returned.
+      age: The age policy used to build the objects.
+      follow_symlinks: If an object opened is a symlink, follow it.
+      attributes: If set, only these attributes (and the type of the objects)
+         are read from the data store. Other attributes are read on first
+         access.
+
+    Yields:
+      The opened AFF4Object instances. Urns which do not exist are skipped.
+    """
 
     if token is None:
       token = data_store.default_token
@@ -829,7 +965,12 @@ class Factory(object):
 
     aff4_type = _ValidateAFF4Type(aff4_type)
 
-    for urn, values in self.GetAttributes(urns, token=token, age=age):
+    predicates = _AttributePredicates(attributes)
+    for urn, values in self.GetAttributes(
+        urns,
+        token=token,
+        age=age,
+        attribute_prefixes=predicates or AFF4_PREFIXES):
       try:
         obj = self.Open(urn,
                         mode=mode,
@@ -837,7 +978,8 @@ class Factory(object):
                         token=token,
                         local_cache={urn: values},
                         age=age,
-                        follow_symlinks=False)
+                        follow_symlinks=False,
+                        attributes=attributes)
         # We can't pass aff4_type to Open since it will raise on AFF4Symlinks.
         # Setting it here, if needed, so that BadGetAttributeError checking
         # works.
@@ -862,7 +1004,8 @@ class Factory(object):
                                 ignore_cache=ignore_cache,
                                 token=token,
                                 aff4_type=aff4_type,
-                                age=age):
+                                age=age,
+                                attributes=attributes):
         obj.symlink_urn = symlinks[obj.urn]
         yield obj
 
@@ -1023,6 +1166,8 @@ class Factory(object):
 
     if urn is not None:
       urn = rdfvalue.RDFURN(urn)
+      # The object is about to be written.
+      self._ExpireCachedAbsence(urn)
 
     aff4_type = _ValidateAFF4Type(aff4_type)
 
@@ -1065,15 +1210,21 @@ class Factory(object):
 
     return result
 
-  def MultiDelete(self, urns, token=None):
+  def MultiDelete(self, urns, token=None, progress_callback=None):
     """Drop all the information about given objects.
 
     DANGEROUS! This recursively deletes all objects contained within the
     specified URN.
 
+    Every subject below the deleted objects is removed with a single prefix
+    delete per subtree, including subjects which are not indexed as children.
+
     Args:
       urns: Urns of objects to remove.
       token: The Security Token to use for opening this item.
+      progress_callback: If set, called periodically while the objects are
+        deleted. Long running callers (e.g. cron jobs) can use this to
+        heartbeat.
     Raises:
       RuntimeError: If one of the urns is too short. This is a safety check to
       ensure the root is not removed.
@@ -1087,7 +1238,8 @@ class Factory(object):
       if urn.Path() == "/":
         raise RuntimeError("Can't delete root URN. Please enter a valid URN")
 
-    deletion_pool = DeletionPool(token=token)
+    deletion_pool = DeletionPool(token=token,
+                                 progress_callback=progress_callback)
     deletion_pool.MultiMarkForDeletion(urns)
 
     marked_root_urns = deletion_pool.root_urns_for_deletion
@@ -1106,6 +1258,7 @@ class Factory(object):
       # below the target object (along with indexes) is going to be
       # deleted.
       self._DeleteChildFromIndex(root, token, mutation_pool=pool)
+    pool.Flush()
 
     for urn_to_delete in marked_urns:
       try:
@@ -1113,8 +1266,10 @@ class Factory(object):
       except KeyError:
         pass
 
-    pool.DeleteSubjects(marked_urns)
-    pool.Flush()
+    for root in marked_root_urns:
+      data_store.DB.DeleteSubjectPrefix(root, token=token)
+      if progress_callback is not None:
+        progress_callback()
 
     # Ensure this is removed from the cache as well.
     self.Flush()
@@ -1240,6 +1395,7 @@ class Factory(object):
   def Flush(self):
     data_store.DB.Flush()
     self.cache.Flush()
+    self.missing_cache.Flush()
     self.intermediate_cache.Flush()
 
 
@@ -1703,7 +1859,8 @@ class AFF4Object(object):
                aff4_type=None,
                object_exists=False,
                mutation_pool=None,
-               transaction=None):
+               transaction=None,
+               loaded_predicates=None):
     if urn is not None:
       urn = rdfvalue.RDFURN(urn)
     self.urn = urn
@@ -1738,6 +1895,12 @@ class AFF4Object(object):
     # verify aff4 attributes exist in the schema at Get() time.
     self.aff4_type = aff4_type
 
+    # If the object was opened with an attribute projection, these are the
+    # predicates read from the data store so far. None means all of them.
+    if loaded_predicates is not None:
+      loaded_predicates = set(loaded_predicates)
+    self.loaded_predicates = loaded_predicates
+
     # We maintain two attribute caches - self.synced_attributes reflects the
     # attributes which are synced with the data_store, while self.new_attributes
     # are new attributes which still need to be flushed to the data_store. When
@@ -1755,6 +1918,8 @@ class AFF4Object(object):
         # data_store now.
         self.new_attributes = clone.new_attributes.copy()
         self.synced_attributes = clone.synced_attributes.copy()
+        if clone.loaded_predicates is not None:
+          self.loaded_predicates = clone.loaded_predicates.copy()
 
       else:
         raise RuntimeError("Cannot clone from %s." % clone)
@@ -1771,9 +1936,11 @@ class AFF4Object(object):
             pass
         else:
           # Populate the caches from the data store.
-          for urn, values in FACTORY.GetAttributes([urn],
-                                                   age=age,
-                                                   token=self.token):
+          for urn, values in FACTORY.GetAttributes(
+              [urn],
+              age=age,
+              token=self.token,
+              attribute_prefixes=loaded_predicates or AFF4_PREFIXES):
             for attribute_name, value, ts in values:
               self.DecodeValueFromAttribute(attribute_name, value, ts)
 
@@ -1813,6 +1980,33 @@ class AFF4Object(object):
       logging.debug("%s: %s invalid encoding. Skipping.", self.urn,
                     attribute_name)
 
+  @utils.Synchronized
+  def _LoadAttribute(self, attribute):
+    """Reads an attribute left out by the projection the object was opened with.
+
+    Args:
+       attribute: The Attribute to read.
+    """
+    if (self.loaded_predicates is None or
+        attribute.predicate in self.loaded_predicates):
+      return
+
+    self.loaded_predicates.add(attribute.predicate)
+    if "r" not in self.mode:
+      return
+
+    # Values of other attributes sharing the prefix are already loaded.
+    self.synced_attributes.pop(attribute, None)
+    for _, values in FACTORY.GetAttributes([self.urn],
+                                           age=self.age_policy,
+                                           token=self.token,
+                                           attribute_prefixes=[
+                                               attribute.predicate
+                                           ]):
+      for attribute_name, value, ts in values:
+        if attribute_name == attribute.predicate:
+          self.DecodeValueFromAttribute(attribute_name, value, ts)
+
   def _AddAttributeToCache(self, attribute_name, value, cache):
     """Helper to add a new attribute to a cache."""
     # If there's another value in cache with the same timestamp, the last added
@@ -2074,6 +2268,8 @@ class AFF4Object(object):
     # Non-versioned attributes always replace previous versions and get written
     # at the earliest timestamp (so they appear in all objects).
     else:
+      if self.loaded_predicates is not None:
+        self.loaded_predicates.add(attribute.predicate)
       self._to_delete.add(attribute)
       self.synced_attributes.pop(attribute, None)
       self.new_attributes.pop(attribute, None)
@@ -2093,6 +2289,7 @@ class AFF4Object(object):
     if self.mode != "w" and attribute.lock_protected and not self.transaction:
       raise IOError("Object must be locked to delete attribute %s." % attribute)
 
+    self._LoadAttribute(attribute)
     if attribute in self.synced_attributes:
       self._to_delete.add(attribute)
       del self.synced_attributes[attribute]
@@ -2118,6 +2315,7 @@ class AFF4Object(object):
     Checking Get against None doesn't work as Get will return a default
     attribute value. This determines if the attribute has been manually set.
     """
+    self._LoadAttribute(attribute)
     return (attribute in self.synced_attributes or
             attribute in self.new_attributes)
 
@@ -2162,6 +2360,7 @@ class AFF4Object(object):
     elif isinstance(attribute, basestring):
       attribute = Attribute.GetAttributeByName(attribute)
 
+    self._LoadAttribute(attribute)
     return attribute.GetValues(self)
 
   def Update(self, attribute=None, user=None, priority=None):
@@ -2443,7 +2642,8 @@ class AFF4Volume(AFF4Object):
                    mode="r",
                    limit=1000000,
                    chunk_limit=100000,
-                   age=NEWEST_TIME):
+                   age=NEWEST_TIME,
+                   attributes=None):
     """Yields AFF4 Objects of all our direct children.
 
     This method efficiently returns all attributes for our children directly, in
@@ -2458,6 +2658,7 @@ class AFF4Volume(AFF4Object):
       chunk_limit: Maximum number of items to retrieve at a time.
       age: The age of the items to retrieve. Should be one of ALL_TIMES,
            NEWEST_TIME or a range.
+      attributes: If set, only read these attributes of the children up front.
     Yields:
       Instances for each direct child.
     """
@@ -2473,7 +2674,8 @@ class AFF4Volume(AFF4Object):
       for child in FACTORY.MultiOpen(to_read,
                                      mode=mode,
                                      token=self.token,
-                                     age=age):
+                                     age=age,
+                                     attributes=attributes):
         yield child
 
   @property
@@ -2833,8 +3035,18 @@ class AFF4ImageBase(AFF4Stream):
   # Subclasses should set the name of the type of stream to use for chunks.
   STREAM_TYPE = None
 
-  # How many chunks should be cached.
+  # How many chunks to read ahead. The read ahead window doubles up to
+  # MAX_LOOK_AHEAD chunks while the stream is read sequentially. It must stay
+  # well below the size of the chunk cache so read ahead chunks are not expired
+  # before they are read.
   LOOK_AHEAD = 10
+  MAX_LOOK_AHEAD = 50
+
+  # How many chunks should be cached.
+  CHUNK_CACHE_SIZE = 100
+
+  # The chunk following the current read ahead window.
+  next_look_ahead_chunk = None
 
   class SchemaCls(AFF4Stream.SchemaCls):
     """The schema for AFF4ImageBase."""
@@ -2912,7 +3124,10 @@ class AFF4ImageBase(AFF4Stream):
     super(AFF4ImageBase, self).Initialize()
     self.offset = 0
     # A cache for segments - When we get pickled we want to discard them.
-    self.chunk_cache = ChunkCache(self._WriteChunk, 100)
+    self.chunk_cache = ChunkCache(self._WriteChunk, self.CHUNK_CACHE_SIZE)
+
+    self.look_ahead = self.LOOK_AHEAD
+    self.next_look_ahead_chunk = None
 
     if "r" in self.mode:
       self.size = int(self.Get(self.Schema.SIZE))
@@ -3005,6 +3220,44 @@ class AFF4ImageBase(AFF4Stream):
     self.chunk_cache.Put(chunk, fd)
     return fd
 
+  def _LookAheadWindow(self, chunk):
+    """Returns how many chunks to read ahead when chunk is not cached.
+
+    If chunk directly follows the previous read ahead window the stream is read
+    sequentially and the window doubles, otherwise it is reset.
+
+    Args:
+      chunk: The chunk which is not cached.
+
+    Returns:
+      The number of chunks to read, starting with chunk.
+    """
+    if chunk == self.next_look_ahead_chunk:
+      self.look_ahead = min(self.look_ahead * 2, self.MAX_LOOK_AHEAD)
+    else:
+      self.look_ahead = self.LOOK_AHEAD
+
+    self.next_look_ahead_chunk = chunk + self.look_ahead
+    return self.look_ahead
+
+  def _LastChunk(self):
+    """The number of the last chunk in this stream."""
+    return (self.size - 1) / self.chunksize
+
+  def _ChunksToReadAhead(self, chunk):
+    """Returns the chunks to read together with a chunk which is not cached."""
+    end = min(chunk + self._LookAheadWindow(chunk), self._LastChunk() + 1)
+
+    # When reading sequentially the chunks before this one were already read,
+    # so we release them first rather than have them expire in LRU order.
+    if self.look_ahead > self.LOOK_AHEAD:
+      for cached_chunk, fd in self.chunk_cache:
+        if cached_chunk < chunk and not fd.dirty:
+          self.chunk_cache.ExpireObject(cached_chunk)
+
+    return [chunk] + [chunk_number for chunk_number in xrange(chunk + 1, end)
+                      if chunk_number not in self.chunk_cache]
+
   def _GetChunkForReading(self, chunk):
     """Returns the relevant chunk from the datastore and reads ahead."""
     try:
@@ -3015,13 +3268,7 @@ class AFF4ImageBase(AFF4Stream):
     # We don't have this chunk already cached. The most common read
     # access pattern is contiguous reading so since we have to go to
     # the data store already, we read ahead to reduce round trips.
-
-    missing_chunks = []
-    for chunk_number in range(chunk, chunk + self.LOOK_AHEAD):
-      if chunk_number not in self.chunk_cache:
-        missing_chunks.append(chunk_number)
-
-    self._ReadChunks(missing_chunks)
+    self._ReadChunks(self._ChunksToReadAhead(chunk))
     # This should work now - otherwise we just give up.
     try:
       return self.chunk_cache.Get(chunk)
@@ -3134,7 +3381,7 @@ class AFF4ImageBase(AFF4Stream):
 
   def __setstate__(self, state):
     self.__dict__ = state
-    self.chunk_cache = ChunkCache(self._WriteChunk, 100)
+    self.chunk_cache = ChunkCache(self._WriteChunk, self.CHUNK_CACHE_SIZE)
 
 
 class AFF4Image(AFF4ImageBase):
@@ -15,6 +15,7 @@ from grr.lib import flow
 from grr.lib import queue_manager
 from grr.lib import rdfvalue
 from grr.lib import registry
+from grr.lib import utils
 from grr.lib.aff4_objects import standard
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import crypto as rdf_crypto
@@ -467,6 +468,24 @@ class GRRForeman(aff4.AFF4Object):
                            creates_new_object_version=False,
                            default=rdf_foreman.ForemanRules())
 
+  # How many clients to remember as already checked against the current rules.
+  CHECKED_CLIENTS_CACHE_SIZE = 100000
+
+  def Initialize(self):
+    super(GRRForeman, self).Initialize()
+    self._rules_index = None
+
+    # Maps client ids to the rules version they were checked against, this
+    # mirrors the clients' LAST_FOREMAN_TIME attribute.
+    self.checked_clients = utils.FastStore(
+        max_size=self.CHECKED_CLIENTS_CACHE_SIZE)
+
+  def _GetRulesIndex(self, rules):
+    """Returns the index of the given rules, building it if needed."""
+    if self._rules_index is None or self._rules_index[0] is not rules:
+      self._rules_index = (rules, rdf_foreman.ForemanRulesIndex(rules))
+    return self._rules_index[1]
+
   def ExpireRules(self):
     """Removes any rules with an expiration date in the past."""
     rules = self.Get(self.Schema.RULES)
@@ -562,49 +581,60 @@ class GRRForeman(aff4.AFF4Object):
     if not rules:
       return 0
 
-    client = aff4.FACTORY.Open(client_id, mode="rw", token=self.token)
+    index = self._GetRulesIndex(rules)
+
+    # Nothing to do if the client was already checked against all the rules.
+    try:
+      if self.checked_clients.Get(client_id) >= index.version:
+        return 0
+    except KeyError:
+      pass
+
+    # For efficiency we collect all the objects we want to open first and then
+    # open them all in one round trip, reading only the attributes the rules
+    # need.
+    object_urns = {str(client_id): client_id}
+    for path in index.paths:
+      aff4_object = client_id.Add(path)
+      object_urns[str(aff4_object)] = aff4_object
+
+    attributes = set(index.attributes)
+    attributes.add(VFSGRRClient.SchemaCls.LAST_FOREMAN_TIME)
+
+    objects = {}
+    for fd in aff4.FACTORY.MultiOpen(object_urns,
+                                     mode="rw",
+                                     attributes=attributes,
+                                     token=self.token):
+      objects[fd.urn] = fd
+
+    client = objects.get(client_id)
+    if client is None:
+      client = aff4.FACTORY.Open(client_id, mode="rw", token=self.token)
+
     try:
-      last_foreman_run = client.Get(client.Schema.LAST_FOREMAN_TIME) or 0
+      last_foreman_run = int(client.Get(client.Schema.LAST_FOREMAN_TIME) or 0)
     except AttributeError:
       last_foreman_run = 0
 
-    latest_rule = max(rule.created for rule in rules)
-
-    if latest_rule <= int(last_foreman_run):
+    if index.version <= last_foreman_run:
+      self.checked_clients.Put(client_id, last_foreman_run)
       return 0
 
     # Update the latest checked rule on the client.
-    client.Set(client.Schema.LAST_FOREMAN_TIME(latest_rule))
-    client.Close()
-
-    # For efficiency we collect all the objects we want to open first and then
-    # open them all in one round trip.
-    object_urns = {}
-    relevant_rules = []
-    expired_rules = False
+    # The client object is still passed to the rules, so it's not closed.
+    client.Set(client.Schema.LAST_FOREMAN_TIME(index.version))
+    client.Flush()
+    self.checked_clients.Put(client_id, index.version)
 
     now = time.time() * 1e6
+    expired_rules = any(rule.expires < now for rule in rules)
 
-    for rule in rules:
-      if rule.expires < now:
-        expired_rules = True
-        continue
-      if rule.created <= int(last_foreman_run):
+    actions_count = 0
+    for rule in index.GetCandidates(objects.get(client_id)):
+      if rule.expires < now or rule.created <= last_foreman_run:
         continue
 
-      relevant_rules.append(rule)
-
-      for path in rule.client_rule_set.GetPathsToCheck():
-        aff4_object = client_id.Add(path)
-        object_urns[str(aff4_object)] = aff4_object
-
-    # Retrieve all aff4 objects we need.
-    objects = {}
-    for fd in aff4.FACTORY.MultiOpen(object_urns, token=self.token):
-      objects[fd.urn] = fd
-
-    actions_count = 0
-    for rule in relevant_rules:
       if self._EvaluateRules(objects, rule, client_id):
         actions_count += self._RunActions(rule, client_id)
 
@@ -108,6 +108,29 @@ class AFF4Benchmark(test_lib.AverageMicroBenchmarks):
     self.TimeIt(ReadAVersionedAFF4Attribute,
                 name="Read one versioned Attributes")
 
+  def testRecursiveMultiListChildren(self):
+    """How fast can we list a deep tree of URNs."""
+    with aff4.FACTORY.Create("aff4:/C.1234567812345678/fs/os",
+                             aff4.AFF4Volume,
+                             token=self.token) as root:
+      for i in range(10):
+        for j in range(10):
+          for k in range(10):
+            aff4.FACTORY.Create(root.urn.Add("dir%d/dir%d/file%d" % (i, j, k)),
+                                aff4.AFF4MemoryStream,
+                                token=self.token).Close()
+
+    def ListTree():
+      count = 0
+      for _, children in aff4.FACTORY.RecursiveMultiListChildren(
+          ["aff4:/C.1234567812345678/fs/os"],
+          token=self.token):
+        count += len(children)
+
+      self.assertEqual(count, 1110)
+
+    self.TimeIt(ListTree, name="RecursiveMultiListChildren of 1110 URNs")
+
 
 def main(argv):
   # Run the full test suite
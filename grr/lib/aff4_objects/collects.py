@@ -15,6 +15,7 @@ from grr.lib import data_store
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib import stats
+from grr.lib import threadpool
 from grr.lib import utils
 from grr.lib.rdfvalues import anomaly as rdf_anomaly
 from grr.lib.rdfvalues import client as rdf_client
@@ -477,6 +478,101 @@ class SeekIndex(rdf_structs.RDFProtoStruct):
   protobuf = jobs_pb2.SeekIndex
 
 
+class _StreamTailWriter(object):
+  """Writes data past the end of an AFF4 image, one whole chunk at a time.
+
+  Data can be written at any offset between the current end of the stream and
+  end_offset, in any order. As soon as a chunk is complete it is written on a
+  thread pool. The stream's size is updated only when the writer is closed, so
+  until then readers don't see any of the new data.
+  """
+
+  def __init__(self, stream, end_offset, threads):
+    self.stream = stream
+    self.start_offset = stream.size
+    self.end_offset = end_offset
+    self.chunks = {}
+    self.missing = {}
+    self.errors = []
+
+    # Dirty chunks have to be written out and cached chunks would get stale.
+    stream.chunk_cache.Flush()
+
+    # The last chunk of the stream is usually incomplete, it gets rewritten
+    # together with the new data.
+    chunksize = stream.chunksize
+    chunk_offset = self.start_offset % chunksize
+    if chunk_offset:
+      stream.Seek(self.start_offset - chunk_offset)
+      self.Write(self.start_offset - chunk_offset, stream.Read(chunk_offset))
+
+    self.pool = threadpool.ThreadPool.Factory("packed_collection_compactor",
+                                              threads)
+    self.pool.Start()
+
+  def _WriteChunk(self, chunk_number, data):
+    try:
+      chunk_urn = self.stream.urn.Add(self.stream.CHUNK_ID_TEMPLATE %
+                                      chunk_number)
+      with aff4.FACTORY.Create(chunk_urn,
+                               self.stream.STREAM_TYPE,
+                               mode="w",
+                               token=self.stream.token) as fd:
+        fd.Write(data)
+    except Exception as e:  # pylint: disable=broad-except
+      self.errors.append(e)
+
+  def Write(self, offset, data):
+    """Places data at the given offset of the stream."""
+    chunksize = self.stream.chunksize
+    while data:
+      chunk_number = offset / chunksize
+      chunk_offset = offset % chunksize
+      chunk = self.chunks.get(chunk_number)
+      if chunk is None:
+        chunk_start = chunk_number * chunksize
+        length = min(chunksize, self.end_offset - chunk_start)
+        chunk = self.chunks[chunk_number] = bytearray(length)
+        self.missing[chunk_number] = length
+
+      to_write = min(len(data), len(chunk) - chunk_offset)
+      chunk[chunk_offset:chunk_offset + to_write] = data[:to_write]
+      self.missing[chunk_number] -= to_write
+
+      if not self.missing[chunk_number]:
+        del self.missing[chunk_number]
+        self.pool.AddTask(self._WriteChunk,
+                          (chunk_number, str(self.chunks.pop(chunk_number))),
+                          name="WriteChunk")
+
+      offset += to_write
+      data = data[to_write:]
+
+  def Close(self, abort=False):
+    """Waits for all chunks to be written and updates the stream's size.
+
+    Args:
+      abort: If True, the stream is left as it was.
+
+    Raises:
+      IOError: if some of the data is missing or couldn't be written.
+    """
+    self.pool.Join()
+    # Cached chunks were read before they got rewritten.
+    self.stream.chunk_cache.Flush()
+    if abort:
+      return
+
+    if self.chunks or self.errors:
+      raise IOError("Failed to write %s: %s" %
+                    (self.stream.urn, self.errors or "incomplete data"))
+
+    self.stream.size = self.end_offset
+    self.stream.offset = self.end_offset
+    self.stream.content_last = rdfvalue.RDFDatetime().Now()
+    self.stream._dirty = True  # pylint: disable=protected-access
+
+
 class PackedVersionedCollection(RDFValueCollection):
   """A collection which uses the data store's version properties.
 
@@ -604,6 +700,7 @@ class PackedVersionedCollection(RDFValueCollection):
 
   INDEX_INTERVAL = 10000
   COMPACTION_BATCH_SIZE = 10000
+  COMPACTION_THREADS = 10
   MAX_REVERSED_RESULTS = 10000
 
   @staticmethod
@@ -733,9 +830,13 @@ class PackedVersionedCollection(RDFValueCollection):
     order).
 
     Compact's implementation can handle very large collections that can't
-    be reversed in memory. It reads them in batches, reverses every batch
-    individually, and then reads batches back in the reversed order and
-    write their contents to the collection stream.
+    be reversed in memory. It reads the versioned attributes twice. The first
+    pass only measures every batch of COMPACTION_BATCH_SIZE items, which is
+    enough to know where each item goes in the stream. The second pass places
+    items directly at their final positions and writes every completed
+    stream chunk on a thread pool. Chunks are written past the end of the
+    stream, so readers don't see them until the new stream size is flushed,
+    right before the versioned attributes are deleted.
 
     Args:
       callback: An optional function without arguments that gets called
@@ -744,8 +845,8 @@ class PackedVersionedCollection(RDFValueCollection):
       timestamp: Only items added before this timestamp will be compacted.
 
     Raises:
-      RuntimeError: if problems are encountered when reading back temporary
-                    saved data.
+      RuntimeError: if versioned attributes change between the two passes.
+      IOError: if writing stream chunks fails.
 
     Returns:
       Number of compacted results.
@@ -753,47 +854,15 @@ class PackedVersionedCollection(RDFValueCollection):
     if not self.locked:
       raise aff4.LockError("Collection must be locked before compaction.")
 
-    compacted_count = 0
-
-    batches_urns = []
-    current_batch = []
-
     # This timestamp will be used to delete attributes. We don't want
     # to delete anything that was added after we started the compaction.
     freeze_timestamp = timestamp or rdfvalue.RDFDatetime().Now()
 
-    def UpdateIndex():
-      seek_index = self.Get(self.Schema.SEEK_INDEX, SeekIndex())
-
-      prev_index_pair = seek_index.checkpoints and seek_index.checkpoints[-1]
-      if (not prev_index_pair or
-          self.size - prev_index_pair.index_offset >= self.INDEX_INTERVAL):
-        new_index_pair = SeekIndexPair(index_offset=self.size,
-                                       byte_offset=self.fd.Tell())
-        seek_index.checkpoints.Append(new_index_pair)
-        self.Set(self.Schema.SEEK_INDEX, seek_index)
-
-    def DeleteVersionedDataAndFlush():
-      """Removes versioned attributes and flushes the stream."""
-      data_store.DB.DeleteAttributes(self.urn, [self.Schema.DATA.predicate],
-                                     end=freeze_timestamp,
-                                     token=self.token,
-                                     sync=True)
-      if self.IsJournalingEnabled():
-        journal_entry = self.Schema.COMPACTION_JOURNAL(compacted_count,
-                                                       age=freeze_timestamp)
-        attrs_to_set = {self.Schema.COMPACTION_JOURNAL: [journal_entry]}
-        aff4.FACTORY.SetAttributes(self.urn,
-                                   attrs_to_set,
-                                   set(),
-                                   add_child_index=False,
-                                   sync=True,
-                                   token=self.token)
-
-      if self.Schema.DATA in self.synced_attributes:
-        del self.synced_attributes[self.Schema.DATA]
-
-      self.Flush(sync=True)
+    def VersionedData():
+      return data_store.DB.ResolvePrefix(self.urn,
+                                         self.Schema.DATA.predicate,
+                                         token=self.token,
+                                         timestamp=(0, freeze_timestamp))
 
     def HeartBeat():
       """Update the lock lease if needed and call the callback."""
@@ -808,92 +877,102 @@ class PackedVersionedCollection(RDFValueCollection):
 
     HeartBeat()
 
-    # We iterate over all versioned attributes. If we get more than
-    # self.COMPACTION_BATCH_SIZE, we write the data to temporary
-    # stream in the reversed order.
-    for _, value, _ in data_store.DB.ResolvePrefix(
-        self.urn,
-        self.Schema.DATA.predicate,
-        token=self.token,
-        timestamp=(0, freeze_timestamp)):
-
+    # First pass: [number of items, bytes in the stream] for every batch,
+    # newest batch first.
+    batches = []
+    for _, value, _ in VersionedData():
       HeartBeat()
 
-      current_batch.append(value)
-      compacted_count += 1
-
-      if len(current_batch) >= self.COMPACTION_BATCH_SIZE:
-        batch_urn = rdfvalue.RDFURN("aff4:/tmp").Add("%X" %
-                                                     utils.PRNG.GetULong())
-        batches_urns.append(batch_urn)
-
-        buf = cStringIO.StringIO()
-        for data in reversed(current_batch):
-          buf.write(struct.pack("<i", len(data)))
-          buf.write(data)
-
-        # We use AFF4Image to avoid serializing/deserializing data stored
-        # in versioned attributes.
-        with aff4.FACTORY.Create(batch_urn,
-                                 aff4.AFF4Image,
-                                 mode="w",
-                                 token=self.token) as batch_stream:
-          batch_stream.Write(buf.getvalue())
-
-        current_batch = []
+      if not batches or batches[-1][0] >= self.COMPACTION_BATCH_SIZE:
+        batches.append([0, 0])
+      batches[-1][0] += 1
+      batches[-1][1] += 4 + len(value)
 
     # If there are no versioned attributes, we have nothing to do.
-    if not current_batch and not batches_urns:
+    if not batches:
       return 0
 
-    # The last batch of results can be written to our collection's stream
-    # immediately, because we have to reverse the order of all the data
-    # stored in versioned attributes.
-    if current_batch:
-      buf = cStringIO.StringIO()
-      for data in reversed(current_batch):
-        buf.write(struct.pack("<i", len(data)))
-        buf.write(data)
-
-      self.fd.Seek(0, 2)
-      self.fd.Write(buf.getvalue())
-      self.stream_dirty = True
-      self.size += len(current_batch)
-      UpdateIndex()
-
-      # If current_batch was the only available batch, just write everything
-      # and return.
-      if not batches_urns:
-        DeleteVersionedDataAndFlush()
-        return compacted_count
-
-    batches = {}
-    for batch in aff4.FACTORY.MultiOpen(batches_urns,
-                                        aff4_type=aff4.AFF4Image,
-                                        token=self.token):
-      batches[batch.urn] = batch
-
-    if len(batches_urns) != len(batches):
-      raise RuntimeError("Internal inconsistency can't read back all the "
-                         "temporary batches.")
-
-    # We read all the temporary batches in reverse order (batches itself
-    # were reversed when they were written).
-    self.fd.Seek(0, 2)
-    for batch_urn in reversed(batches_urns):
-      batch = batches[batch_urn]
-
+    compacted_count = sum(count for count, _ in batches)
+
+    # Batches are written to the stream oldest first, so the newest batch ends
+    # up at the very end of the stream.
+    end_offsets = []
+    end_offset = self.fd.size + sum(size for _, size in batches)
+    for _, size in batches:
+      end_offsets.append(end_offset)
+      end_offset -= size
+
+    seek_index = self.Get(self.Schema.SEEK_INDEX, SeekIndex())
+    num_checkpoints = len(seek_index.checkpoints)
+    index_offset = self.size
+    for (count, _), end_offset in reversed(zip(batches, end_offsets)):
+      index_offset += count
+      prev_index_pair = seek_index.checkpoints and seek_index.checkpoints[-1]
+      if (not prev_index_pair or
+          index_offset - prev_index_pair.index_offset >= self.INDEX_INTERVAL):
+        seek_index.checkpoints.Append(SeekIndexPair(index_offset=index_offset,
+                                                    byte_offset=end_offset))
+
+    # Second pass: every batch is filled backwards from its end.
+    writer = _StreamTailWriter(self.fd, end_offsets[0], self.COMPACTION_THREADS)
+    batch_number = 0
+    remaining = batches[0][0]
+    offset = end_offsets[0]
+    consistent = True
+    for _, value, _ in VersionedData():
       HeartBeat()
 
-      data = batch.Read(len(batch))
-      self.fd.Write(data)
-      self.stream_dirty = True
-      self.size += self.COMPACTION_BATCH_SIZE
-      UpdateIndex()
+      if not remaining:
+        batch_number += 1
+        if (batch_number == len(batches) or
+            offset != end_offsets[batch_number - 1] - batches[batch_number -
+                                                              1][1]):
+          consistent = False
+          break
+        remaining = batches[batch_number][0]
+        offset = end_offsets[batch_number]
+
+      offset -= 4 + len(value)
+      if offset < end_offsets[batch_number] - batches[batch_number][1]:
+        consistent = False
+        break
+
+      writer.Write(offset, struct.pack("<i", len(value)) + value)
+      remaining -= 1
 
-      aff4.FACTORY.Delete(batch_urn, token=self.token)
+    if (not consistent or remaining or batch_number != len(batches) - 1 or
+        offset != end_offsets[-1] - batches[-1][1]):
+      writer.Close(abort=True)
+      raise RuntimeError("Internal inconsistency: versioned attributes "
+                         "changed during compaction.")
 
-    DeleteVersionedDataAndFlush()
+    writer.Close()
+
+    self.size += compacted_count
+    self.stream_dirty = True
+    if len(seek_index.checkpoints) != num_checkpoints:
+      self.Set(self.Schema.SEEK_INDEX, seek_index)
+    # The new stream size has to be stored before the versioned attributes
+    # are gone, otherwise the compacted items would briefly disappear.
+    self.Flush(sync=True)
+
+    data_store.DB.DeleteAttributes(self.urn, [self.Schema.DATA.predicate],
+                                   end=freeze_timestamp,
+                                   token=self.token,
+                                   sync=True)
+    if self.IsJournalingEnabled():
+      journal_entry = self.Schema.COMPACTION_JOURNAL(compacted_count,
+                                                     age=freeze_timestamp)
+      attrs_to_set = {self.Schema.COMPACTION_JOURNAL: [journal_entry]}
+      aff4.FACTORY.SetAttributes(self.urn,
+                                 attrs_to_set,
+                                 set(),
+                                 add_child_index=False,
+                                 sync=True,
+                                 token=self.token)
+
+    if self.Schema.DATA in self.synced_attributes:
+      del self.synced_attributes[self.Schema.DATA]
 
     # Update system-wide stats.
     stats.STATS.IncrementCounter("packed_collection_compacted",
@@ -742,6 +742,32 @@ class TestPackedVersionedCollection(test_lib.AFF4ObjectTest):
     self._testCompactsCollectionSuccessfully(
         collects.PackedVersionedCollection.COMPACTION_BATCH_SIZE * 5 - 1)
 
+  def testCompactsIntoManySmallChunks(self):
+    with aff4.FACTORY.Create(self.collection_urn.Add("UnversionedStream"),
+                             aff4.AFF4UnversionedImage,
+                             mode="w",
+                             token=self.token) as fd:
+      fd.SetChunksize(100)
+
+    # Every compaction has to append to the partially filled last chunk.
+    for start in range(0, 300, 75):
+      with aff4.FACTORY.Create(self.collection_urn,
+                               collects.PackedVersionedCollection,
+                               mode="w",
+                               token=self.token) as fd:
+        fd.AddAll([rdf_flows.GrrMessage(request_id=i)
+                   for i in range(start, start + 75)])
+
+      with aff4.FACTORY.OpenWithLock(self.collection_urn,
+                                     collects.PackedVersionedCollection,
+                                     token=self.token) as fd:
+        self.assertEqual(fd.Compact(), 75)
+
+      fd = aff4.FACTORY.Open(self.collection_urn, token=self.token)
+      self.assertGreater(fd.fd.size / 100, 1)
+      self.assertEqual([item.request_id for item in fd],
+                       range(start + 75))
+
   def testSecondCompactionDoesNothing(self):
     with aff4.FACTORY.Create(self.collection_urn,
                              collects.PackedVersionedCollection,
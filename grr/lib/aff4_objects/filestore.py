@@ -5,7 +5,14 @@ Filestore allows for multiple different filestore modules to register URNs
 under aff4:/files to handle new file hash and new file creations.
 """
 
+import atexit
+import collections
+import functools
 import hashlib
+import Queue
+import struct
+import threading
+import time
 
 import logging
 
@@ -15,6 +22,7 @@ from grr.lib import aff4
 from grr.lib import data_store
 from grr.lib import rdfvalue
 from grr.lib import registry
+from grr.lib import utils
 from grr.lib.aff4_objects import aff4_grr
 from grr.lib.aff4_objects import standard as aff4_standard
 from grr.lib.rdfvalues import nsrl as rdf_nsrl
@@ -160,15 +168,18 @@ class FileStoreImage(aff4_grr.VFSBlobImage):
                             "List of hashes of each chunk in this file.",
                             versioned=False)
 
-  def AddIndex(self, target):
+  def AddIndex(self, target, mutation_pool=None):
     """Adds an indexed reference to the target URN."""
     if "w" not in self.mode:
       raise IOError("FileStoreImage %s is not in write mode.", self.urn)
     predicate = ("index:target:%s" % target).lower()
-    data_store.DB.MultiSet(self.urn, {predicate: target},
-                           token=self.token,
-                           replace=True,
-                           sync=False)
+    if mutation_pool:
+      mutation_pool.MultiSet(self.urn, {predicate: target}, replace=True)
+    else:
+      data_store.DB.MultiSet(self.urn, {predicate: target},
+                             token=self.token,
+                             replace=True,
+                             sync=False)
 
   def Query(self, target_prefix="", limit=100):
     """Search the index for matches starting with target_prefix.
@@ -240,6 +251,404 @@ class FileStoreHash(rdfvalue.RDFURN):
     self.fingerprint_type, self.hash_type, self.hash_value = relative_path
 
 
+class HashFilter(object):
+  """A Bloom filter of the hashes in a hash file store.
+
+  CheckHashes() only looks up hashes the filter might contain, so most hashes
+  which are not in the file store are answered without going to the data store.
+
+  The filter is kept in index attributes of the file store, split in segments,
+  so all processes share it. Hashes added by this process are merged into the
+  stored segments in batches by a background thread, with a bitwise or inside
+  a transaction, so concurrent merges don't lose bits.
+
+  Every added hash is also written right away to a journal of recent hashes
+  next to the segments, and every process reads the journal entries written
+  since its last check every RECENT_REFRESH_INTERVAL seconds. A hash added by
+  any process is therefore missing from the filter for a few seconds at most,
+  even if the process dies before merging it. Journal entries are deleted
+  RECENT_RETENTION seconds after their hash was merged, and by
+  HashFilterCronFlow once it rebuilt the filter from the file store.
+
+  Bulk imports add hashes without journaling them, so they don't fill the
+  journal every process reads. Such hashes are only seen by other processes
+  once they were merged and the stored filter was reloaded.
+  """
+
+  SEGMENT_SIZE = 1024 * 1024
+  SEGMENT_ATTRIBUTE_PREFIX = "index:hash_filter/"
+  SEGMENT_ATTRIBUTE_PATTERN = "index:hash_filter/%04d"
+  RECENT_ATTRIBUTE_PREFIX = "index:hash_filter_recent/"
+  RECENT_ATTRIBUTE_PATTERN = "index:hash_filter_recent/%s"
+  COMPLETE_ATTRIBUTE = "index:hash_filter_complete"
+
+  # The bits set for a hash are taken from the first 20 bytes of the digest.
+  HASH_FORMAT = struct.Struct("<5I")
+
+  # Local changes are merged into the stored filter after this many hashes or
+  # this many seconds, whichever comes first.
+  FLUSH_SIZE = 10000
+  FLUSH_INTERVAL = 60
+
+  # How often the journal of recent hashes is read, in seconds. Reads go back
+  # RECENT_OVERLAP seconds more, so entries that were written late are seen.
+  RECENT_REFRESH_INTERVAL = 5
+  RECENT_OVERLAP = 120
+
+  # How long journal entries are kept once their hash was merged, in seconds.
+  # This must be well above REFRESH_INTERVAL.
+  RECENT_RETENTION = 3600
+
+  # How often the stored filter is reloaded, in seconds.
+  REFRESH_INTERVAL = 600
+
+  def __init__(self, urn, num_segments):
+    self.urn = urn
+    self.num_segments = num_segments
+    self.num_bits = num_segments * self.SEGMENT_SIZE * 8
+    self.lock = threading.RLock()
+    self.db = data_store.DB
+    self.token = aff4.FACTORY.root_token
+
+    # The bits of the filter, None while the filter is not complete.
+    self.bits = None
+    self.loaded = 0
+    self.recent_loaded = 0
+
+    # Hashes added by this process which are not merged yet, mapped to whether
+    # they were journaled.
+    self.unmerged = {}
+    # Merged hashes with the time they were merged, oldest first.
+    self.merged = collections.deque()
+
+    self._flush_lock = threading.Lock()
+    self._flush_requested = threading.Event()
+    self._flusher = None
+    self._stopped = False
+    self._closed = False
+
+  def _Positions(self, hash_value):
+    digest = hash_value.decode("hex")
+    return [position % self.num_bits
+            for position in self.HASH_FORMAT.unpack_from(digest)]
+
+  def _SetBits(self, bits, hash_value):
+    for position in self._Positions(hash_value):
+      bits[position / 8] |= 1 << position % 8
+
+  def _ReadRecent(self, timestamp=None):
+    """Returns the journaled hashes written within timestamp."""
+    return [attribute[len(self.RECENT_ATTRIBUTE_PREFIX):]
+            for attribute, _, _ in data_store.DB.ResolvePrefix(
+                self.urn,
+                self.RECENT_ATTRIBUTE_PREFIX,
+                timestamp=timestamp,
+                token=self.token)]
+
+  def _SetRecentBits(self, bits, hash_values):
+    for hash_value in hash_values:
+      try:
+        self._SetBits(bits, hash_value)
+      except (TypeError, struct.error):
+        logging.warning("Not a valid hash in %s: %s", self.urn, hash_value)
+
+  @utils.Synchronized
+  def Refresh(self):
+    """Loads the stored filter, or the recent hashes, if not done recently."""
+    now = time.time()
+    if now - self.loaded < self.REFRESH_INTERVAL:
+      if (self.bits is not None and
+          now - self.recent_loaded >= self.RECENT_REFRESH_INTERVAL):
+        start = max(0, self.recent_loaded - self.RECENT_OVERLAP)
+        self._SetRecentBits(self.bits, self._ReadRecent(
+            timestamp=(int(start * 1e6), int(now * 1e6))))
+        self.recent_loaded = now
+      return
+
+    self.loaded = self.recent_loaded = now
+    complete, _ = data_store.DB.Resolve(self.urn,
+                                        self.COMPLETE_ATTRIBUTE,
+                                        token=self.token)
+    if not complete:
+      self.bits = None
+      return
+
+    # The journal is read before the segments: entries deleted in between
+    # were merged before they were deleted.
+    recent = self._ReadRecent()
+
+    bits = bytearray(self.num_segments * self.SEGMENT_SIZE)
+    for attribute, value, _ in data_store.DB.ResolvePrefix(
+        self.urn, self.SEGMENT_ATTRIBUTE_PREFIX, token=self.token):
+      segment = int(attribute[len(self.SEGMENT_ATTRIBUTE_PREFIX):])
+      if segment < self.num_segments:
+        start = segment * self.SEGMENT_SIZE
+        bits[start:start + len(value)] = value
+
+    self._SetRecentBits(bits, recent)
+    self._SetRecentBits(bits, self.unmerged)
+
+    self.bits = bits
+
+  @utils.Synchronized
+  def MightContain(self, hash_value):
+    """Returns False if the hash is definitely not in the file store."""
+    if self.bits is None:
+      return True
+
+    for position in self._Positions(hash_value):
+      if not self.bits[position / 8] & (1 << position % 8):
+        return False
+
+    return True
+
+  def Add(self, hash_value, mutation_pool=None, journal=True):
+    """Adds a hash to the filter.
+
+    The hash is journaled right away and merged into the stored filter later.
+
+    Args:
+      hash_value: The hex digest to add.
+      mutation_pool: If set, the journal entry is written through this pool.
+      journal: If False, the hash is only merged into the stored filter. This
+        is meant for bulk imports.
+    """
+    if journal:
+      attribute = self.RECENT_ATTRIBUTE_PATTERN % hash_value
+      if mutation_pool:
+        mutation_pool.Set(self.urn, attribute, hash_value)
+      else:
+        data_store.DB.Set(self.urn,
+                          attribute,
+                          hash_value,
+                          sync=False,
+                          token=self.token)
+
+    with self.lock:
+      if self.bits is not None:
+        self._SetBits(self.bits, hash_value)
+
+      self.unmerged[hash_value] = journal or self.unmerged.get(hash_value,
+                                                               False)
+      if len(self.unmerged) >= self.FLUSH_SIZE:
+        self._flush_requested.set()
+
+      if self._flusher is None and not self._stopped:
+        self._flusher = threading.Thread(target=self._RunFlusher,
+                                         name="HashFilterFlusher")
+        self._flusher.daemon = True
+        self._flusher.start()
+        atexit.register(self.Close)
+
+  def _RunFlusher(self):
+    while not self._stopped:
+      self._flush_requested.wait(self.FLUSH_INTERVAL)
+      self._flush_requested.clear()
+      if self._stopped:
+        break
+
+      try:
+        self.Flush()
+      except Exception:  # pylint: disable=broad-except
+        logging.exception("Error merging hashes into the filter of %s",
+                          self.urn)
+
+  def Flush(self):
+    """Merges the hashes added so far into the stored filter."""
+    with self._flush_lock:
+      with self.lock:
+        hash_values = dict(self.unmerged)
+
+      segment_bits = self.SEGMENT_SIZE * 8
+      positions_by_segment = {}
+      for hash_value in hash_values:
+        for position in self._Positions(hash_value):
+          positions_by_segment.setdefault(position / segment_bits, set()).add(
+              position % segment_bits)
+
+      # The filter lock is not held here, so lookups don't wait for merges.
+      for segment, positions in positions_by_segment.iteritems():
+        data_store.DB.RetryWrapper(self.urn,
+                                   self._MergeSegment,
+                                   segment=segment,
+                                   positions=positions,
+                                   token=self.token)
+
+      now = time.time()
+      with self.lock:
+        for hash_value, journaled in hash_values.iteritems():
+          # A hash journaled in the meantime is merged again by the next run,
+          # so its journal entry gets deleted.
+          if self.unmerged.get(hash_value) == journaled:
+            del self.unmerged[hash_value]
+          if journaled:
+            self.merged.append((hash_value, now))
+
+      self._DeleteMergedEntries(now)
+
+  def _DeleteMergedEntries(self, now):
+    """Deletes the journal entries of hashes merged long enough ago."""
+    cutoff = now - self.RECENT_RETENTION
+    attributes = []
+    while self.merged and self.merged[0][1] < cutoff:
+      hash_value, _ = self.merged.popleft()
+      attributes.append(self.RECENT_ATTRIBUTE_PATTERN % hash_value)
+
+    if attributes:
+      # Entries written since the cutoff stay, their hash might not be merged.
+      data_store.DB.DeleteAttributes(self.urn,
+                                     attributes,
+                                     end=int(cutoff * 1e6),
+                                     sync=False,
+                                     token=self.token)
+
+  def Stop(self):
+    """Stops the background merges."""
+    self._stopped = True
+    self._flush_requested.set()
+    if self._flusher is not None:
+      self._flusher.join()
+
+  def Close(self):
+    """Stops the background merges and merges what is left."""
+    if self._closed:
+      return
+    self._closed = True
+    self.Stop()
+    self.Flush()
+
+  def _MergeSegment(self, transaction, segment=None, positions=None,
+                    bits=None):
+    """Sets positions, or ors bits, into a stored segment."""
+    attribute = self.SEGMENT_ATTRIBUTE_PATTERN % segment
+    value, _ = transaction.Resolve(attribute)
+    value = value or "\x00" * self.SEGMENT_SIZE
+
+    if bits is not None:
+      value = ("%0*x" % (self.SEGMENT_SIZE * 2,
+                         long(value.encode("hex"), 16) |
+                         long(str(bits).encode("hex"), 16))).decode("hex")
+    else:
+      data = bytearray(value)
+      for position in positions:
+        data[position / 8] |= 1 << position % 8
+      value = str(data)
+
+    transaction.Set(attribute, value)
+
+  @classmethod
+  def Build(cls, urn, num_segments, hash_values):
+    """Builds the filter from all the hashes in a file store and stores it."""
+    hash_filter = cls(urn, num_segments)
+    start_time = int(time.time() * 1e6)
+    bits = bytearray(num_segments * cls.SEGMENT_SIZE)
+    for hash_value in hash_values:
+      try:
+        hash_filter._SetBits(bits, hash_value)
+      except (TypeError, struct.error):
+        logging.warning("Not a valid hash in %s: %s", urn, hash_value)
+
+    # Merging rather than overwriting keeps hashes added in the meantime.
+    for segment in range(num_segments):
+      start = segment * cls.SEGMENT_SIZE
+      data_store.DB.RetryWrapper(urn,
+                                 hash_filter._MergeSegment,
+                                 segment=segment,
+                                 bits=bits[start:start + cls.SEGMENT_SIZE],
+                                 token=hash_filter.token)
+
+    data_store.DB.Set(urn,
+                      cls.COMPLETE_ATTRIBUTE,
+                      str(rdfvalue.RDFDatetime().Now()),
+                      token=hash_filter.token)
+
+    # Files of the journal entries written before the build started were in
+    # the store already, so the filter covers them now.
+    stale = [attribute for attribute, _, _ in data_store.DB.ResolvePrefix(
+        urn,
+        cls.RECENT_ATTRIBUTE_PREFIX,
+        timestamp=(0, start_time),
+        token=hash_filter.token)]
+    if stale:
+      data_store.DB.DeleteAttributes(urn,
+                                     stale,
+                                     end=start_time,
+                                     token=hash_filter.token)
+
+
+class ThreadedHasher(object):
+  """A hashlib hasher updated on a thread of its own.
+
+  hashlib releases the GIL while hashing large blocks, so the hashers fed by a
+  Fingerprinter all hash each block in parallel rather than one after the other.
+  """
+
+  # The number of blocks queued for the hasher at most. This bounds the memory
+  # used when the hasher is slower than the reads.
+  MAX_QUEUED_BLOCKS = 4
+
+  def __init__(self, hash_cls):
+    self.hasher = hash_cls()
+    self.name = self.hasher.name
+    self.queue = Queue.Queue(maxsize=self.MAX_QUEUED_BLOCKS)
+    self.thread = threading.Thread(target=self._Run, name="ThreadedHasher")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _Run(self):
+    while True:
+      block = self.queue.get()
+      if block is None:
+        return
+
+      self.hasher.update(block)
+
+  def update(self, block):  # pylint: disable=invalid-name
+    self.queue.put(block)
+
+  def Stop(self):
+    """Waits until all queued blocks are hashed and stops the thread."""
+    if self.thread.is_alive():
+      self.queue.put(None)
+      self.thread.join()
+
+  def digest(self):  # pylint: disable=invalid-name
+    self.Stop()
+    return self.hasher.digest()
+
+
+class ThreadedHashers(object):
+  """A context creating ThreadedHashers, which are stopped on exit.
+
+  Starting the threads costs more than hashing small files, so hash classes
+  are only wrapped if enabled is set.
+  """
+
+  def __init__(self, enabled=True):
+    self.enabled = enabled
+    self.hashers = []
+
+  def Wrap(self, hash_classes):
+    """Returns hasher factories creating ThreadedHashers for hash_classes."""
+    if not self.enabled:
+      return hash_classes
+
+    return [functools.partial(self._Create, hash_cls)
+            for hash_cls in hash_classes]
+
+  def _Create(self, hash_cls):
+    hasher = ThreadedHasher(hash_cls)
+    self.hashers.append(hasher)
+    return hasher
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    for hasher in self.hashers:
+      hasher.Stop()
+
+
 class HashFileStore(FileStore):
   """FileStore that stores files referenced by hash."""
 
@@ -250,6 +659,47 @@ class HashFileStore(FileStore):
                 "pecoff": ["md5", "sha1"]}
   FILE_HASH_TYPE = FileStoreHash
 
+  # Files of at least this size are hashed with ThreadedHashers.
+  THREADED_HASHING_MIN_SIZE = fingerprint.Fingerprinter.BLOCK_SIZE
+
+  # The hash type the hash filter is keyed on, and its size in segments of
+  # HashFilter.SEGMENT_SIZE bytes.
+  FILTER_HASH_TYPE = "sha256"
+  FILTER_SEGMENTS = 16
+
+  # The HashFilter for each store, shared by all objects in this process.
+  hash_filters = {}
+  hash_filters_lock = threading.Lock()
+
+  @classmethod
+  def GetHashFilter(cls):
+    """Returns the hash filter for this store, loading it if needed."""
+    with cls.hash_filters_lock:
+      hash_filter = cls.hash_filters.get(cls.PATH)
+      if hash_filter is None or hash_filter.db is not data_store.DB:
+        if hash_filter is not None:
+          hash_filter.Stop()
+        hash_filter = HashFilter(cls.PATH, cls.FILTER_SEGMENTS)
+        cls.hash_filters[cls.PATH] = hash_filter
+
+    hash_filter.Refresh()
+    return hash_filter
+
+  @classmethod
+  def ListFilterHashes(cls, token=None):
+    """Yields the hex digests of all the hashes the hash filter covers."""
+    for subject, _, _ in data_store.DB.ScanAttribute(
+        cls.PATH.Add("generic").Add(cls.FILTER_HASH_TYPE),
+        aff4.AFF4Object.SchemaCls.TYPE.predicate,
+        token=token):
+      yield rdfvalue.RDFURN(subject).Basename()
+
+  @classmethod
+  def BuildHashFilter(cls, token=None):
+    """Builds the hash filter from the contents of the store."""
+    HashFilter.Build(cls.PATH, cls.FILTER_SEGMENTS,
+                     cls.ListFilterHashes(token=token))
+
   def CheckHashes(self, hashes):
     """Check hashes against the filestore.
 
@@ -262,9 +712,13 @@ class HashFileStore(FileStore):
     Yields:
       Tuples of (RDFURN, hash object) that exist in the store.
     """
+    hash_filter = self.GetHashFilter()
     hash_map = {}
     for hsh in hashes:
       if hsh.HasField("sha256"):
+        if not hash_filter.MightContain(str(hsh.sha256)):
+          continue
+
         # The canonical name of the file is where we store the file hash.
         hash_map[aff4.ROOT_URN.Add("files/hash/generic/sha256").Add(str(
             hsh.sha256))] = hsh
@@ -293,19 +747,25 @@ class HashFileStore(FileStore):
       if found_all:
         return hashes
 
+    # The file is read once, in blocks of Fingerprinter.BLOCK_SIZE, and every
+    # block is hashed by all the hashers in parallel.
     fingerprinter = fingerprint.Fingerprinter(fd)
-    if "generic" in self.HASH_TYPES:
-      hashers = self._GetHashers(self.HASH_TYPES["generic"])
-      fingerprinter.EvalGeneric(hashers=hashers)
-    if "pecoff" in self.HASH_TYPES:
-      hashers = self._GetHashers(self.HASH_TYPES["pecoff"])
-      if hashers:
-        fingerprinter.EvalPecoff(hashers=hashers)
+    threaded = fingerprinter.filelength >= self.THREADED_HASHING_MIN_SIZE
+    with ThreadedHashers(enabled=threaded) as threaded_hashers:
+      if "generic" in self.HASH_TYPES:
+        hashers = self._GetHashers(self.HASH_TYPES["generic"])
+        fingerprinter.EvalGeneric(hashers=threaded_hashers.Wrap(hashers))
+      if "pecoff" in self.HASH_TYPES:
+        hashers = self._GetHashers(self.HASH_TYPES["pecoff"])
+        if hashers:
+          fingerprinter.EvalPecoff(hashers=threaded_hashers.Wrap(hashers))
+
+      results = fingerprinter.HashIt()
 
     if not hashes:
       hashes = fd.Schema.HASH()
 
-    for result in fingerprinter.HashIt():
+    for result in results:
       fingerprint_type = result["name"]
       for hash_type in self.HASH_TYPES[fingerprint_type]:
         if hash_type not in result:
@@ -369,6 +829,10 @@ class HashFileStore(FileStore):
 
     hashes = self._HashFile(fd)
 
+    # The files and their index entries are written together once all the
+    # files are created.
+    mutation_pool = data_store.DB.GetMutationPool(token=self.token)
+
     # The empty file is very common, we don't keep the back references for it
     # in the DB since it just takes up too much space.
     empty_hash = ("e3b0c44298fc1c149afbf4c8996fb924"
@@ -396,9 +860,10 @@ class HashFileStore(FileStore):
       file_store_fd = aff4.FACTORY.Create(file_store_urn,
                                           FileStoreImage,
                                           mode="w",
-                                          token=self.token)
+                                          token=self.token,
+                                          mutation_pool=mutation_pool)
       file_store_fd.FromBlobImage(fd)
-      file_store_fd.AddIndex(fd.urn)
+      file_store_fd.AddIndex(fd.urn, mutation_pool=mutation_pool)
 
       file_store_files.append(file_store_fd)
 
@@ -407,6 +872,15 @@ class HashFileStore(FileStore):
       file_store_fd.Set(hashes)
       file_store_fd.Close(sync=sync)
 
+    # The hash is journaled along with the files, merging it into the stored
+    # filter happens in the background.
+    if file_store_files:
+      self.GetHashFilter().Add(str(hashes.sha256), mutation_pool=mutation_pool)
+
+    mutation_pool.Flush()
+    if sync:
+      data_store.DB.Flush()
+
     # We do not want to be externally written here.
     return None
 
@@ -603,6 +1077,9 @@ class NSRLFileStore(HashFileStore):
   EXTERNAL = False
   FILE_HASH_TYPE = NSRLFileStoreHash
 
+  FILTER_HASH_TYPE = "sha1"
+  FILTER_SEGMENTS = 32
+
   FILE_TYPES = {"M": rdf_nsrl.NSRLInformation.FileType.MALICIOUS_FILE,
                 "S": rdf_nsrl.NSRLInformation.FileType.SPECIAL_FILE,
                 "": rdf_nsrl.NSRLInformation.FileType.NORMAL_FILE}
@@ -614,6 +1091,13 @@ class NSRLFileStore(HashFileStore):
   def ListHashes(token=None, age=aff4.NEWEST_TIME):
     return
 
+  @classmethod
+  def ListFilterHashes(cls, token=None):
+    for subject, _, _ in data_store.DB.ScanAttribute(
+        cls.PATH, aff4.AFF4Object.SchemaCls.TYPE.predicate,
+        token=token):
+      yield rdfvalue.RDFURN(subject).Basename()
+
   def CheckHashes(self, hashes, unused_external=True):
     """Checks a list of hashes for presence in the store.
 
@@ -627,9 +1111,13 @@ class NSRLFileStore(HashFileStore):
     Yields:
       Tuples of (RDFURN, hash object) that exist in the store.
     """
+    hash_filter = self.GetHashFilter()
     hash_map = {}
     for hsh in hashes:
       if hsh.HasField("sha1"):
+        if not hash_filter.MightContain(str(hsh.sha1)):
+          continue
+
         hash_urn = self.PATH.Add(str(hsh.sha1))
         logging.info("Checking URN %s", str(hash_urn))
         hash_map[hash_urn] = hsh
@@ -645,6 +1133,9 @@ class NSRLFileStore(HashFileStore):
       aff4:/files/nsrl/<sha1>
     with all the other arguments as attributes.
 
+    Hashes are bulk imported, so they are merged straight into the hash filter
+    without being journaled.
+
     Args:
       sha1: SHA1 digest as a hex encoded string.
       md5: MD5 digest as a hex encoded string.
@@ -672,6 +1163,8 @@ class NSRLFileStore(HashFileStore):
                             op_system_code=op_system_code_list,
                             file_type=special_code))
 
+    self.GetHashFilter().Add(sha1, journal=False)
+
   def FindFile(self, fd):
     """Hash an AFF4Stream and find the RDFURN with the same hash.
 
@@ -6,10 +6,13 @@ import os
 import StringIO
 import time
 
+import mock
+
 from grr.lib import action_mocks
 from grr.lib import aff4
 from grr.lib import config_lib
 from grr.lib import data_store
+from grr.lib import fingerprint
 from grr.lib import flags
 from grr.lib import flow
 from grr.lib import rdfvalue
@@ -20,6 +23,7 @@ from grr.lib.aff4_objects import filestore
 # Needed for GetFile pylint: disable=unused-import
 from grr.lib.flows.general import transfer
 # pylint: enable=unused-import
+from grr.lib.rdfvalues import crypto as rdf_crypto
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import paths as rdf_paths
 
@@ -389,6 +393,101 @@ class HashFileStoreTest(test_lib.AFF4ObjectTest):
                             token=self.token)
     self.assertEqual(len(self._GetBackRefs(filename)), 0)
 
+  def testCheckHashesUsesHashFilter(self):
+    self.addCleanup(filestore.HashFileStore.hash_filters.clear)
+    sha256 = ("0e8dc93e150021bb4752029ebbff51394aa36f06"
+              "9cf19901578e4f06017acdb5")
+    missing = hashlib.sha256("missing").hexdigest()
+    hashes = [rdf_crypto.Hash(sha256=sha256.decode("hex")),
+              rdf_crypto.Hash(sha256=missing.decode("hex"))]
+
+    with utils.Stubber(filestore.HashFileStore, "FILTER_SEGMENTS", 1):
+      store = aff4.FACTORY.Open(filestore.HashFileStore.PATH, token=self.token)
+
+      # The filter is not used before it was built.
+      self.assertTrue(store.GetHashFilter().MightContain(missing))
+
+      filestore.HashFileStore.BuildHashFilter(token=self.token)
+      store.GetHashFilter().loaded = 0
+
+      # Files added once the filter was built are added to the filter.
+      self.AddFile("/Ext2IFS_1_10b.exe")
+
+      with mock.patch.object(aff4.FACTORY, "Stat",
+                             wraps=aff4.FACTORY.Stat) as stat:
+        found = list(store.CheckHashes(hashes))
+
+    self.assertEqual([hash_obj for _, hash_obj in found], hashes[:1])
+
+    # Only the hash which might be in the store was looked up.
+    self.assertEqual(stat.call_args[0][0], [
+        filestore.HashFileStore.PATH.Add("generic/sha256").Add(sha256)
+    ])
+
+  def testHashFiltersAreMerged(self):
+    urn = filestore.HashFileStore.PATH
+    hash_values = [hashlib.sha256(str(i)).hexdigest() for i in range(2)]
+    filestore.HashFilter.Build(urn, 1, [])
+
+    # Each filter only merges its own hashes into the stored filter.
+    for hash_value in hash_values:
+      hash_filter = filestore.HashFilter(urn, 1)
+      self.addCleanup(hash_filter.Close)
+      hash_filter.Add(hash_value)
+      hash_filter.Flush()
+
+    hash_filter = filestore.HashFilter(urn, 1)
+    hash_filter.Refresh()
+    for hash_value in hash_values:
+      self.assertTrue(hash_filter.MightContain(hash_value))
+    self.assertFalse(hash_filter.MightContain(hashlib.sha256(
+        "missing").hexdigest()))
+
+  def testBulkAddedHashesAreNotJournaled(self):
+    urn = filestore.HashFileStore.PATH
+    hash_value = hashlib.sha256("bulk").hexdigest()
+    filestore.HashFilter.Build(urn, 1, [])
+
+    hash_filter = filestore.HashFilter(urn, 1)
+    self.addCleanup(hash_filter.Close)
+    hash_filter.Add(hash_value, journal=False)
+    hash_filter.Flush()
+    data_store.DB.Flush()
+
+    self.assertFalse(list(data_store.DB.ResolvePrefix(
+        urn, filestore.HashFilter.RECENT_ATTRIBUTE_PREFIX, token=self.token)))
+    self.assertFalse(hash_filter.merged)
+
+    hash_filter = filestore.HashFilter(urn, 1)
+    hash_filter.Refresh()
+    self.assertTrue(hash_filter.MightContain(hash_value))
+
+  def testHashFilterSeesUnmergedHashesOfOtherProcesses(self):
+    urn = filestore.HashFileStore.PATH
+    hash_value = hashlib.sha256("new").hexdigest()
+    filestore.HashFilter.Build(urn, 1, [])
+
+    with test_lib.FakeTime(1000):
+      reader = filestore.HashFilter(urn, 1)
+      reader.Refresh()
+      self.assertFalse(reader.MightContain(hash_value))
+
+      # The writer never merges the hash into the stored filter.
+      writer = filestore.HashFilter(urn, 1)
+      self.addCleanup(writer.Close)
+      writer.Add(hash_value)
+      data_store.DB.Flush()
+
+    with test_lib.FakeTime(1000 +
+                           filestore.HashFilter.RECENT_REFRESH_INTERVAL):
+      reader.Refresh()
+    self.assertTrue(reader.MightContain(hash_value))
+
+    # A filter loaded from scratch sees the hash as well.
+    hash_filter = filestore.HashFilter(urn, 1)
+    hash_filter.Refresh()
+    self.assertTrue(hash_filter.MightContain(hash_value))
+
   def _GetBackRefs(self, filename):
     res = []
     for name, algo in [
@@ -410,6 +509,29 @@ class HashFileStoreTest(test_lib.AFF4ObjectTest):
     return res
 
 
+class ThreadedHashersTest(test_lib.GRRBaseTest):
+  """Tests for ThreadedHashers."""
+
+  def testThreadedHashersMatchHashlib(self):
+    data = os.urandom(3 * fingerprint.Fingerprinter.BLOCK_SIZE + 17)
+    hash_classes = [hashlib.md5, hashlib.sha1, hashlib.sha256]
+
+    fingerprinter = fingerprint.Fingerprinter(StringIO.StringIO(data))
+    with filestore.ThreadedHashers() as threaded_hashers:
+      fingerprinter.EvalGeneric(hashers=threaded_hashers.Wrap(hash_classes))
+      result = fingerprinter.HashIt()[0]
+
+    self.assertEqual(len(threaded_hashers.hashers), 3)
+    for hash_cls in hash_classes:
+      hasher = hash_cls(data)
+      self.assertEqual(result[hasher.name], hasher.digest())
+
+  def testDisabledThreadedHashersDontWrap(self):
+    hash_classes = [hashlib.md5, hashlib.sha1]
+    with filestore.ThreadedHashers(enabled=False) as threaded_hashers:
+      self.assertEqual(threaded_hashers.Wrap(hash_classes), hash_classes)
+
+
 def main(argv):
   # Run the full test suite
   test_lib.GrrTestProgram(argv=argv)
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 """MultiTypeCollection implementation."""
 
+import heapq
+
 from grr.lib import aff4
 
 from grr.lib.aff4_objects import sequential_collection
@@ -79,7 +81,8 @@ class MultiTypeCollection(aff4.AFF4Object):
                  type_name,
                  after_timestamp=None,
                  include_suffix=False,
-                 max_records=None):
+                 max_records=None,
+                 before_timestamp=None):
     """Scans for stored records.
 
     Scans through the collection, returning stored values ordered by timestamp.
@@ -88,6 +91,7 @@ class MultiTypeCollection(aff4.AFF4Object):
       type_name: Type of the records to scan.
 
       after_timestamp: If set, only returns values recorded after timestamp.
+        May also be a (timestamp, suffix) pair to continue a previous scan.
 
       include_suffix: If true, the timestamps returned are pairs of the form
         (micros_since_epoc, suffix) where suffix is a 24 bit random refinement
@@ -96,6 +100,8 @@ class MultiTypeCollection(aff4.AFF4Object):
       max_records: The maximum number of records to return. Defaults to
         unlimited.
 
+      before_timestamp: If set, only returns values recorded before timestamp.
+
     Yields:
       Pairs (timestamp, rdf_value), indicating that rdf_value was stored at
       timestamp.
@@ -108,9 +114,60 @@ class MultiTypeCollection(aff4.AFF4Object):
         token=self.token)
     for item in sub_collection.Scan(after_timestamp=after_timestamp,
                                     include_suffix=include_suffix,
-                                    max_records=max_records):
+                                    max_records=max_records,
+                                    before_timestamp=before_timestamp):
       yield item
 
+  def Scan(self,
+           after_timestamp=None,
+           include_suffix=False,
+           max_records=None,
+           before_timestamp=None,
+           type_names=None):
+    """Scans for stored records of all (or some) types.
+
+    Merges the scans of the per-type sequences, so that records of all types
+    are returned ordered by timestamp. Type and time range filters are applied
+    while scanning the sequences, records outside of them are never read.
+
+    Args:
+      after_timestamp: If set, only returns values recorded after timestamp.
+        May also be a (timestamp, suffix) pair to continue a previous scan.
+
+      include_suffix: If true, the timestamps returned are pairs of the form
+        (micros_since_epoc, suffix) where suffix is a 24 bit random refinement
+        to avoid collisions. Otherwise only micros_since_epoc is returned.
+
+      max_records: The maximum number of records to return. Defaults to
+        unlimited.
+
+      before_timestamp: If set, only returns values recorded before timestamp.
+
+      type_names: If set, only records of these types are returned.
+
+    Yields:
+      Pairs (timestamp, rdf_value), indicating that rdf_value was stored at
+      timestamp.
+    """
+    if type_names is None:
+      type_names = self.ListStoredTypes()
+
+    scans = [self.ScanByType(type_name,
+                             after_timestamp=after_timestamp,
+                             include_suffix=True,
+                             max_records=max_records,
+                             before_timestamp=before_timestamp)
+             for type_name in type_names]
+
+    for record_count, (key, rdf_value) in enumerate(heapq.merge(*scans)):
+      if max_records and record_count >= max_records:
+        return
+
+      if include_suffix:
+        yield (key, rdf_value)
+      else:
+        yield (key[0], rdf_value)
+
   def LengthByType(self, type_name):
     sub_collection_urn = self.urn.Add(type_name)
     sub_collection = aff4.FACTORY.Open(
@@ -99,6 +99,44 @@ class MultiTypeCollectionTest(test_lib.AFF4ObjectTest):
     self.assertEqual(101,
                      self.collection.LengthByType(rdfvalue.RDFString.__name__))
 
+  def testScanMergesTypesInTimestampOrder(self):
+    for i in range(10):
+      self.collection.Add(rdf_flows.GrrMessage(payload=rdfvalue.RDFInteger(i)),
+                          timestamp=2 * i)
+      self.collection.Add(rdf_flows.GrrMessage(payload=rdfvalue.RDFString(i)),
+                          timestamp=2 * i + 1)
+
+    self.assertEqual([ts for ts, _ in self.collection.Scan()], range(20))
+
+    # Time range and type filters.
+    items = list(self.collection.Scan(after_timestamp=4,
+                                      before_timestamp=10,
+                                      type_names=[rdfvalue.RDFString.__name__]))
+    self.assertEqual([ts for ts, _ in items], [5, 7, 9])
+    self.assertEqual([v.payload for _, v in items], ["2", "3", "4"])
+
+  def testScanCanBeContinuedFromLastKey(self):
+    for i in range(10):
+      self.collection.Add(rdf_flows.GrrMessage(payload=rdfvalue.RDFInteger(i)),
+                          timestamp=i)
+      self.collection.Add(rdf_flows.GrrMessage(payload=rdfvalue.RDFString(i)),
+                          timestamp=i)
+
+    values = []
+    key = None
+    while True:
+      page = list(self.collection.Scan(after_timestamp=key,
+                                       include_suffix=True,
+                                       max_records=3))
+      if not page:
+        break
+      values.extend(v.payload for _, v in page)
+      key = page[-1][0]
+
+    self.assertEqual(len(values), 20)
+    self.assertEqual(sorted(values), sorted([str(i) for i in range(10)] +
+                                            range(10)))
+
   def testDeletingCollectionDeletesAllSubcollections(self):
     self.collection.Add(rdf_flows.GrrMessage(payload=rdfvalue.RDFInteger(0)))
     self.collection.Add(rdf_flows.GrrMessage(payload=rdfvalue.RDFString("foo")))
@@ -3,9 +3,12 @@
 """
 
 import collections
+import heapq
 import random
+import struct
 import threading
 import time
+import zlib
 
 from grr.lib import access_control
 from grr.lib import aff4
@@ -29,12 +32,43 @@ class SequentialCollection(aff4.AFF4Object):
   # The type which we store, subclasses must set this to a subclass of RDFValue.
   RDF_TYPE = None
 
-  # The attribute (column) where we store value.
+  # The attribute (column) where we store value. Records and segments are
+  # stored below the collection's urn, so deleting the collection with
+  # aff4.FACTORY.Delete() removes them along with it.
   ATTRIBUTE = "aff4:sequential_value"
 
   # The largest possible suffix - maximum value expressible by 6 hex digits.
   MAX_SUFFIX = 2**24 - 1
 
+  # If set, records older than SEGMENT_WRITE_DELAY are packed into compressed
+  # segments by PackSegments(). Segments are named after the last record they
+  # hold and store (timestamp, suffix, length, value) records in order.
+  PACK_SEGMENTS = False
+
+  # The attribute (column) where we store segments.
+  SEGMENT_ATTRIBUTE = "aff4:sequential_segment"
+
+  # The attribute on the collection holding the last packed record.
+  SEGMENT_MARKER_ATTRIBUTE = "index:sequential_segment_end"
+
+  SEGMENT_RECORD_HEADER = "<QII"
+
+  # Uncompressed size of a segment.
+  SEGMENT_SIZE = 2 * 1024 * 1024
+
+  # Records are only packed once they are older than this. Records written
+  # later with an older timestamp stay where they are and are merged in on
+  # read.
+  SEGMENT_WRITE_DELAY = rdfvalue.Duration("10m")
+
+  # Number of segments read from the data store at once.
+  SEGMENT_SCAN_BATCH = 4
+
+  # Number of rows read at once when scanning a collection with segments.
+  ROW_SCAN_BATCH = 1000
+
+  SEGMENT_LOCK_LEASE = 600
+
   @classmethod
   def _MakeURN(cls, urn, timestamp, suffix=None):
     if suffix is None:
@@ -43,6 +77,30 @@ class SequentialCollection(aff4.AFF4Object):
       suffix = random.randint(1, cls.MAX_SUFFIX)
     return urn.Add("Results").Add("%016x.%06x" % (timestamp, suffix))
 
+  @classmethod
+  def _MakeSegmentURN(cls, urn, timestamp, suffix):
+    return urn.Add("Segments").Add("%016x.%06x" % (timestamp, suffix))
+
+  @classmethod
+  def _EncodeSegment(cls, records):
+    data = "".join(
+        struct.pack(cls.SEGMENT_RECORD_HEADER, ts, suffix, len(value)) + value
+        for (ts, suffix), value in records)
+    return zlib.compress(data)
+
+  @classmethod
+  def _DecodeSegment(cls, segment):
+    """Yields ((timestamp, suffix), value) records stored in a segment."""
+    data = zlib.decompress(segment)
+    header_size = struct.calcsize(cls.SEGMENT_RECORD_HEADER)
+    offset = 0
+    while offset < len(data):
+      ts, suffix, length = struct.unpack_from(cls.SEGMENT_RECORD_HEADER, data,
+                                              offset)
+      offset += header_size
+      yield (ts, suffix), data[offset:offset + length]
+      offset += length
+
   @classmethod
   def _ParseURN(cls, urn):
     string_urn = utils.SmartUnicode(urn)
@@ -142,7 +200,11 @@ class SequentialCollection(aff4.AFF4Object):
                           suffix=suffix,
                           **kwargs)
 
-  def Scan(self, after_timestamp=None, include_suffix=False, max_records=None):
+  def Scan(self,
+           after_timestamp=None,
+           include_suffix=False,
+           max_records=None,
+           before_timestamp=None):
     """Scans for stored records.
 
     Scans through the collection, returning stored values ordered by timestamp.
@@ -150,6 +212,8 @@ class SequentialCollection(aff4.AFF4Object):
     Args:
 
       after_timestamp: If set, only returns values recorded after timestamp.
+        May also be a (timestamp, suffix) pair, as returned when include_suffix
+        is set, to continue a scan right after a given record.
 
       include_suffix: If true, the timestamps returned are pairs of the form
         (micros_since_epoc, suffix) where suffix is a 24 bit random refinement
@@ -158,11 +222,15 @@ class SequentialCollection(aff4.AFF4Object):
       max_records: The maximum number of records to return. Defaults to
         unlimited.
 
+      before_timestamp: If set, only returns values recorded before timestamp.
+        The scan stops at the first record past it.
+
     Yields:
       Pairs (timestamp, rdf_value), indicating that rdf_value was stored at
       timestamp.
 
     """
+    after_key = None
     after_urn = None
     if after_timestamp is not None:
       if isinstance(after_timestamp, tuple):
@@ -170,59 +238,291 @@ class SequentialCollection(aff4.AFF4Object):
         after_timestamp = after_timestamp[0]
       else:
         suffix = self.MAX_SUFFIX
+      after_key = (after_timestamp, suffix)
       after_urn = utils.SmartStr(self._MakeURN(
           self.urn, after_timestamp, suffix=suffix))
 
+    if self.PACK_SEGMENTS:
+      records = self._ScanPacked(after_key, max_records)
+    else:
+      records = self._ScanRows(after_urn, max_records)
+
+    record_count = 0
+    for key, timestamp, value in records:
+      if before_timestamp is not None and key[0] >= before_timestamp:
+        return
+
+      if max_records and record_count >= max_records:
+        return
+      record_count += 1
+
+      rdf_value = self.RDF_TYPE(value)  # pylint: disable=not-callable
+      rdf_value.age = timestamp
+
+      if include_suffix:
+        yield (key, rdf_value)
+      else:
+        yield (timestamp, rdf_value)
+
+  def _ScanRows(self, after_urn, max_records):
+    """Yields (key, timestamp, value) for records stored as rows."""
     for subject, timestamp, value in data_store.DB.ScanAttribute(
         self.urn.Add("Results"),
         self.ATTRIBUTE,
         after_urn=after_urn,
         max_records=max_records,
         token=self.token):
-      rdf_value = self.RDF_TYPE(value)  # pylint: disable=not-callable
-      rdf_value.age = timestamp
+      yield (self._ParseURN(subject), timestamp, value)
 
-      if include_suffix:
-        yield (self._ParseURN(subject), rdf_value)
-      else:
-        yield (timestamp, rdf_value)
+  def _ScanPacked(self, after_key, max_records):
+    """Yields (key, timestamp, value) for records in rows and segments.
+
+    PackSegments() can write a segment and delete its rows while a scan is in
+    progress. Rows are therefore read a page at a time, and the segments
+    covering a page are only looked up once the page has been read: a record
+    missing from the page was packed into one of them before its row went
+    away.
+
+    Args:
+      after_key: If set, only records after this (timestamp, suffix) pair are
+        returned.
+      max_records: The maximum number of records the caller needs.
+
+    Yields:
+      (key, timestamp, value) tuples ordered by key.
+    """
+    row_batch = self.ROW_SCAN_BATCH
+    segment_batch = self.SEGMENT_SCAN_BATCH
+    if max_records:
+      row_batch = min(row_batch, max_records)
+      segment_batch = min(segment_batch, max_records)
+
+    segment_records = collections.deque()
+    segment_end = after_key
+    last_key = after_key
+    while True:
+      after_urn = None
+      if last_key is not None:
+        after_urn = utils.SmartStr(self._MakeURN(self.urn, *last_key))
+      rows = [(self._ParseURN(subject), timestamp, value)
+              for subject, timestamp, value in data_store.DB.ScanAttribute(
+                  self.urn.Add("Results"),
+                  self.ATTRIBUTE,
+                  after_urn=after_urn,
+                  max_records=row_batch,
+                  token=self.token)]
+      page_end = None
+      if len(rows) == row_batch:
+        page_end = rows[-1][0]
+
+      # Segments are looked up again for every page, they may have been
+      # written after the previous lookup.
+      while page_end is None or segment_end is None or segment_end < page_end:
+        segments = self._ReadSegments(segment_end, segment_batch)
+        for segment_end, records in segments:
+          segment_records.extend((key, key[0], value)
+                                 for key, value in records)
+        if len(segments) < segment_batch:
+          break
+
+      page = []
+      while segment_records and (page_end is None or
+                                 segment_records[0][0] <= page_end):
+        page.append(segment_records.popleft())
+
+      # Records which are still stored as rows after being packed (e.g.
+      # because packing was interrupted) show up twice, only the first copy
+      # is used.
+      for key, timestamp, value in heapq.merge(rows, page):
+        if last_key is not None and key <= last_key:
+          continue
+        last_key = key
+        yield (key, timestamp, value)
+
+      if page_end is None:
+        return
+
+  def _ReadSegments(self, after_key, max_segments):
+    """Reads segments ending after after_key.
+
+    Args:
+      after_key: If set, only segments ending after this (timestamp, suffix)
+        pair are read.
+      max_segments: The maximum number of segments to read.
+
+    Returns:
+      A list of (end_key, records) pairs, where records is a list of
+      ((timestamp, suffix), value) pairs.
+    """
+    after_urn = None
+    if after_key is not None:
+      after_urn = utils.SmartStr(self._MakeSegmentURN(self.urn, *after_key))
+
+    return [(self._ParseURN(subject), list(self._DecodeSegment(segment)))
+            for subject, _, segment in data_store.DB.ScanAttribute(
+                self.urn.Add("Segments"),
+                self.SEGMENT_ATTRIBUTE,
+                after_urn=after_urn,
+                max_records=max_segments,
+                token=self.token)]
 
   def MultiResolve(self, timestamps):
     """Lookup multiple values by (timestamp, suffix) pairs."""
-    for _, v in data_store.DB.MultiResolvePrefix(
+    missing = set(timestamps)
+    for subject, v in data_store.DB.MultiResolvePrefix(
         [self._MakeURN(self.urn, ts, suffix) for (ts, suffix) in timestamps],
         self.ATTRIBUTE,
         token=self.token):
       _, value, timestamp = v[0]
+      missing.discard(self._ParseURN(subject))
       rdf_value = self.RDF_TYPE(value)  # pylint: disable=not-callable
       rdf_value.age = timestamp
       yield rdf_value
 
-  def __iter__(self):
-    for _, item in self.Scan():
-      yield item
+    if not self.PACK_SEGMENTS:
+      return
+
+    segment = {}
+    segment_end = None
+    for key in sorted(missing):
+      if segment_end is None or key > segment_end:
+        # Find the first segment ending at or after key.
+        after_urn = utils.SmartStr(self._MakeSegmentURN(self.urn, key[0],
+                                                        key[1] - 1))
+        segment = {}
+        segment_end = None
+        for subject, _, value in data_store.DB.ScanAttribute(
+            self.urn.Add("Segments"),
+            self.SEGMENT_ATTRIBUTE,
+            after_urn=after_urn,
+            max_records=1,
+            token=self.token):
+          segment = dict(self._DecodeSegment(value))
+          segment_end = self._ParseURN(subject)
+
+        if segment_end is None:
+          # There are no segments past key.
+          return
+
+      if key in segment:
+        rdf_value = self.RDF_TYPE(segment[key])  # pylint: disable=not-callable
+        rdf_value.age = key[0]
+        yield rdf_value
+
+  def PackSegments(self):
+    """Packs records older than SEGMENT_WRITE_DELAY into segments.
+
+    Packing is skipped if the collection is locked by someone else.
+
+    Returns:
+      The number of records packed.
+    """
+    if self.locked:
+      return self._PackSegments()
+
+    try:
+      with aff4.FACTORY.OpenWithLock(self.urn,
+                                     blocking=False,
+                                     lease_time=self.SEGMENT_LOCK_LEASE,
+                                     token=self.token) as collection:
+        return collection._PackSegments()  # pylint: disable=protected-access
+    except aff4.LockError:
+      return 0
 
-  def OnDelete(self, deletion_pool=None):
-    pool = data_store.DB.GetMutationPool(self.token)
-    for subject, _, _ in data_store.DB.ScanAttribute(
+  def _PackSegments(self):
+    """Packs records into segments, the collection must be locked."""
+    after_segment_urn = None
+    after_urn = None
+    marker = data_store.DB.Resolve(self.urn,
+                                   self.SEGMENT_MARKER_ATTRIBUTE,
+                                   token=self.token)[0]
+    if marker:
+      ts, suffix = utils.SmartStr(marker).split(".")
+      marker_key = (int(ts, 16), int(suffix, 16))
+      after_segment_urn = utils.SmartStr(self._MakeSegmentURN(self.urn,
+                                                              *marker_key))
+      after_urn = utils.SmartStr(self._MakeURN(self.urn, *marker_key))
+
+    # Segments past the marker were left by an interrupted run. Their records
+    # are still stored as rows and get packed again below.
+    orphans = [subject for subject, _, _ in data_store.DB.ScanAttribute(
+        self.urn.Add("Segments"),
+        self.SEGMENT_ATTRIBUTE,
+        after_urn=after_segment_urn,
+        token=self.token)]
+    if orphans:
+      data_store.DB.DeleteSubjects(orphans, sync=True, token=self.token)
+
+    deadline = (rdfvalue.RDFDatetime().Now() - self.SEGMENT_WRITE_DELAY
+               ).AsMicroSecondsFromEpoch()
+
+    packed = 0
+    records = []
+    subjects = []
+    size = 0
+    idle = True
+    for subject, _, value in data_store.DB.ScanAttribute(
         self.urn.Add("Results"),
         self.ATTRIBUTE,
+        after_urn=after_urn,
         token=self.token):
-      pool.DeleteSubject(subject)
-      if pool.Size() > 50000:
-        pool.Flush()
-    pool.Flush()
-    super(SequentialCollection, self).OnDelete(deletion_pool=deletion_pool)
+      key = self._ParseURN(subject)
+      if key[0] >= deadline:
+        idle = False
+        break
+
+      records.append((key, value))
+      subjects.append(subject)
+      size += len(value)
+      if size >= self.SEGMENT_SIZE:
+        packed += self._WriteSegment(records, subjects)
+        records = []
+        subjects = []
+        size = 0
+
+    # A partial segment is only written once no more records are coming in,
+    # otherwise it is completed by a later run.
+    if records and idle:
+      packed += self._WriteSegment(records, subjects)
+
+    return packed
+
+  def _WriteSegment(self, records, subjects):
+    """Writes records to a segment and deletes their rows."""
+    last_key = records[-1][0]
+    data_store.DB.Set(self._MakeSegmentURN(self.urn, *last_key),
+                      self.SEGMENT_ATTRIBUTE,
+                      self._EncodeSegment(records),
+                      timestamp=last_key[0],
+                      token=self.token,
+                      sync=True)
+    data_store.DB.Set(self.urn,
+                      self.SEGMENT_MARKER_ATTRIBUTE,
+                      "%016x.%06x" % last_key,
+                      token=self.token,
+                      replace=True,
+                      sync=True)
+    data_store.DB.DeleteSubjects(subjects, sync=True, token=self.token)
+
+    self.UpdateLease(self.SEGMENT_LOCK_LEASE)
+    return len(records)
+
+  def __iter__(self):
+    for _, item in self.Scan():
+      yield item
 
 
 class BackgroundIndexUpdater(object):
   """Updates IndexedSequentialCollection objects in the background."""
+  # A bit longer than IndexedSequentialCollection.INDEX_WRITE_DELAY, so the
+  # records that triggered the update can be indexed.
   INDEX_DELAY = 240
 
   exit_now = False
 
   def __init__(self):
     self.to_process = collections.deque()
+    self.pending = set()
     self.cv = threading.Condition()
 
   def ExitNow(self):
@@ -233,14 +533,24 @@ class BackgroundIndexUpdater(object):
 
   def AddIndexToUpdate(self, index_urn):
     with self.cv:
+      if index_urn in self.pending:
+        return
+      self.pending.add(index_urn)
       self.to_process.append((index_urn, time.time() + self.INDEX_DELAY))
       self.cv.notify()
 
   def ProcessCollection(self, collection_urn, token):
     try:
-      aff4.FACTORY.Open(collection_urn, token=token).UpdateIndex()
+      collection = aff4.FACTORY.Open(collection_urn, token=token)
+      collection.UpdateIndex()
     except AttributeError:
-      pass
+      return
+
+    if collection.PACK_SEGMENTS:
+      try:
+        collection.PackSegments()
+      except access_control.UnauthorizedAccess:
+        pass
 
   def UpdateLoop(self):
     token = access_control.ACLToken(username="Background Index Updater",
@@ -260,6 +570,8 @@ class BackgroundIndexUpdater(object):
         time.sleep(next_time - now)
         now = time.time()
 
+      with self.cv:
+        self.pending.discard(next_urn)
       self.ProcessCollection(next_urn, token)
 
 
@@ -280,8 +592,15 @@ class IndexedSequentialCollection(SequentialCollection):
   Adds an index to SequentialCollection, making it efficient to find the number
   of records present, and to find a particular record number.
 
-  IMPLEMENTATION NOTE: The index is created lazily, and for records older than
-    INDEX_WRITE_DELAY.
+  IMPLEMENTATION NOTE: Index points are written by readers and the background
+    index updater when they scan past records older than INDEX_WRITE_DELAY. A
+    record that is written late, i.e. with a timestamp before the last index
+    point, shifts the record numbers after it. Writers stamping records with
+    their own clock are assumed to be less than INDEX_WRITE_DELAY behind the
+    readers, so only writes with an explicit timestamp older than
+    INDEX_WRITE_DELAY can do that. Only those check for and drop the index
+    points that became wrong. Readers double check each new index point after
+    writing it, which catches late writes racing with index creation.
   """
 
   # How many records between index entries. Subclasses may change this.  The
@@ -297,8 +616,10 @@ class IndexedSequentialCollection(SequentialCollection):
 
   INDEX_ATTRIBUTE_PREFIX = "index:sc_"
 
-  # The time to wait before creating an index for a record - hacky defense
-  # against the correct index changing due to a late write.
+  # Only records older than this are indexed. This is needed for correctness:
+  # records stamped at write time are not checked against the index, so the
+  # delay has to cover the clock skew between the workers writing to a
+  # collection and the ones reading it.
 
   INDEX_WRITE_DELAY = rdfvalue.Duration("3m")
 
@@ -318,25 +639,71 @@ class IndexedSequentialCollection(SequentialCollection):
 
   def _MaybeWriteIndex(self, i, ts):
     """Write index marker i."""
-    if i > self._max_indexed and i % self.INDEX_SPACING == 0:
-      # We only write the index if the timestamp is more than 5 minutes in the
-      # past: hacky defense against a late write changing the count.
-      if ts[0] < (rdfvalue.RDFDatetime().Now() - self.INDEX_WRITE_DELAY
-                 ).AsMicroSecondsFromEpoch():
-        # We may be used in contexts were we don't have write access, so simply
-        # give up in that case. TODO(user): Remove this when the ACL
-        # system allows.
-        try:
-          data_store.DB.Set(self.urn,
-                            self.INDEX_ATTRIBUTE_PREFIX + "%08x" % i,
-                            "%06x" % ts[1],
-                            ts[0],
-                            token=self.token,
-                            replace=True)
+    if (i > self._max_indexed and i % self.INDEX_SPACING == 0 and
+        i - self.INDEX_SPACING in self._index and
+        ts[0] < (rdfvalue.RDFDatetime().Now() - self.INDEX_WRITE_DELAY
+                ).AsMicroSecondsFromEpoch()):
+      # We may be used in contexts were we don't have write access, so simply
+      # give up in that case. TODO(user): Remove this when the ACL
+      # system allows.
+      try:
+        if self._WriteIndexPoint(i, ts):
           self._index[i] = ts
           self._max_indexed = max(i, self._max_indexed)
-        except access_control.UnauthorizedAccess:
-          pass
+      except access_control.UnauthorizedAccess:
+        pass
+
+  def _WriteIndexPoint(self, i, ts):
+    """Writes index point i and checks that it is still valid afterwards.
+
+    Args:
+      i: The record number, a multiple of INDEX_SPACING.
+      ts: The (timestamp, suffix) key of record i.
+
+    Returns:
+      True if the index point was written, False if a late write made it
+      invalid.
+    """
+    attribute = self.INDEX_ATTRIBUTE_PREFIX + "%08x" % i
+    data_store.DB.Set(self.urn,
+                      attribute,
+                      "%06x" % ts[1],
+                      ts[0],
+                      token=self.token,
+                      replace=True)
+
+    # A late writer that checked the index before we wrote this point might
+    # have added a record before ts. Since its record is visible by now,
+    # counting the records since the previous index point catches it. If the
+    # previous point is gone, a writer already invalidated the index.
+    prev = i - self.INDEX_SPACING
+    if prev:
+      prev_ts = self._index[prev]
+      valid = False
+      for (_, value, timestamp) in data_store.DB.ResolvePrefix(
+          self.urn,
+          self.INDEX_ATTRIBUTE_PREFIX + "%08x" % prev,
+          token=self.token):
+        valid = (timestamp, int(value, 16)) == prev_ts
+      start_ts = (prev_ts[0], prev_ts[1] - 1)
+    else:
+      valid = True
+      start_ts = None
+
+    if valid:
+      count = 0
+      for (key, _) in self.Scan(after_timestamp=start_ts,
+                                max_records=self.INDEX_SPACING + 2,
+                                include_suffix=True):
+        if key > ts:
+          break
+        count += 1
+      valid = count == self.INDEX_SPACING + 1
+
+    if not valid:
+      data_store.DB.DeleteAttributes(self.urn, [attribute],
+                                     token=self.token)
+    return valid
 
   def _IndexedScan(self, i, max_records=None):
     """Scan records starting with index i."""
@@ -413,10 +780,47 @@ class IndexedSequentialCollection(SequentialCollection):
     r = super(IndexedSequentialCollection, cls).StaticAdd(collection_urn, token,
                                                           rdf_value, timestamp,
                                                           suffix, **kwargs)
+    if timestamp is not None and r[0] < (
+        rdfvalue.RDFDatetime().Now() - cls.INDEX_WRITE_DELAY
+    ).AsMicroSecondsFromEpoch():
+      cls._CheckIndexAfterWrite(collection_urn, token, r)
     if random.randint(0, cls.INDEX_SPACING) == 0:
       BACKGROUND_INDEX_UPDATER.AddIndexToUpdate(collection_urn)
     return r
 
+  @classmethod
+  def _CheckIndexAfterWrite(cls, collection_urn, token, ts):
+    """Drops the index points a write of record ts made invalid.
+
+    This has to run after the record is written (which is synchronous by
+    default), see _WriteIndexPoint for the other half of the protocol. Index
+    points are only written for records older than INDEX_WRITE_DELAY, so
+    records stamped later than that can't come before any of them and don't
+    need checking. This includes records stamped at write time, as long as
+    the writer's clock isn't more than INDEX_WRITE_DELAY behind.
+
+    Args:
+      collection_urn: The urn of the collection written to.
+      token: The database access token.
+      ts: The (timestamp, suffix) key of the record written.
+    """
+    try:
+      attributes = []
+      for (attr, _, timestamp) in data_store.DB.ResolvePrefix(
+          collection_urn, cls.INDEX_ATTRIBUTE_PREFIX,
+          token=token):
+        if timestamp >= ts[0]:
+          attributes.append(attr)
+      if not attributes:
+        return
+
+      data_store.DB.DeleteAttributes(collection_urn,
+                                     attributes,
+                                     start=ts[0],
+                                     token=token)
+    except access_control.UnauthorizedAccess:
+      pass
+
 
 class GeneralIndexedCollection(IndexedSequentialCollection):
   """An indexed sequential collection of RDFValues with different types."""
@@ -4,6 +4,7 @@
 import threading
 
 from grr.lib import aff4
+from grr.lib import data_store
 from grr.lib import flags
 from grr.lib import rdfvalue
 from grr.lib import test_lib
@@ -88,6 +89,104 @@ class SequentialCollectionTest(test_lib.AFF4ObjectTest):
         self.fail("Deleted and recreated SequentialCollection should be empty")
 
 
+class TestPackedSequentialCollection(
+    sequential_collection.SequentialCollection):
+  RDF_TYPE = rdfvalue.RDFInteger
+  PACK_SEGMENTS = True
+  SEGMENT_SIZE = 20
+
+
+class TestPackedIndexedSequentialCollection(
+    sequential_collection.IndexedSequentialCollection):
+  RDF_TYPE = rdfvalue.RDFInteger
+  PACK_SEGMENTS = True
+  SEGMENT_SIZE = 20
+  INDEX_SPACING = 8
+
+
+class PackedSequentialCollectionTest(test_lib.AFF4ObjectTest):
+
+  def _CreateCollection(self, urn, collection_cls, count):
+    start = (rdfvalue.RDFDatetime().Now() - rdfvalue.Duration("1h")
+            ).AsMicroSecondsFromEpoch()
+    with aff4.FACTORY.Create(urn, collection_cls,
+                             token=self.token) as collection:
+      timestamps = [collection.Add(rdfvalue.RDFInteger(i),
+                                   timestamp=start + i,
+                                   suffix=1) for i in range(count)]
+    return aff4.FACTORY.Open(urn, token=self.token), timestamps
+
+  def _CountRows(self, collection):
+    return len(list(data_store.DB.ScanAttribute(
+        collection.urn.Add("Results"),
+        collection.ATTRIBUTE,
+        token=self.token)))
+
+  def testPackSegments(self):
+    collection, timestamps = self._CreateCollection(
+        "aff4:/sequential_collection/testPackSegments",
+        TestPackedSequentialCollection, 100)
+    self.assertEqual(collection.PackSegments(), 100)
+    self.assertEqual(self._CountRows(collection), 0)
+
+    # This record is too recent to be packed.
+    recent = collection.Add(rdfvalue.RDFInteger(100))
+    self.assertEqual(collection.PackSegments(), 0)
+    self.assertEqual(self._CountRows(collection), 1)
+
+    self.assertEqual([v for v in collection], range(101))
+    self.assertEqual([v for _, v in collection.Scan(
+        after_timestamp=timestamps[49])], range(50, 101))
+    self.assertEqual([v for _, v in collection.Scan(
+        after_timestamp=timestamps[49], max_records=3)], [50, 51, 52])
+
+    self.assertEqual(sorted(collection.MultiResolve(
+        timestamps[::10] + [recent])), range(0, 101, 10))
+
+  def testPackedCollectionReadsLateAndDuplicateRecords(self):
+    collection, timestamps = self._CreateCollection(
+        "aff4:/sequential_collection/testPackedLateRecords",
+        TestPackedSequentialCollection, 10)
+    collection.PackSegments()
+
+    # A record written with an old timestamp after packing is merged in.
+    late_ts = timestamps[4][0]
+    collection.Add(rdfvalue.RDFInteger(42), timestamp=late_ts, suffix=2)
+    # Rows left behind by an interrupted packing are only returned once.
+    collection.Add(rdfvalue.RDFInteger(7), timestamp=timestamps[7][0],
+                   suffix=1)
+
+    self.assertEqual([v for v in collection],
+                     [0, 1, 2, 3, 4, 42, 5, 6, 7, 8, 9])
+
+  def testScanSeesRecordsPackedDuringScan(self):
+    collection, _ = self._CreateCollection(
+        "aff4:/sequential_collection/testPackedDuringScan",
+        TestPackedSequentialCollection, 100)
+    collection.ROW_SCAN_BATCH = 10
+
+    scan = collection.Scan()
+    values = [next(scan)[1] for _ in range(15)]
+    # The rows ahead of the scan are packed and deleted.
+    self.assertEqual(collection.PackSegments(), 100)
+    self.assertEqual(self._CountRows(collection), 0)
+
+    values.extend(v for _, v in scan)
+    self.assertEqual(values, range(100))
+
+  def testPackedIndexedCollection(self):
+    collection, _ = self._CreateCollection(
+        "aff4:/sequential_collection/testPackedIndexed",
+        TestPackedIndexedSequentialCollection, 100)
+    collection.PackSegments()
+    self.assertEqual(self._CountRows(collection), 0)
+
+    collection = aff4.FACTORY.Open(collection.urn, token=self.token)
+    self.assertEqual(len(collection), 100)
+    for i in [0, 9, 10, 63, 99]:
+      self.assertEqual(collection[i], i)
+
+
 class TestIndexedSequentialCollection(
     sequential_collection.IndexedSequentialCollection):
   RDF_TYPE = rdfvalue.RDFInteger
@@ -192,6 +291,32 @@ class IndexedSequentialCollectionTest(test_lib.AFF4ObjectTest):
         for i in range(data_size - 1020, data_size - 1040, -1):
           self.assertEqual(collection[i], i)
 
+  def testLateWriteInvalidatesIndex(self):
+    urn = "aff4:/sequential_collection/testLateWriteInvalidatesIndex"
+    with utils.Stubber(TestIndexedSequentialCollection, "INDEX_SPACING", 8):
+      with aff4.FACTORY.Create(urn,
+                               TestIndexedSequentialCollection,
+                               token=self.token) as collection:
+        timestamps = [collection.Add(rdfvalue.RDFInteger(i),
+                                     timestamp=10 * (i + 1))
+                      for i in range(100)]
+        self.assertEqual(len(collection), 100)
+
+      # A record written between records 50 and 51.
+      TestIndexedSequentialCollection.StaticAdd(urn,
+                                                self.token,
+                                                rdfvalue.RDFInteger(-1),
+                                                timestamp=timestamps[50][0] + 5)
+
+      collection = aff4.FACTORY.Open(urn, token=self.token)
+      self.assertEqual(collection[0], 0)
+      self.assertEqual(sorted(collection._index.keys()), [0, 8, 16, 24, 32, 40,
+                                                          48])
+      self.assertEqual(len(collection), 101)
+      self.assertEqual(collection[51], -1)
+      self.assertEqual(collection[52], 51)
+      self.assertEqual(collection[100], 99)
+
   def testListing(self):
     test_urn = "aff4:/sequential_collection/testIndexedListing"
     with aff4.FACTORY.Create(test_urn,
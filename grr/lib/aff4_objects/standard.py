@@ -100,7 +100,7 @@ class BlobImage(aff4.AFF4ImageBase):
   _HASH_SIZE = 32
 
   # How many chunks we read ahead
-  _READAHEAD = 5
+  LOOK_AHEAD = 5
 
   @classmethod
   def _GenerateChunkIds(cls, fds):
@@ -200,7 +200,7 @@ class BlobImage(aff4.AFF4ImageBase):
     self.index.seek(offset)
     readahead = []
 
-    for _ in range(self._READAHEAD):
+    for _ in range(self._LookAheadWindow(chunk)):
       name = self.index.read(self._HASH_SIZE).encode("hex")
       if name and name not in self.chunk_cache:
         readahead.append(name)
@@ -313,7 +313,7 @@ class HashImage(aff4.AFF4Image):
   _HASH_SIZE = 32
 
   # How many chunks we read ahead
-  _READAHEAD = 5
+  LOOK_AHEAD = 5
   _data_dirty = False
 
   def Initialize(self):
@@ -347,7 +347,7 @@ class HashImage(aff4.AFF4Image):
     self.index.Seek(-self._HASH_SIZE, whence=1)
     readahead = []
 
-    for _ in range(self._READAHEAD):
+    for _ in range(self._LookAheadWindow(chunk)):
       name = self.index.Read(self._HASH_SIZE)
       if name and name not in self.chunk_cache:
         readahead.append(name.encode("hex"))
@@ -388,8 +388,6 @@ class AFF4SparseImage(aff4.AFF4ImageBase):
 
   _HASH_SIZE = 32
 
-  _READAHEAD = 10
-
   chunksize = 512 * 1024
 
   class SchemaCls(aff4.AFF4ImageBase.SchemaCls):
@@ -425,6 +423,9 @@ class AFF4SparseImage(aff4.AFF4ImageBase):
     if chunk.dirty:
       data_store.DB.StoreBlob(chunk.getvalue(), token=self.token)
 
+  def _LastChunk(self):
+    return self.last_chunk
+
   def _ChunkNrToHash(self, chunk_nr):
     return self._ChunkNrsToHashes([chunk_nr])[chunk_nr]
 
@@ -449,13 +450,7 @@ class AFF4SparseImage(aff4.AFF4ImageBase):
     # We don't have this chunk already cached. The most common read
     # access pattern is contiguous reading so since we have to go to
     # the data store already, we read ahead to reduce round trips.
-
-    missing_chunks = []
-    for chunk_number in range(chunk, chunk + 10):
-      if chunk_number not in self.chunk_cache:
-        missing_chunks.append(chunk_number)
-
-    self._ReadChunks(missing_chunks)
+    self._ReadChunks(self._ChunksToReadAhead(chunk))
     # This should work now - otherwise we just give up.
     try:
       return self.chunk_cache.Get(chunk)
@@ -376,6 +376,33 @@ class AFF4MemoryStreamTest(test_lib.AFF4ObjectTest):
 class AFF4ImageTest(test_lib.AFF4ObjectTest):
   """Tests for AFF4Image class."""
 
+  def testSequentialReadsGrowTheLookAheadWindow(self):
+    with aff4.FACTORY.Create("aff4:/foo",
+                             aff4_type=aff4.AFF4Image,
+                             token=self.token) as fd:
+      fd.SetChunksize(10)
+      data = "".join(chr(ord("a") + i % 26) * 10 for i in range(200))
+      fd.Write(data)
+
+    fd = aff4.FACTORY.Open("aff4:/foo", token=self.token)
+    with mock.patch.object(aff4.AFF4Image, "_ReadChunks", autospec=True,
+                           side_effect=aff4.AFF4Image._ReadChunks) as read:
+      result = []
+      while True:
+        buf = fd.Read(10)
+        if not buf:
+          break
+        result.append(buf)
+
+    self.assertEqual("".join(result), data)
+
+    # Windows of 10, 20, 40, 50, 50 and the remaining 30 chunks.
+    self.assertEqual(read.call_count, 6)
+    self.assertEqual(fd.look_ahead, fd.MAX_LOOK_AHEAD)
+
+    # Chunks behind the reader are released as the window grows.
+    self.assertEqual(len(fd.chunk_cache), 30)
+
   # Tests below effectively test AFF4ImageBase._MultiStream implementation.
   def testMultiStreamStreamsSingleFileWithSingleChunk(self):
     with aff4.FACTORY.Create("aff4:/foo",
@@ -1007,6 +1034,57 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
         for value, _ in values:
           self.assertFalse(unique_token in utils.SmartUnicode(value))
 
+  def testMultiDeleteDeletesSiblingsSharingAPrefix(self):
+    for path in ["aff4:/tmp/a", "aff4:/tmp/ab"]:
+      with aff4.FACTORY.Create(path,
+                               aff4.AFF4MemoryStream,
+                               token=self.token) as fd:
+        fd.Write("hello")
+
+    aff4.FACTORY.MultiDelete(["aff4:/tmp/a", "aff4:/tmp/ab"],
+                             token=self.token)
+
+    for path in ["aff4:/tmp/a", "aff4:/tmp/ab"]:
+      self.assertRaises(IOError,
+                        aff4.FACTORY.Open,
+                        path,
+                        aff4.AFF4MemoryStream,
+                        token=self.token)
+
+    fd = aff4.FACTORY.Open("aff4:/tmp", token=self.token)
+    self.assertFalse(set(fd.ListChildren()) &
+                     set(["aff4:/tmp/a", "aff4:/tmp/ab"]))
+
+  def testMultiDeleteRemovesSubjectsWhichAreNotIndexed(self):
+    with aff4.FACTORY.Create("aff4:/unindexed/dir/file",
+                             aff4.AFF4MemoryStream,
+                             token=self.token) as fd:
+      fd.Write("hello")
+
+    # Neither of these subjects is listed as a child of any object.
+    data_store.DB.Set("aff4:/unindexed/dir/Results/0",
+                      "aff4:sequential_value",
+                      "foo",
+                      token=self.token)
+    data_store.DB.Set("aff4:/unindexed/dir0",
+                      "aff4:sequential_value",
+                      "bar",
+                      token=self.token)
+
+    progress = []
+    aff4.FACTORY.MultiDelete(["aff4:/unindexed/dir"],
+                             token=self.token,
+                             progress_callback=lambda: progress.append(1))
+    self.assertTrue(progress)
+
+    # NOTE: We assume that tests are running with FakeDataStore.
+    subjects = [s for s in data_store.DB.subjects
+                if s.startswith("aff4:/unindexed/")]
+    self.assertEqual(subjects, ["aff4:/unindexed/dir0"])
+
+    fd = aff4.FACTORY.Open("aff4:/unindexed", token=self.token)
+    self.assertFalse(list(fd.ListChildren()))
+
   def testClientObject(self):
     fd = aff4.FACTORY.Create(self.client_id,
                              aff4_grr.VFSGRRClient,
@@ -1428,6 +1506,78 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
         sorted([x.urn for x in all_children]),
         [root_urn.Add("some1"), root_urn.Add("some2")])
 
+  def testMultiOpenCachesMissingObjects(self):
+    urns = ["aff4:/path/missing1", "aff4:/path/missing2"]
+    self.assertFalse(list(aff4.FACTORY.MultiOpen(urns, token=self.token)))
+
+    with mock.patch.object(data_store.DB, "MultiResolvePrefix") as resolve:
+      self.assertFalse(list(aff4.FACTORY.MultiOpen(urns, token=self.token)))
+      self.assertFalse(resolve.called)
+
+    # Creating the object expires the cached absence.
+    aff4.FACTORY.Create(urns[0], aff4.AFF4Volume, token=self.token).Close()
+    result = list(aff4.FACTORY.MultiOpen(urns, token=self.token))
+    self.assertEqual([x.urn for x in result], [urns[0]])
+
+    # Creating a child creates its parent in the index.
+    aff4.FACTORY.Create(urns[1] + "/child", aff4.AFF4Volume,
+                        token=self.token).Close()
+    result = list(aff4.FACTORY.MultiOpen(urns, token=self.token))
+    self.assertEqual(sorted([x.urn for x in result]), urns)
+
+    # A deleted object is cached as missing again until it's recreated.
+    aff4.FACTORY.Delete(urns[0], token=self.token)
+    result = list(aff4.FACTORY.MultiOpen(urns, token=self.token))
+    self.assertEqual([x.urn for x in result], [urns[1]])
+
+    aff4.FACTORY.Create(urns[0], aff4.AFF4Volume, token=self.token).Close()
+    result = list(aff4.FACTORY.MultiOpen(urns, token=self.token))
+    self.assertEqual(sorted([x.urn for x in result]), urns)
+
+  def testOpenWithAttributeProjection(self):
+    client_id = rdf_client.ClientURN("C.1234567812345678")
+    with aff4.FACTORY.Create(client_id,
+                             aff4_grr.VFSGRRClient,
+                             token=self.token) as fd:
+      fd.Set(fd.Schema.HOSTNAME("host"))
+      fd.Set(fd.Schema.FQDN("host.example.com"))
+
+    for fd in [
+        aff4.FACTORY.Open(client_id,
+                          attributes=[aff4_grr.VFSGRRClient.SchemaCls.HOSTNAME],
+                          token=self.token),
+        list(aff4.FACTORY.MultiOpen(
+            [client_id],
+            attributes=[aff4_grr.VFSGRRClient.SchemaCls.HOSTNAME],
+            token=self.token))[0]
+    ]:
+      self.assertTrue(isinstance(fd, aff4_grr.VFSGRRClient))
+      self.assertTrue(fd.Schema.HOSTNAME in fd.synced_attributes)
+      self.assertFalse(fd.Schema.FQDN in fd.synced_attributes)
+
+      # Attributes outside the projection are read on demand.
+      self.assertEqual(fd.Get(fd.Schema.HOSTNAME), "host")
+      self.assertEqual(fd.Get(fd.Schema.FQDN), "host.example.com")
+
+  def testGetAttributesCachesByAttributePrefix(self):
+    urn = aff4.ROOT_URN.Add("path").Add("some")
+    aff4.FACTORY.Create(urn, aff4.AFF4Volume, token=self.token).Close()
+
+    list(aff4.FACTORY.GetAttributes([urn], token=self.token))
+    type_only = list(aff4.FACTORY.GetAttributes(
+        [urn], token=self.token, attribute_prefixes=["aff4:type"]))
+
+    with mock.patch.object(data_store.DB, "MultiResolvePrefix") as resolve:
+      # Both fetches are served from the cache and are kept apart.
+      self.assertEqual(list(aff4.FACTORY.GetAttributes(
+          [urn], token=self.token, attribute_prefixes=["aff4:type"])),
+                       type_only)
+      values = list(aff4.FACTORY.GetAttributes([urn], token=self.token))
+      self.assertFalse(resolve.called)
+
+    self.assertEqual([x[0] for x in type_only[0][1]], ["aff4:type"])
+    self.assertGreater(len(values[0][1]), 1)
+
   def testObjectListChildren(self):
     root_urn = aff4.ROOT_URN.Add("path")
 
@@ -2232,6 +2382,106 @@ class ForemanTests(test_lib.AFF4ObjectTest):
                        rdf_client.ClientURN("C.0000000000000014"))
       self.assertEqual(self.clients_launched[3][1], eq_flow)
 
+  def testRulesIndexOnlyReturnsRulesThatMayMatch(self):
+    with aff4.FACTORY.Create("C.0000000000000031",
+                             aff4_grr.VFSGRRClient,
+                             mode="rw",
+                             token=self.token) as fd:
+      fd.Set(fd.Schema.SYSTEM, rdfvalue.RDFString("Linux"))
+      fd.AddLabels("foo", owner="GRR")
+
+    with aff4.FACTORY.Create("C.0000000000000032",
+                             aff4_grr.VFSGRRClient,
+                             token=self.token) as fd:
+      fd.Set(fd.Schema.SYSTEM, rdfvalue.RDFString("Windows 7"))
+
+    def Rule(description, *client_rules):
+      return rdf_foreman.ForemanRule(
+          description=description,
+          client_rule_set=rdf_foreman.ForemanClientRuleSet(
+              rules=list(client_rules)))
+
+    label_rule = rdf_foreman.ForemanLabelClientRule(label_names=["foo"])
+    no_label_rule = rdf_foreman.ForemanLabelClientRule(
+        label_names=["foo"],
+        match_mode=rdf_foreman.ForemanLabelClientRule.MatchMode.
+        DOES_NOT_MATCH_ANY)
+
+    index = rdf_foreman.ForemanRulesIndex([
+        Rule("windows", rdf_foreman.ForemanClientRule(
+            rule_type=rdf_foreman.ForemanClientRule.Type.OS,
+            os=rdf_foreman.ForemanOsClientRule(os_windows=True))),
+        Rule("label", rdf_foreman.ForemanClientRule(
+            rule_type=rdf_foreman.ForemanClientRule.Type.LABEL,
+            label=label_rule)),
+        Rule("no label", rdf_foreman.ForemanClientRule(
+            rule_type=rdf_foreman.ForemanClientRule.Type.LABEL,
+            label=no_label_rule)),
+        Rule("regex", rdf_foreman.ForemanClientRule(
+            rule_type=rdf_foreman.ForemanClientRule.Type.REGEX,
+            regex=rdf_foreman.ForemanRegexClientRule(
+                attribute_name="System",
+                attribute_regex="Linux")))
+    ])
+
+    linux_client = aff4.FACTORY.Open("C.0000000000000031", token=self.token)
+    self.assertEqual(
+        [rule.description for rule in index.GetCandidates(linux_client)],
+        ["label", "no label", "regex"])
+
+    windows_client = aff4.FACTORY.Open("C.0000000000000032", token=self.token)
+    self.assertEqual(
+        [rule.description for rule in index.GetCandidates(windows_client)],
+        ["windows", "no label", "regex"])
+
+    self.assertEqual([rule.description for rule in index.GetCandidates(None)],
+                     ["no label", "regex"])
+
+    # Without OS or label rules, the client's OS and labels are not needed.
+    index = rdf_foreman.ForemanRulesIndex([index.rules[3]])
+    with test_lib.Instrument(aff4.AFF4Object, "GetLabelsNames") as labels:
+      self.assertEqual(
+          [rule.description for rule in index.GetCandidates(linux_client)],
+          ["regex"])
+      self.assertEqual(labels.call_count, 0)
+
+  def testClientIsNotReadAgainUntilThereAreNewRules(self):
+    with aff4.FACTORY.Create("C.0000000000000041",
+                             aff4_grr.VFSGRRClient,
+                             token=self.token) as fd:
+      fd.Set(fd.Schema.SYSTEM, rdfvalue.RDFString("Windows 7"))
+
+    foreman = aff4.FACTORY.Open("aff4:/foreman", mode="rw", token=self.token)
+
+    def AddRule(created):
+      rule = rdf_foreman.ForemanRule(
+          created=int(created),
+          expires=int((time.time() + 3600) * 1e6),
+          client_rule_set=rdf_foreman.ForemanClientRuleSet(rules=[
+              rdf_foreman.ForemanClientRule(
+                  rule_type=rdf_foreman.ForemanClientRule.Type.OS,
+                  os=rdf_foreman.ForemanOsClientRule(os_windows=True))
+          ]))
+      rule.actions.Append(flow_name="Test Flow",
+                          argv=rdf_protodict.Dict(foo="bar"))
+
+      rules = foreman.Get(foreman.Schema.RULES).Copy()
+      rules.Append(rule)
+      foreman.Set(foreman.Schema.RULES, rules)
+
+    with utils.Stubber(flow.GRRFlow, "StartFlow", self.StartFlow):
+      self.clients_launched = []
+      AddRule(time.time() * 1e6)
+      self.assertEqual(foreman.AssignTasksToClient("C.0000000000000041"), 1)
+
+      with mock.patch.object(aff4.FACTORY, "MultiOpen") as multi_open:
+        self.assertEqual(foreman.AssignTasksToClient("C.0000000000000041"), 0)
+        self.assertFalse(multi_open.called)
+
+      AddRule(time.time() * 1e6 + 1)
+      self.assertEqual(foreman.AssignTasksToClient("C.0000000000000041"), 1)
+      self.assertEqual(len(self.clients_launched), 2)
+
   def testRuleExpiration(self):
     with test_lib.FakeTime(1000):
       foreman = aff4.FACTORY.Open("aff4:/foreman", mode="rw", token=self.token)
@@ -51,3 +51,14 @@ class Blobstore(object):
     Returns:
       A dict mapping each identifier to a boolean value indicating existence.
     """
+
+  def DeleteBlobs(self, identifiers, token=None):
+    """Deletes blobs.
+
+    Args:
+      identifiers: A list of identifiers for the blobs to delete.
+      token: Data store token.
+    """
+
+  def Close(self):
+    """Stops background work and releases the resources of this blob store."""
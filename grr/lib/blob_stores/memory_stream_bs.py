@@ -77,3 +77,8 @@ class MemoryStreamBlobstore(blob_store.Blobstore):
       res[urns[blob.urn]] = True
 
     return res
+
+  def DeleteBlobs(self, digests, token=None):
+    data_store.DB.DeleteSubjects([self._BlobUrn(digest) for digest in digests],
+                                 sync=True,
+                                 token=token)
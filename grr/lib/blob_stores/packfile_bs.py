@@ -0,0 +1,672 @@
+#!/usr/bin/env python
+"""A blob store keeping blobs in content addressed packfiles on local disk.
+
+Blobs are appended to large packfiles in PackfileBlobstore.location. An open
+addressed hash table, mapped into memory, maps the digest of every blob to its
+location in the packfiles so reads are served straight from the mapped
+packfiles. A Bloom filter stored in front of the table answers most existence
+checks for unknown blobs without probing it.
+
+Since the index and the packfiles are mapped shared, all processes using the
+same location see each other's blobs. Writers serialize on a lock file.
+Deleted blobs are marked in the index and a tombstone is appended to the
+packfiles, so that recovering the index from the packfiles doesn't bring them
+back. A background thread rewrites packfiles which are mostly deleted.
+
+The index also records where the last complete record of the current packfile
+ends. A process dying in the middle of an append leaves a partial record
+behind, which the next append cuts off, so partial records are only ever found
+at the end of a packfile when the index is recovered.
+"""
+
+
+import contextlib
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+import logging
+
+from grr.lib import blob_store
+from grr.lib import config_lib
+from grr.lib import utils
+
+INDEX_MAGIC = "GRRBIDX2"
+# Magic, number of slots, number of used slots, number of deleted slots, the
+# packfile blobs are appended to, whether the index was replaced and the end of
+# the last complete record in the packfile.
+INDEX_HEADER = struct.Struct("<8sQQQQQQ")
+# Raw digest, packfile number, offset and length of the blob.
+INDEX_SLOT = struct.Struct("<32sIQI")
+# Every record in a packfile is the raw digest and the length of the blob
+# followed by the blob itself.
+RECORD_HEADER = struct.Struct("<32sI")
+# Tombstones are records with this length, followed by the packfile and offset
+# of the deleted blob.
+TOMBSTONE_LENGTH = 0xFFFFFFFF
+TOMBSTONE = struct.Struct("<IQ")
+
+EMPTY_DIGEST = "\x00" * 32
+DELETED_PACKFILE = 0xFFFFFFFF
+INITIAL_SLOTS = 1 << 16
+
+# Bloom filter bits per index slot and bits set for each digest. The index is
+# at most half full so this is at least 16 bits per blob.
+BLOOM_BITS_PER_SLOT = 8
+BLOOM_HASHES = 4
+BLOOM_HASH_FORMAT = struct.Struct("<%dI" % BLOOM_HASHES)
+
+# The slot a digest is stored in is derived from these bytes of the digest.
+SLOT_HASH_FORMAT = struct.Struct("<16xQ")
+
+
+class PackfileIndex(object):
+  """A hash table mapping blob digests to their location in the packfiles."""
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, "r+b") as fd:
+      self.mmap = mmap.mmap(fd.fileno(), 0)
+
+    magic, self.num_slots = INDEX_HEADER.unpack_from(self.mmap)[:2]
+    if magic != INDEX_MAGIC:
+      raise IOError("%s is not a blob store index." % path)
+
+    self.mask = self.num_slots - 1
+    self.bloom_offset = INDEX_HEADER.size
+    self.bloom_bits = self.num_slots * BLOOM_BITS_PER_SLOT
+    self.slots_offset = self.bloom_offset + self.bloom_bits / 8
+
+  @classmethod
+  def Create(cls, path, num_slots, packfile, end):
+    """Creates an empty index with num_slots slots, a power of two."""
+    size = (INDEX_HEADER.size + num_slots * BLOOM_BITS_PER_SLOT / 8 +
+            num_slots * INDEX_SLOT.size)
+    with open(path, "wb") as fd:
+      fd.write(INDEX_HEADER.pack(INDEX_MAGIC, num_slots, 0, 0, packfile, 0,
+                                 end))
+      fd.truncate(size)
+
+    return cls(path)
+
+  def _Header(self):
+    return list(INDEX_HEADER.unpack_from(self.mmap))
+
+  def _SetHeader(self, header):
+    INDEX_HEADER.pack_into(self.mmap, 0, *header)
+
+  @property
+  def used(self):
+    return self._Header()[2]
+
+  @property
+  def deleted(self):
+    return self._Header()[3]
+
+  @property
+  def packfile(self):
+    return self._Header()[4]
+
+  @property
+  def end(self):
+    return self._Header()[6]
+
+  def SetEnd(self, packfile, end):
+    """Records the current packfile and the end of its last complete record."""
+    header = self._Header()
+    header[4] = packfile
+    header[6] = end
+    self._SetHeader(header)
+
+  @property
+  def superseded(self):
+    return bool(self._Header()[5])
+
+  def Supersede(self):
+    """Marks this index as replaced so other processes reopen the index."""
+    header = self._Header()
+    header[5] = 1
+    self._SetHeader(header)
+
+  def NeedsResize(self, count):
+    """Checks if count more blobs would fill more than half of the slots."""
+    header = self._Header()
+    return (header[2] + header[3] + count) * 2 > self.num_slots
+
+  def MightContain(self, digest):
+    """Checks the Bloom filter, False means the digest is not in the index."""
+    for bit in BLOOM_HASH_FORMAT.unpack_from(digest):
+      bit %= self.bloom_bits
+      if not ord(self.mmap[self.bloom_offset + bit / 8]) & (1 << bit % 8):
+        return False
+
+    return True
+
+  def _AddToBloomFilter(self, digest):
+    for bit in BLOOM_HASH_FORMAT.unpack_from(digest):
+      bit %= self.bloom_bits
+      offset = self.bloom_offset + bit / 8
+      self.mmap[offset] = chr(ord(self.mmap[offset]) | (1 << bit % 8))
+
+  def _FindSlot(self, digest):
+    """Returns the offset of the slot holding digest or of an empty slot."""
+    slot = SLOT_HASH_FORMAT.unpack_from(digest)[0] & self.mask
+    while True:
+      offset = self.slots_offset + slot * INDEX_SLOT.size
+      slot_digest = self.mmap[offset:offset + 32]
+      if slot_digest == digest or slot_digest == EMPTY_DIGEST:
+        return offset
+
+      slot = (slot + 1) & self.mask
+
+  def Lookup(self, digest):
+    """Returns the (packfile, offset, length) of a blob or None."""
+    _, packfile, offset, length = INDEX_SLOT.unpack_from(
+        self.mmap, self._FindSlot(digest))
+    if packfile == 0 or packfile == DELETED_PACKFILE:
+      return None
+
+    return packfile, offset, length
+
+  def Insert(self, digest, packfile, offset, length):
+    """Adds a blob or changes its location. The caller checks NeedsResize."""
+    slot_offset = self._FindSlot(digest)
+    slot_digest, old_packfile, _, _ = INDEX_SLOT.unpack_from(self.mmap,
+                                                             slot_offset)
+    header = self._Header()
+    if slot_digest == EMPTY_DIGEST:
+      header[2] += 1
+    elif old_packfile == DELETED_PACKFILE:
+      header[2] += 1
+      header[3] -= 1
+
+    # Readers identify a slot by its digest so it has to be written last.
+    self.mmap[slot_offset + 32:slot_offset + INDEX_SLOT.size] = (
+        INDEX_SLOT.pack(digest, packfile, offset, length)[32:])
+    self.mmap[slot_offset:slot_offset + 32] = digest
+    self._AddToBloomFilter(digest)
+    self._SetHeader(header)
+
+  def Delete(self, digest):
+    """Marks a blob as deleted, the digest stays to keep probing intact."""
+    slot_offset = self._FindSlot(digest)
+    slot_digest, packfile, _, _ = INDEX_SLOT.unpack_from(self.mmap, slot_offset)
+    if slot_digest == EMPTY_DIGEST or packfile == DELETED_PACKFILE:
+      return False
+
+    INDEX_SLOT.pack_into(self.mmap, slot_offset, digest, DELETED_PACKFILE, 0, 0)
+    header = self._Header()
+    header[2] -= 1
+    header[3] += 1
+    self._SetHeader(header)
+    return True
+
+  def __iter__(self):
+    """Yields (digest, packfile, offset, length) for all blobs."""
+    for slot in xrange(self.num_slots):
+      digest, packfile, offset, length = INDEX_SLOT.unpack_from(
+          self.mmap, self.slots_offset + slot * INDEX_SLOT.size)
+      if packfile != 0 and packfile != DELETED_PACKFILE:
+        yield digest, packfile, offset, length
+
+  def Close(self):
+    self.mmap.close()
+
+
+class PackfileCache(utils.FastStore):
+  """A cache of mapped packfiles."""
+
+  def KillObject(self, obj):
+    obj.close()
+
+
+class PackfileCompactor(utils.InterruptableThread):
+  """Compacts the packfiles of a location in the background.
+
+  There is one compactor per location and process, shared by all blob stores
+  using the location. It's stopped once the last of them is closed.
+  """
+
+  compactors = {}
+  compactors_lock = threading.Lock()
+
+  def __init__(self, location):
+    super(PackfileCompactor, self).__init__(
+        sleep_time=config_lib.CONFIG["PackfileBlobstore.compaction_interval"],
+        name="PackfileCompactor")
+    self.location = location
+    self.stores = []
+
+  @classmethod
+  def Register(cls, store):
+    with cls.compactors_lock:
+      compactor = cls.compactors.get(store.location)
+      if compactor is None:
+        compactor = cls(store.location)
+        cls.compactors[store.location] = compactor
+        compactor.start()
+
+      compactor.stores.append(store)
+
+  @classmethod
+  def Unregister(cls, store):
+    with cls.compactors_lock:
+      compactor = cls.compactors.get(store.location)
+      if compactor is None or store not in compactor.stores:
+        return
+
+      compactor.stores.remove(store)
+      if compactor.stores:
+        return
+
+      del cls.compactors[store.location]
+
+    compactor.Stop()
+    compactor.join()
+
+  def Iterate(self):
+    with self.compactors_lock:
+      if not self.stores:
+        return
+      store = self.stores[0]
+
+    try:
+      store.Compact()
+    except Exception:  # pylint: disable=broad-except
+      logging.exception("Error compacting packfiles in %s", self.location)
+
+
+class PackfileBlobstore(blob_store.Blobstore):
+  """A blob store appending blobs to content addressed packfiles."""
+
+  def __init__(self, location=None):
+    super(PackfileBlobstore, self).__init__()
+    self.location = location or config_lib.CONFIG[
+        "PackfileBlobstore.location"]
+    try:
+      os.makedirs(self.location)
+    except OSError:
+      # Directory exists already.
+      pass
+
+    self.lock = threading.RLock()
+    self.lock_file = open(os.path.join(self.location, "lock"), "ab")
+    self.write_lock_depth = 0
+    self.packfiles = PackfileCache(100)
+    self.index = None
+    self.closed = False
+    self._GetIndex()
+
+    PackfileCompactor.Register(self)
+
+  def Close(self):
+    """Stops compacting and unmaps the index and the packfiles."""
+    PackfileCompactor.Unregister(self)
+
+    with self._WriteLock():
+      self.closed = True
+      if self.index is not None:
+        self.index.Close()
+        self.index = None
+      self.packfiles.Flush()
+
+    self.lock_file.close()
+
+  def _IndexPath(self):
+    return os.path.join(self.location, "index")
+
+  def _PackfilePath(self, packfile):
+    return os.path.join(self.location, "pack-%08d" % packfile)
+
+  def _PackfileNumbers(self):
+    return sorted(int(name[5:]) for name in os.listdir(self.location)
+                  if name.startswith("pack-"))
+
+  @contextlib.contextmanager
+  def _WriteLock(self):
+    """Takes the lock file, nested calls don't release it early."""
+    with self.lock:
+      if not self.write_lock_depth:
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+      self.write_lock_depth += 1
+      try:
+        yield
+      finally:
+        self.write_lock_depth -= 1
+        if not self.write_lock_depth:
+          fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+  def _GetIndex(self):
+    """Returns the current index, reopening it if it was replaced."""
+    if self.index is not None and not self.index.superseded:
+      return self.index
+
+    if self.index is not None:
+      self.index.Close()
+      self.index = None
+
+    try:
+      self.index = PackfileIndex(self._IndexPath())
+    except (IOError, OSError, ValueError):
+      # There is no index (yet). Another process might be recovering it right
+      # now, so look again under the write lock before recovering it here.
+      with self._WriteLock():
+        try:
+          self.index = PackfileIndex(self._IndexPath())
+        except (IOError, OSError, ValueError):
+          self.index = self._RebuildIndex(INITIAL_SLOTS)
+
+    return self.index
+
+  def _RebuildIndex(self, num_slots):
+    """Replaces the index with an index of num_slots slots."""
+    old_index = self.index
+    tmp_path = self._IndexPath() + ".tmp"
+
+    if old_index is not None:
+      new_index = PackfileIndex.Create(tmp_path, num_slots, old_index.packfile,
+                                       old_index.end)
+      for entry in old_index:
+        new_index.Insert(*entry)
+    else:
+      # Recover the index from the packfiles. Later records supersede earlier
+      # ones since compaction appends live blobs to the current packfile, and
+      # tombstones always follow the blob they delete.
+      packfiles = self._PackfileNumbers()
+      new_index = PackfileIndex.Create(tmp_path, num_slots,
+                                       packfiles[-1] if packfiles else 1, 0)
+      for packfile in packfiles:
+        end = 0
+        for digest, offset, length in self._ScanPackfile(packfile):
+          if length == TOMBSTONE_LENGTH:
+            end = offset + TOMBSTONE.size
+            location = new_index.Lookup(digest)
+            if location and location[:2] == self._ReadTombstone(packfile,
+                                                                offset):
+              new_index.Delete(digest)
+            continue
+
+          end = offset + length
+
+          if new_index.NeedsResize(1):
+            new_index.Close()
+            return self._RebuildIndex(num_slots * 2)
+
+          new_index.Insert(digest, packfile, offset, length)
+
+        new_index.SetEnd(packfile, end)
+
+    os.rename(tmp_path, self._IndexPath())
+    if old_index is not None:
+      old_index.Supersede()
+      old_index.Close()
+
+    self.index = new_index
+    return new_index
+
+  def _GetPackfile(self, packfile, size):
+    """Returns packfile mapped into memory, size bytes of it at least."""
+    try:
+      mapped = self.packfiles.Get(packfile)
+      if len(mapped) >= size:
+        return mapped
+      self.packfiles.ExpireObject(packfile)
+    except KeyError:
+      pass
+
+    with open(self._PackfilePath(packfile), "rb") as fd:
+      mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    self.packfiles.Put(packfile, mapped)
+    return mapped
+
+  def _ScanPackfile(self, packfile):
+    """Yields (digest, offset, length) of all records in a packfile.
+
+    For tombstones, length is TOMBSTONE_LENGTH.
+
+    Args:
+      packfile: The number of the packfile.
+    """
+    size = os.path.getsize(self._PackfilePath(packfile))
+    if not size:
+      return
+
+    mapped = self._GetPackfile(packfile, size)
+    offset = 0
+    while offset + RECORD_HEADER.size <= size:
+      digest, length = RECORD_HEADER.unpack_from(mapped, offset)
+      offset += RECORD_HEADER.size
+      record_size = TOMBSTONE.size if length == TOMBSTONE_LENGTH else length
+      if offset + record_size > size:
+        logging.warning("Truncated record in packfile %d.", packfile)
+        return
+
+      yield digest, offset, length
+      offset += record_size
+
+  def _ReadTombstone(self, packfile, offset):
+    """Returns the (packfile, offset) of the blob a tombstone deletes."""
+    return TOMBSTONE.unpack_from(
+        self._GetPackfile(packfile, offset + TOMBSTONE.size), offset)
+
+  def _ReadRecord(self, digest, packfile, offset, length):
+    """Reads a blob, returns None if the record is not there (anymore)."""
+    try:
+      mapped = self._GetPackfile(packfile, offset + length)
+    except (IOError, OSError, ValueError):
+      return None
+
+    header_offset = offset - RECORD_HEADER.size
+    if (len(mapped) < offset + length or RECORD_HEADER.unpack_from(
+        mapped, header_offset) != (digest, length)):
+      return None
+
+    return mapped[offset:offset + length]
+
+  def _OpenPackfileForAppend(self, index):
+    """Opens the current packfile, cutting off a partial record at its end."""
+    fd = open(self._PackfilePath(index.packfile), "ab")
+    fd.seek(0, os.SEEK_END)
+    if fd.tell() > index.end:
+      logging.warning("Truncating partial record at %d in packfile %d.",
+                      index.end, index.packfile)
+      fd.truncate(index.end)
+      fd.seek(0, os.SEEK_END)
+
+    return fd
+
+  def _Append(self, index, blobs):
+    """Appends (digest, content) pairs to the packfiles and indexes them."""
+    if index.NeedsResize(len(blobs)):
+      num_slots = index.num_slots
+      while (index.used + len(blobs)) * 4 > num_slots:
+        num_slots *= 2
+      index = self._RebuildIndex(num_slots)
+
+    max_size = config_lib.CONFIG["PackfileBlobstore.max_packfile_size"]
+    packfile = index.packfile
+    locations = []
+    fd = self._OpenPackfileForAppend(index)
+    try:
+      for digest, content in blobs:
+        if fd.tell() >= max_size:
+          fd.close()
+          packfile += 1
+          # Packfiles past the current one can only hold partial records.
+          fd = open(self._PackfilePath(packfile), "wb")
+
+        fd.write(RECORD_HEADER.pack(digest, len(content)))
+        locations.append((digest, packfile, fd.tell(), len(content)))
+        fd.write(content)
+      end = fd.tell()
+    finally:
+      fd.close()
+
+    # The blobs are only indexed once they are fully written so readers never
+    # see partial blobs. The end is recorded first, since indexed blobs must
+    # never be cut off.
+    index.SetEnd(packfile, end)
+    for location in locations:
+      index.Insert(*location)
+
+    return index
+
+  def StoreBlobs(self, contents, token=None):
+    """Creates or overwrites blobs."""
+    _ = token
+    digests = [hashlib.sha256(content).hexdigest() for content in contents]
+
+    with self._WriteLock():
+      index = self._GetIndex()
+      blobs = {}
+      for digest, content in zip(digests, contents):
+        raw_digest = digest.decode("hex")
+        if raw_digest in blobs or index.Lookup(raw_digest):
+          logging.debug("Blob %s already stored.", digest)
+          continue
+
+        blobs[raw_digest] = content
+
+      if blobs:
+        self._Append(index, blobs.items())
+
+    return digests
+
+  def ReadBlobs(self, digests, token=None):
+    _ = token
+    res = {digest: None for digest in digests}
+
+    with self.lock:
+      for digest in digests:
+        raw_digest = digest.decode("hex")
+        # A compaction in another process might move the blob between the
+        # lookup and the read so we look it up again if it's gone.
+        for _ in range(2):
+          location = self._GetIndex().Lookup(raw_digest)
+          if location is None:
+            break
+
+          res[digest] = self._ReadRecord(raw_digest, *location)
+          if res[digest] is not None:
+            break
+
+    return res
+
+  def BlobsExist(self, digests, token=None):
+    """Check if blobs for the given digests already exist."""
+    _ = token
+    res = {digest: False for digest in digests}
+
+    with self.lock:
+      index = self._GetIndex()
+      for digest in digests:
+        raw_digest = digest.decode("hex")
+        res[digest] = (index.MightContain(raw_digest) and
+                       index.Lookup(raw_digest) is not None)
+
+    return res
+
+  def _AppendTombstones(self, index, tombstones):
+    """Appends (digest, packfile, offset) tombstones to the current packfile."""
+    with self._OpenPackfileForAppend(index) as fd:
+      for digest, packfile, offset in tombstones:
+        fd.write(RECORD_HEADER.pack(digest, TOMBSTONE_LENGTH))
+        fd.write(TOMBSTONE.pack(packfile, offset))
+      end = fd.tell()
+
+    index.SetEnd(index.packfile, end)
+
+  def DeleteBlobs(self, digests, token=None):
+    """Deletes blobs, the space is reclaimed by Compact()."""
+    _ = token
+    with self._WriteLock():
+      index = self._GetIndex()
+      tombstones = []
+      for digest in digests:
+        raw_digest = digest.decode("hex")
+        location = index.Lookup(raw_digest)
+        if location is not None:
+          tombstones.append((raw_digest,) + location[:2])
+
+      # The tombstones are written first, a blob that is gone from the index
+      # must not come back when the index is recovered.
+      self._AppendTombstones(index, tombstones)
+      for raw_digest, _, _ in tombstones:
+        index.Delete(raw_digest)
+
+  def Compact(self):
+    """Rewrites packfiles which consist mostly of deleted blobs."""
+    ratio = config_lib.CONFIG["PackfileBlobstore.compaction_ratio"]
+
+    with self._WriteLock():
+      if self.closed:
+        return
+
+      index = self._GetIndex()
+      live_sizes = {}
+      for _, packfile, _, length in index:
+        live_sizes[packfile] = (live_sizes.get(packfile, 0) + length +
+                                RECORD_HEADER.size)
+
+      candidates = []
+      for packfile in self._PackfileNumbers():
+        if packfile == index.packfile:
+          continue
+
+        size = os.path.getsize(self._PackfilePath(packfile))
+        if live_sizes.get(packfile, 0) <= size * (1 - ratio):
+          candidates.append(packfile)
+
+    # Every packfile is compacted under its own lock so writers are not
+    # blocked for the whole compaction.
+    for packfile in candidates:
+      with self._WriteLock():
+        if self.closed:
+          return
+
+        # Another compaction might have removed it in the meantime.
+        if os.path.exists(self._PackfilePath(packfile)):
+          self._CompactPackfile(packfile)
+
+  def _CompactPackfile(self, packfile):
+    """Moves the live blobs of packfile to the current one and removes it.
+
+    Tombstones of blobs in packfiles that still exist are moved as well.
+
+    Args:
+      packfile: The number of the packfile.
+    """
+    index = self._GetIndex()
+    moved = 0
+    live = []
+    tombstones = []
+    for digest, offset, length in self._ScanPackfile(packfile):
+      if length == TOMBSTONE_LENGTH:
+        deleted_packfile, deleted_offset = self._ReadTombstone(packfile, offset)
+        if (deleted_packfile != packfile and
+            os.path.exists(self._PackfilePath(deleted_packfile))):
+          tombstones.append((digest, deleted_packfile, deleted_offset))
+        continue
+
+      if index.Lookup(digest) != (packfile, offset, length):
+        continue
+
+      live.append((digest, self._ReadRecord(digest, packfile, offset, length)))
+      if len(live) >= 100:
+        index = self._Append(index, live)
+        moved += len(live)
+        live = []
+
+    if live:
+      index = self._Append(index, live)
+      moved += len(live)
+
+    self._AppendTombstones(index, tombstones)
+
+    self.packfiles.ExpireObject(packfile)
+    os.unlink(self._PackfilePath(packfile))
+    logging.info("Compacted packfile %d, moved %d blobs.", packfile, moved)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""Tests for the packfile based blob store."""
+
+import hashlib
+import os
+
+
+from grr.lib import flags
+from grr.lib import test_lib
+from grr.lib import utils
+from grr.lib.blob_stores import packfile_bs
+
+
+class PackfileBlobstoreTest(test_lib.GRRBaseTest):
+  """Tests for PackfileBlobstore."""
+
+  def setUp(self):
+    super(PackfileBlobstoreTest, self).setUp()
+    self.location = os.path.join(self.temp_dir, "blobs")
+
+  def _Store(self):
+    store = packfile_bs.PackfileBlobstore(location=self.location)
+    self.addCleanup(store.Close)
+    return store
+
+  def _Blobs(self, count, prefix="blob"):
+    return ["%s%d" % (prefix, i) * 20 for i in range(count)]
+
+  def _SmallPackfiles(self):
+    return test_lib.ConfigOverrider({
+        "PackfileBlobstore.max_packfile_size": 1024
+    })
+
+  def testStoreAndReadBlobs(self):
+    store = self._Store()
+    blobs = self._Blobs(100)
+
+    with self._SmallPackfiles():
+      digests = store.StoreBlobs(blobs)
+    self.assertEqual(digests,
+                     [hashlib.sha256(blob).hexdigest() for blob in blobs])
+
+    # Blobs are spread over multiple packfiles.
+    self.assertGreater(len(store._PackfileNumbers()), 1)
+
+    self.assertEqual(store.ReadBlobs(digests), dict(zip(digests, blobs)))
+
+    missing = hashlib.sha256("missing").hexdigest()
+    self.assertEqual(store.ReadBlobs([missing]), {missing: None})
+
+  def testStoringBlobsTwiceDoesNotDuplicateThem(self):
+    store = self._Store()
+    blobs = self._Blobs(10)
+
+    store.StoreBlobs(blobs + blobs)
+    store.StoreBlobs(blobs)
+    self.assertEqual(store.index.used, 10)
+
+  def testBlobsExist(self):
+    store = self._Store()
+    digests = store.StoreBlobs(self._Blobs(10))
+    missing = [hashlib.sha256(blob).hexdigest()
+               for blob in self._Blobs(100, prefix="missing")]
+
+    result = store.BlobsExist(digests + missing)
+    for digest in digests:
+      self.assertTrue(result[digest])
+    for digest in missing:
+      self.assertFalse(result[digest])
+
+  def testIndexGrows(self):
+    store = self._Store()
+    blobs = self._Blobs(packfile_bs.INITIAL_SLOTS)
+
+    digests = store.StoreBlobs(blobs)
+    self.assertGreater(store.index.num_slots, packfile_bs.INITIAL_SLOTS)
+    self.assertEqual(store.ReadBlob(digests[-1]), blobs[-1])
+
+  def testBlobsAreSharedBetweenStores(self):
+    store = self._Store()
+    other_store = self._Store()
+
+    digest = store.StoreBlob("foo")
+    self.assertTrue(other_store.BlobExists(digest))
+    self.assertEqual(other_store.ReadBlob(digest), "foo")
+
+    # Growing the index replaces it, the other store has to pick that up.
+    digests = other_store.StoreBlobs(self._Blobs(packfile_bs.INITIAL_SLOTS))
+    self.assertEqual(store.ReadBlob(digests[-1]), other_store.ReadBlob(
+        digests[-1]))
+    self.assertEqual(store.ReadBlob(digest), "foo")
+
+  def testDeleteAndCompact(self):
+    store = self._Store()
+    blobs = self._Blobs(100)
+    with self._SmallPackfiles():
+      digests = store.StoreBlobs(blobs)
+    packfiles = store._PackfileNumbers()
+
+    store.DeleteBlobs(digests[:80])
+    self.assertFalse(any(store.BlobsExist(digests[:80]).values()))
+
+    store.Compact()
+
+    # Packfiles holding deleted blobs only are gone.
+    self.assertNotIn(packfiles[0], store._PackfileNumbers())
+    self.assertLess(len(store._PackfileNumbers()), len(packfiles))
+
+    result = store.ReadBlobs(digests)
+    for digest in digests[:80]:
+      self.assertIsNone(result[digest])
+    for digest, blob in zip(digests[80:], blobs[80:]):
+      self.assertEqual(result[digest], blob)
+
+  def testIndexIsRecoveredFromPackfiles(self):
+    store = self._Store()
+    blobs = self._Blobs(100)
+    digests = store.StoreBlobs(blobs)
+
+    os.unlink(store._IndexPath())
+
+    store = self._Store()
+    self.assertEqual(store.ReadBlobs(digests), dict(zip(digests, blobs)))
+
+  def testDeletedBlobsStayDeletedWhenIndexIsRecovered(self):
+    store = self._Store()
+    blobs = self._Blobs(100)
+    with self._SmallPackfiles():
+      digests = store.StoreBlobs(blobs)
+      store.DeleteBlobs(digests[:50])
+      store.Compact()
+
+    os.unlink(store._IndexPath())
+
+    store = self._Store()
+    result = store.ReadBlobs(digests)
+    for digest in digests[:50]:
+      self.assertIsNone(result[digest])
+    for digest, blob in zip(digests[50:], blobs[50:]):
+      self.assertEqual(result[digest], blob)
+
+  def testPartialRecordIsCutOffByTheNextAppend(self):
+    store = self._Store()
+    blobs = self._Blobs(10)
+    digests = store.StoreBlobs(blobs[:5])
+
+    # A writer died in the middle of an append.
+    with open(store._PackfilePath(store.index.packfile), "ab") as fd:
+      fd.write(packfile_bs.RECORD_HEADER.pack("\x01" * 32, 1000) + "partial")
+
+    digests += store.StoreBlobs(blobs[5:])
+    store.DeleteBlobs(digests[:1])
+
+    os.unlink(store._IndexPath())
+
+    store = self._Store()
+    result = store.ReadBlobs(digests)
+    self.assertIsNone(result[digests[0]])
+    for digest, blob in zip(digests[1:], blobs[1:]):
+      self.assertEqual(result[digest], blob)
+
+  def testMissingIndexIsRecoveredUnderTheWriteLock(self):
+    store = self._Store()
+    digest = store.StoreBlob("foo")
+
+    # Make the store reopen the index, which is gone.
+    os.unlink(store._IndexPath())
+    store.index.Supersede()
+
+    write_lock_depths = []
+    rebuild_index = store._RebuildIndex
+
+    def RebuildIndex(num_slots):
+      write_lock_depths.append(store.write_lock_depth)
+      return rebuild_index(num_slots)
+
+    with utils.Stubber(store, "_RebuildIndex", RebuildIndex):
+      self.assertEqual(store.ReadBlob(digest), "foo")
+    self.assertEqual(write_lock_depths, [1])
+
+  def testStoresShareOneCompactorPerLocation(self):
+    store = packfile_bs.PackfileBlobstore(location=self.location)
+    other_store = packfile_bs.PackfileBlobstore(location=self.location)
+
+    compactor = packfile_bs.PackfileCompactor.compactors[self.location]
+    self.assertEqual(compactor.stores, [store, other_store])
+
+    store.Close()
+    self.assertTrue(compactor.is_alive())
+
+    # Closing the last store stops the compactor.
+    other_store.Close()
+    self.assertFalse(compactor.is_alive())
+    self.assertNotIn(self.location, packfile_bs.PackfileCompactor.compactors)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
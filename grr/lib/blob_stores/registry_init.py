@@ -5,3 +5,6 @@
 
 # The memory stream object based blob store.
 from grr.lib.blob_stores import memory_stream_bs
+
+# The local disk packfile based blob store.
+from grr.lib.blob_stores import packfile_bs
@@ -305,7 +305,9 @@ class Communicator(object):
                      result,
                      destination=None,
                      timestamp=None,
-                     api_version=3):
+                     api_version=3,
+                     server_load=0,
+                     next_poll_delay=0):
     """Accepts a list of messages and encodes for transmission.
 
     This function signs and then encrypts the payload.
@@ -323,6 +325,11 @@ class Communicator(object):
 
        api_version: The api version which this should be encoded in.
 
+       server_load: The server's load estimate sent to clients.
+
+       next_poll_delay: The number of seconds the client is asked to wait
+              before polling again.
+
     Returns:
        A nonce (based on time) which is inserted to the encrypted payload. The
        client can verify that the server is able to decrypt the message and
@@ -353,6 +360,10 @@ class Communicator(object):
       self.cipher_cache.Put(destination, cipher)
 
     signed_message_list = rdf_flows.SignedMessageList(timestamp=timestamp)
+    if server_load:
+      signed_message_list.server_load = server_load
+    if next_poll_delay:
+      signed_message_list.next_poll_delay = next_poll_delay
     self.EncodeMessageList(message_list, signed_message_list)
 
     result.encrypted_cipher_metadata = cipher.encrypted_cipher_metadata
@@ -442,6 +453,23 @@ class Communicator(object):
     Returns:
        list of messages and the CN where they came from.
 
+    Raises:
+       DecryptionError: If the message failed to decrypt properly.
+    """
+    messages, source, signed_message_list = self.DecodeSignedMessages(
+        response_comms)
+    return messages, source, signed_message_list.timestamp
+
+  def DecodeSignedMessages(self, response_comms):
+    """Like DecodeMessages but returns the whole SignedMessageList.
+
+    Args:
+        response_comms: A ClientCommunication rdfvalue
+
+    Returns:
+       list of messages, the CN where they came from and the decrypted
+       SignedMessageList.
+
     Raises:
        DecryptionError: If the message failed to decrypt properly.
     """
@@ -496,7 +524,7 @@ class Communicator(object):
       msg.source = cipher.cipher_metadata.source
 
     return (message_list.job, cipher.cipher_metadata.source,
-            signed_message_list.timestamp)
+            signed_message_list)
 
   def VerifyMessageSignature(self, unused_response_comms, signed_message_list,
                              cipher, cipher_verified, api_version,
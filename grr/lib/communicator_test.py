@@ -28,6 +28,7 @@ from grr.lib.flows.general import ca_enroller
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import crypto as rdf_crypto
 from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import protodict as rdf_protodict
 
 # pylint: mode=test
 
@@ -123,6 +124,23 @@ class ClientCommsTest(test_lib.GRRBaseTest):
       self.assertEqual(decoded_messages[i].auth_state,
                        rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
 
+  def testPollHintsAreSentInTheEncryptedPayload(self):
+    client = self.MakeClientAFF4Record()
+
+    result = rdf_flows.ClientCommunication()
+    self.server_communicator.EncodeMessages(rdf_flows.MessageList(),
+                                            result,
+                                            destination=str(client.urn),
+                                            timestamp=1000000,
+                                            server_load=0.5,
+                                            next_poll_delay=30)
+
+    _, _, signed_message_list = self.client_communicator.DecodeSignedMessages(
+        result)
+    self.assertEqual(signed_message_list.timestamp, 1000000)
+    self.assertEqual(signed_message_list.server_load, 0.5)
+    self.assertEqual(signed_message_list.next_poll_delay, 30)
+
   def testClientPingAndClockIsUpdated(self):
     """Check PING and CLOCK are updated, simulate bad client clock."""
     new_client = self.MakeClientAFF4Record()
@@ -614,6 +632,28 @@ class HTTPClientTests(test_lib.GRRBaseTest):
     """
     self._CheckFastPoll(True, config_lib.CONFIG["Client.poll_min"])
 
+  def testBlobUpload(self):
+    uploader = comms.BlobUploader(self.client_communicator.communicator,
+                                  comms.HTTPManager())
+    blob = rdf_protodict.DataBlob(data="Hello world")
+    self.assertTrue(uploader.UploadBlobs([blob]))
+
+    # The server received the blob for the TransferStore flow.
+    self.assertEqual(len(self.messages), 1)
+    self.assertEqual(self.messages[0].session_id.FlowName(), "TransferStore")
+    self.assertEqual(self.messages[0].payload.data, "Hello world")
+
+  def testBlobUploadFailure(self):
+    self.urlopen_stubber.Stop()
+    try:
+      with utils.Stubber(urllib2, "urlopen", self.RaiseError):
+        uploader = comms.BlobUploader(self.client_communicator.communicator,
+                                      comms.HTTPManager())
+        self.assertFalse(uploader.UploadBlobs([rdf_protodict.DataBlob(
+            data="Hello world")]))
+    finally:
+      self.urlopen_stubber.Start()
+
   def testCachedRSAOperations(self):
     """Make sure that expensive RSA operations are cached."""
     # First time fill the cache.
@@ -257,6 +257,21 @@ class DataStore(object):
     for subject in subjects:
       self.DeleteSubject(subject, sync=sync, token=token)
 
+  @abc.abstractmethod
+  def DeleteSubjectPrefix(self, subject_prefix, sync=False, token=None):
+    """Deletes a subject and all subjects below it.
+
+    This removes subject_prefix itself and every subject starting with
+    subject_prefix + "/", regardless of whether they are indexed as children.
+    Data stores implement this as a range delete which is much cheaper than
+    deleting the subjects one by one.
+
+    Args:
+      subject_prefix: The root of the subtree to delete.
+      sync: If true we ensure the subjects are deleted before returning.
+      token: An ACL token.
+    """
+
   def Set(self,
           subject,
           attribute,
@@ -637,6 +652,9 @@ class DataStore(object):
   def BlobsExist(self, identifiers, token=None):
     return self.blobstore.BlobsExist(identifiers, token=token)
 
+  def DeleteBlobs(self, identifiers, token=None):
+    return self.blobstore.DeleteBlobs(identifiers, token=token)
+
   def GetMutationPool(self, token=None):
     return self.mutation_pool_cls(token=token)
 
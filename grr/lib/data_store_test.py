@@ -503,6 +503,43 @@ class _DataStoreTest(test_lib.GRRBaseTest):
         # These rows should be present.
         self.assertIn(row_template % i, res)
 
+  @DeletionTest
+  def testDeleteSubjectPrefix(self):
+    predicate = "metadata:tspredicate"
+    deleted = ["aff4:/deleteprefixtest/sub",
+               "aff4:/deleteprefixtest/sub/a",
+               "aff4:/deleteprefixtest/sub/a/b",
+               "aff4:/deleteprefixtest/sub/c"]
+    kept = ["aff4:/deleteprefixtest",
+            "aff4:/deleteprefixtest/other",
+            "aff4:/deleteprefixtest/sub0",
+            "aff4:/deleteprefixtest/sub.txt",
+            "aff4:/deleteprefixtest/subdir/a"]
+
+    for row in deleted + kept:
+      data_store.DB.Set(row, predicate, "hello", token=self.token)
+    data_store.DB.Flush()
+
+    data_store.DB.DeleteSubjectPrefix("aff4:/deleteprefixtest/sub",
+                                      token=self.token)
+    data_store.DB.Flush()
+
+    res = dict(data_store.DB.MultiResolvePrefix(
+        deleted + kept, predicate, token=self.token))
+    for row in deleted:
+      self.assertNotIn(row, res)
+    for row in kept:
+      self.assertIn(row, res)
+
+    # Deleting the whole tree.
+    data_store.DB.DeleteSubjectPrefix("aff4:/deleteprefixtest",
+                                      token=self.token)
+    data_store.DB.Flush()
+
+    res = dict(data_store.DB.MultiResolvePrefix(
+        deleted + kept, predicate, token=self.token))
+    self.assertFalse(res)
+
   def testMultiResolvePrefix(self):
     """tests MultiResolvePrefix."""
     rows = self._MakeTimestampedRows()
@@ -1539,6 +1576,15 @@ class _DataStoreTest(test_lib.GRRBaseTest):
                       self.test_row,
                       token=self.token)
 
+  @DeletionTest
+  def testDeleteSubjectPrefixChecksWriteAccess(self):
+    self._InstallACLChecks("w")
+
+    self.assertRaises(access_control.UnauthorizedAccess,
+                      data_store.DB.DeleteSubjectPrefix,
+                      self.test_row,
+                      token=self.token)
+
   def testMultiSetChecksWriteAccess(self):
     self._InstallACLChecks("w")
 
@@ -165,6 +165,21 @@ def ResolveSubjectDestination(subject, regexes):
   return "aff4", ""
 
 
+def SubjectPrefixRange(subject_prefix):
+  """Returns the bounds of the subjects below subject_prefix.
+
+  Args:
+   subject_prefix: The root of a subtree of subjects.
+
+  Returns:
+   A tuple (subject, start, end). The subtree consists of subject itself and
+   all subjects in the half-open interval [start, end[.
+  """
+  subject = utils.SmartStr(rdfvalue.RDFURN(subject_prefix)).rstrip("/")
+  # "0" is the character right after "/".
+  return subject, subject + "/", subject + "0"
+
+
 def MakeDestinationKey(directory, filename):
   """Creates a name that identifies a database file."""
   return utils.SmartStr(utils.JoinPath(directory, filename)).lstrip("/")
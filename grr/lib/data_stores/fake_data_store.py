@@ -107,6 +107,17 @@ class FakeDataStore(data_store.DataStore):
     except KeyError:
       pass
 
+  @utils.Synchronized
+  def DeleteSubjectPrefix(self, subject_prefix, sync=False, token=None):
+    _ = sync
+    subject = utils.SmartUnicode(rdfvalue.RDFURN(subject_prefix)).rstrip("/")
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+
+    children_prefix = subject + "/"
+    for s in self.subjects.keys():
+      if s == subject or s.startswith(children_prefix):
+        del self.subjects[s]
+
   @utils.Synchronized
   def Clear(self):
     self.subjects = {}
@@ -577,6 +577,20 @@ class HTTPDataStore(data_store.DataStore):
     typ = rdf_data_server.DataStoreCommand.Command.DELETE_SUBJECT
     self._MakeRequestSyncOrAsync(request, typ, sync)
 
+  def DeleteSubjectPrefix(self, subject_prefix, sync=False, token=None):
+    _ = sync
+    subject_prefix = utils.SmartStr(rdfvalue.RDFURN(subject_prefix))
+    self.security_manager.CheckDataStoreAccess(token, [subject_prefix], "w")
+
+    request = rdf_data_store.DataStoreRequest(subject=[subject_prefix])
+    if token:
+      request.token = token
+
+    # The subtree may be spread over several data servers.
+    typ = rdf_data_server.DataStoreCommand.Command.DELETE_SUBJECT_PREFIX
+    for _ in self._MakeRequestsForPrefix(subject_prefix, typ, request):
+      pass
+
   def _MakeRequest(self,
                    subjects,
                    attributes,
@@ -146,6 +146,9 @@ class MySQLAdvancedDataStore(data_store.DataStore):
 
   POOL = None
 
+  # Number of subjects removed per transaction by DeleteSubjectPrefix.
+  DELETE_BATCH_SIZE = 1000
+
   def __init__(self):
     self.database_name = config_lib.CONFIG["Mysql.database_name"]
     # Use the global connection pool.
@@ -228,6 +231,40 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     queries = self._BuildDelete(subject)
     self._ExecuteQueries(queries)
 
+  def DeleteSubjectPrefix(self, subject_prefix, sync=False, token=None):
+    """Deletes a subject and all subjects below it with range deletes."""
+    _ = sync
+    subject = utils.SmartUnicode(rdfvalue.RDFURN(subject_prefix)).rstrip("/")
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+
+    self._ExecuteQueries(self._BuildDelete(subject))
+
+    # "0" is the character right after "/". The subjects table uses a case
+    # insensitive collation so the range is matched again in binary to keep
+    # the index usable while only deleting exact matches.
+    start = subject + "/"
+    end = subject + "0"
+    query = ("SELECT hash FROM subjects "
+             "WHERE subject >= %s AND subject < %s "
+             "AND BINARY subject >= %s AND BINARY subject < %s "
+             "LIMIT %s")
+    args = [start, end, start, end, self.DELETE_BATCH_SIZE]
+    while True:
+      hashes = [row["hash"] for row in self.ExecuteQuery(query, args)]
+      if not hashes:
+        break
+
+      placeholders = ", ".join(["%s"] * len(hashes))
+      transaction = []
+      for table, column in [("aff4", "subject_hash"),
+                            ("locks", "subject_hash"), ("subjects", "hash")]:
+        transaction.append({
+            "query": "DELETE %s FROM %s WHERE %s IN (%s)" %
+                     (table, table, column, placeholders),
+            "args": hashes
+        })
+      self._ExecuteTransaction(transaction)
+
   def ResolveMulti(self,
                    subject,
                    attributes,
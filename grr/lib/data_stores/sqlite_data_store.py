@@ -198,6 +198,23 @@ class SqliteConnectionCache(utils.FastStore):
         return
     yield self.Get(subject_prefix)
 
+  @utils.Synchronized
+  def DropDatabase(self, connection):
+    """Closes the connection and removes its database file."""
+    filename = connection.Filename()
+    for key, cached_connection in self:
+      if cached_connection.Filename() == filename:
+        # This also closes the connection.
+        self.ExpireObject(key)
+
+    if connection.conn is not None:
+      connection.Close()
+
+    try:
+      os.unlink(filename)
+    except OSError:
+      pass
+
   def DatabasesInDir(self, directory):
     """Returns a list of the database files in directory."""
     for (path, dirs, files) in os.walk(directory, topdown=True):
@@ -502,6 +519,28 @@ class SqliteConnection(object):
     self.dirty = True
     self.deleted += self.cursor.rowcount
 
+  @utils.Synchronized
+  def DeleteSubjectRange(self, subject, start, end):
+    """Deletes subject and all subjects in the range [start, end[."""
+    for table in ["tbl", "lock"]:
+      query = ("DELETE FROM %s WHERE subject = ? OR "
+               "(subject >= ? AND subject < ?)" % table)
+      args = (subject, start, end)
+      self.Execute(query, args)
+      self.deleted += self.cursor.rowcount
+    self.dirty = True
+
+  @utils.Synchronized
+  def HasSubjectsOutsideRange(self, subject, start, end):
+    """Checks for subjects other than subject and those in [start, end[."""
+    for table in ["tbl", "lock"]:
+      query = ("SELECT 1 FROM %s WHERE subject < ? OR "
+               "(subject > ? AND subject < ?) OR subject >= ? LIMIT 1" % table)
+      args = (subject, subject, start, end)
+      if self.Execute(query, args).fetchone():
+        return True
+    return False
+
   def PrettyPrint(self):
     """Print the SQLite database."""
     query = "SELECT subject, predicate, timestamp, value FROM tbl"
@@ -720,6 +759,24 @@ class SqliteDataStore(data_store.DataStore):
     with self.cache.Get(subject) as sqlite_connection:
       sqlite_connection.DeleteSubject(subject)
 
+  def DeleteSubjectPrefix(self, subject_prefix, sync=False, token=None):
+    _ = sync
+    subject, start, end = common.SubjectPrefixRange(subject_prefix)
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+
+    for sqlite_connection in list(self.cache.GetPrefix(subject)):
+      # Holding the cache lock keeps other threads from getting the
+      # connection, so no subjects outside the range can be written between
+      # the check and the removal of the file.
+      with self.cache.lock:
+        with sqlite_connection:
+          if sqlite_connection.HasSubjectsOutsideRange(subject, start, end):
+            sqlite_connection.DeleteSubjectRange(subject, start, end)
+          else:
+            # The database file only holds the subtree (e.g. a whole client or
+            # hunt), removing it is much cheaper than deleting and vacuuming.
+            self.cache.DropDatabase(sqlite_connection)
+
   def MultiResolvePrefix(self,
                          subjects,
                          attribute_prefix,
@@ -101,18 +101,25 @@ class IterateAllClientUrns(object):
 class IterateAllClients(IterateAllClientUrns):
   """Class to iterate over all GRR Client objects."""
 
-  def __init__(self, max_age, client_chunksize=25, **kwargs):
+  def __init__(self, max_age, client_chunksize=25, attributes=None, **kwargs):
     """Iterate over all clients in a threadpool.
 
     Args:
       max_age: Maximum age in seconds of clients to check.
       client_chunksize: A function to call with each client urn.
+      attributes: If set, only these client attributes are read up front.
       **kwargs: Arguments passed to init.
     """
     super(IterateAllClients, self).__init__(**kwargs)
     self.client_chunksize = client_chunksize
     self.max_age = max_age
 
+    self.attributes = attributes
+    if attributes is not None:
+      self.attributes = list(attributes) + [
+          aff4_grr.VFSGRRClient.SchemaCls.PING
+      ]
+
   def GetInput(self):
     """Yield client urns."""
     client_list = GetAllClients(token=self.token)
@@ -121,6 +128,7 @@ class IterateAllClients(IterateAllClientUrns):
       for fd in aff4.FACTORY.MultiOpen(client_group,
                                        mode="r",
                                        aff4_type=aff4_grr.VFSGRRClient,
+                                       attributes=self.attributes,
                                        token=self.token):
         if isinstance(fd, aff4_grr.VFSGRRClient):
           # Skip if older than max_age
@@ -37,17 +37,22 @@ class CleanHunts(cronjobs.SystemCronFlow):
 
     deadline = rdfvalue.RDFDatetime().Now() - hunts_ttl
 
-    hunts = aff4.FACTORY.MultiOpen(hunts_urns,
-                                   aff4_type=implementation.GRRHunt,
-                                   token=self.token)
-    for hunt in hunts:
-      if exception_label in hunt.GetLabelsNames():
-        continue
+    for hunts_group in utils.Grouper(hunts_urns, 100):
+      expired_hunt_urns = []
+      for hunt in aff4.FACTORY.MultiOpen(hunts_group,
+                                         aff4_type=implementation.GRRHunt,
+                                         token=self.token):
+        if exception_label in hunt.GetLabelsNames():
+          continue
+
+        runner = hunt.GetRunner()
+        if runner.context.expires < deadline:
+          expired_hunt_urns.append(hunt.urn)
 
-      runner = hunt.GetRunner()
-      if runner.context.expires < deadline:
-        aff4.FACTORY.Delete(hunt.urn, token=self.token)
-        self.HeartBeat()
+      aff4.FACTORY.MultiDelete(expired_hunt_urns,
+                               token=self.token,
+                               progress_callback=self.HeartBeat)
+      self.HeartBeat()
 
 
 class CleanCronJobs(cronjobs.SystemCronFlow):
@@ -106,7 +111,9 @@ class CleanTemp(cronjobs.SystemCronFlow):
         if tmp_obj.Get(tmp_obj.Schema.LAST) < deadline:
           expired_tmp_urns.append(tmp_obj.urn)
 
-      aff4.FACTORY.MultiDelete(expired_tmp_urns, token=self.token)
+      aff4.FACTORY.MultiDelete(expired_tmp_urns,
+                               token=self.token,
+                               progress_callback=self.HeartBeat)
       self.HeartBeat()
 
 
@@ -147,5 +154,7 @@ class CleanInactiveClients(cronjobs.SystemCronFlow):
         if client.Get(client.Schema.LAST) < deadline:
           inactive_client_urns.append(client.urn)
 
-      aff4.FACTORY.MultiDelete(inactive_client_urns, token=self.token)
+      aff4.FACTORY.MultiDelete(inactive_client_urns,
+                               token=self.token,
+                               progress_callback=self.HeartBeat)
       self.HeartBeat()
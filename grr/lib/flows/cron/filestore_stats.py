@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-"""Filestore stats crons."""
+"""Filestore stats and maintenance crons."""
 
 from grr.lib import aff4
 from grr.lib import flow
@@ -8,6 +8,7 @@ from grr.lib import stats as stats_lib
 from grr.lib import utils
 
 from grr.lib.aff4_objects import cronjobs
+from grr.lib.aff4_objects import filestore
 from grr.lib.aff4_objects import stats as aff4_stats
 
 # pylint: enable=unused-import
@@ -142,3 +143,15 @@ class FilestoreStatsCronFlow(cronjobs.SystemCronFlow):
       for consumer in self.consumers:
         consumer.Save(self.stats)
       self.stats.Close()
+
+
+class HashFilterCronFlow(cronjobs.SystemCronFlow):
+  """Builds the hash filters of the hash file stores from their contents."""
+  frequency = rdfvalue.Duration("1w")
+  lifetime = rdfvalue.Duration("1d")
+
+  @flow.StateHandler()
+  def Start(self):
+    for store_cls in [filestore.HashFileStore, filestore.NSRLFileStore]:
+      store_cls.BuildHashFilter(token=self.token)
+      self.HeartBeat()
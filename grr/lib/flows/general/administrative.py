@@ -373,10 +373,15 @@ class Foreman(flow.WellKnownFlow):
     with self.lock:
       if (self.foreman_cache is None or
           now > self.foreman_cache.age + self.cache_refresh_time):
-        self.foreman_cache = aff4.FACTORY.Open("aff4:/foreman",
-                                               mode="rw",
-                                               token=self.token)
-        self.foreman_cache.age = now
+        foreman = aff4.FACTORY.Open("aff4:/foreman",
+                                    mode="rw",
+                                    token=self.token)
+        # Clients checked against the old rules only need to be checked
+        # again if there are newer rules.
+        if self.foreman_cache is not None:
+          foreman.checked_clients = self.foreman_cache.checked_clients
+        foreman.age = now
+        self.foreman_cache = foreman
 
     if message.source:
       self.foreman_cache.AssignTasksToClient(message.source)
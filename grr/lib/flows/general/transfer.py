@@ -835,7 +835,7 @@ class TransferStore(flow.WellKnownFlow):
 
       blobs.append(data)
 
-    data_store.DB.StoreBlobs(blobs, token=self.token)
+    return data_store.DB.StoreBlobs(blobs, token=self.token)
 
   def ProcessMessage(self, message):
     """Write the blob into the AFF4 blob storage area."""
@@ -1,7 +1,13 @@
 #!/usr/bin/env python
 """The GRR frontend server."""
 
+import collections
+import math
 import operator
+import os
+import random
+import socket
+import threading
 import time
 
 
@@ -14,6 +20,7 @@ from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import flow
 from grr.lib import queue_manager
+from grr.lib import queues
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib import stats
@@ -21,6 +28,11 @@ from grr.lib import threadpool
 from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import stats as rdf_stats
+
+
+class UploadError(Exception):
+  """Raised when blobs sent to the upload endpoint can't be stored."""
 
 
 class ServerCommunicator(communicator.Communicator):
@@ -146,6 +158,187 @@ class ServerCommunicator(communicator.Communicator):
     return rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED
 
 
+class LatencyTracker(object):
+  """Keeps the most recent latency samples to compute percentiles."""
+
+  def __init__(self, max_samples=1000):
+    self.samples = collections.deque(maxlen=max_samples)
+    self.lock = threading.RLock()
+
+  @utils.Synchronized
+  def Record(self, latency):
+    self.samples.append(latency)
+
+  @utils.Synchronized
+  def Percentile(self, percentile):
+    """Returns the given percentile of the samples, 0 if there are none."""
+    if not self.samples:
+      return 0
+
+    ordered = sorted(self.samples)
+    index = int(math.ceil(percentile / 100.0 * len(ordered))) - 1
+    return ordered[max(0, index)]
+
+
+class AdmissionController(object):
+  """Decides how much work a frontend takes on based on cluster health.
+
+  Each frontend periodically publishes a FrontendHealth record to a shared data
+  store row and reads back the records of all frontends. The records contain:
+
+  - The backlog of one worker notification shard. Frontends sample the shards
+    in turn, so the cluster as a whole keeps all shards covered.
+  - Data store latency percentiles seen by this frontend.
+  - Blob store write latency percentiles seen by this frontend.
+
+  Each signal is compared to its configured limit. The resulting admission
+  factor is 1 if all signals are within their limits and shrinks in proportion
+  to the worst overload otherwise. Frontends use it to scale the number of
+  tasks they hand out and to ask clients to poll less often.
+  """
+
+  HEALTH_URN = rdfvalue.RDFURN("aff4:/frontend_health")
+  HEALTH_PREFIX = "health:"
+
+  # Records are ignored once they are older than this many update intervals,
+  # and deleted once they are older than HEALTH_EXPIRY_INTERVALS.
+  HEALTH_MAX_AGE_INTERVALS = 3
+  HEALTH_EXPIRY_INTERVALS = 10
+
+  # Shard backlogs are only counted up to this multiple of the limit, which
+  # keeps the sampling cheap. Larger backlogs don't lower the admission factor
+  # any further.
+  MAX_BACKLOG_PRESSURE = 2
+
+  def __init__(self, token=None, store=None, frontend_id=None):
+    self.token = token
+    self.data_store = store or data_store.DB
+    self.frontend_id = frontend_id or "%s-%d" % (socket.gethostname(),
+                                                 os.getpid())
+    self.datastore_latency = LatencyTracker()
+    self.blobstore_latency = LatencyTracker()
+    self.admission_factor = 1.0
+    # Frontends start sampling at a random shard so they cover different
+    # shards.
+    self.next_backlog_shard = random.randint(0, 1 << 16)
+
+  def _SampleShardBacklog(self):
+    """Counts the pending notifications of the next shard in turn."""
+    shards = queue_manager.QueueManager(
+        token=self.token).GetAllNotificationShards(queues.FLOWS)
+    shard_index = self.next_backlog_shard % len(shards)
+    self.next_backlog_shard = shard_index + 1
+
+    limit = (config_lib.CONFIG["Frontend.max_shard_backlog"] *
+             self.MAX_BACKLOG_PRESSURE)
+    notifications = self.data_store.ResolvePrefix(
+        shards[shard_index],
+        queue_manager.QueueManager.NOTIFY_PREDICATE_PREFIX,
+        limit=limit,
+        token=self.token)
+
+    return shard_index, len(notifications)
+
+  def PublishHealth(self):
+    """Writes this frontend's view of the system to the data store."""
+    shard_index, backlog = self._SampleShardBacklog()
+    health = rdf_stats.FrontendHealth(
+        frontend_id=self.frontend_id,
+        timestamp=rdfvalue.RDFDatetime().Now(),
+        backlog_shard=shard_index,
+        backlog_size=backlog,
+        datastore_latency_p50=self.datastore_latency.Percentile(50),
+        datastore_latency_p99=self.datastore_latency.Percentile(99),
+        blobstore_latency_p99=self.blobstore_latency.Percentile(99))
+
+    self.data_store.Set(self.HEALTH_URN,
+                        self.HEALTH_PREFIX + self.frontend_id,
+                        health.SerializeToString(),
+                        token=self.token)
+    return health
+
+  def ReadClusterHealth(self):
+    """Returns the recent health records of all frontends.
+
+    Records of frontends that stopped publishing long ago are deleted, so the
+    health row doesn't grow with every frontend process ever started.
+
+    Returns:
+      A list of FrontendHealth records.
+    """
+    interval = config_lib.CONFIG["Frontend.health_update_interval"]
+    now = rdfvalue.RDFDatetime().Now()
+    oldest = now - rdfvalue.Duration("%ds" % (
+        self.HEALTH_MAX_AGE_INTERVALS * interval))
+    expiry = now - rdfvalue.Duration("%ds" % (
+        self.HEALTH_EXPIRY_INTERVALS * interval))
+
+    result = []
+    expired = []
+    for attribute, value, _ in self.data_store.ResolvePrefix(
+        self.HEALTH_URN, self.HEALTH_PREFIX, token=self.token):
+      health = rdf_stats.FrontendHealth(value)
+      if health.timestamp >= oldest:
+        result.append(health)
+      elif health.timestamp < expiry:
+        expired.append(attribute)
+
+    if expired:
+      # Only versions written before the expiry time are deleted, so a record
+      # published in the meantime is kept.
+      self.data_store.DeleteAttributes(self.HEALTH_URN,
+                                       expired,
+                                       end=expiry.AsMicroSecondsFromEpoch(),
+                                       token=self.token)
+
+    return result
+
+  def ComputeAdmissionFactor(self, health_records):
+    """Computes the fraction of the usual work we should take on."""
+    if not health_records:
+      return 1.0
+
+    # The most recent sample wins for each shard.
+    backlogs = {}
+    for health in sorted(health_records, key=lambda h: h.timestamp):
+      backlogs[health.backlog_shard] = health.backlog_size
+
+    def Median(values):
+      return sorted(values)[len(values) // 2]
+
+    pressures = [
+        max(backlogs.values()) /
+        float(config_lib.CONFIG["Frontend.max_shard_backlog"]),
+        Median([h.datastore_latency_p99 for h in health_records]) /
+        config_lib.CONFIG["Frontend.max_datastore_latency"],
+        Median([h.blobstore_latency_p99 for h in health_records]) /
+        config_lib.CONFIG["Frontend.max_blobstore_latency"]
+    ]
+
+    return min(1.0, 1.0 / max(pressures + [1e-6]))
+
+  def Update(self):
+    """Publishes our health and recomputes the admission factor."""
+    try:
+      self.PublishHealth()
+      self.admission_factor = self.ComputeAdmissionFactor(
+          self.ReadClusterHealth())
+    except Exception as e:  # pylint: disable=broad-except
+      # Admission control must never take the frontend down.
+      logging.exception("Unable to update admission control: %s", e)
+
+    stats.STATS.SetGaugeValue("grr_frontendserver_admission_factor",
+                              self.admission_factor)
+    return self.admission_factor
+
+  def AdmitTasks(self, count):
+    """Scales the number of tasks we would like to hand out."""
+    if count <= 0:
+      return 0
+
+    return int(math.ceil(count * self.admission_factor))
+
+
 class FrontEndServer(object):
   """This is the front end server.
 
@@ -175,6 +368,10 @@ class FrontEndServer(object):
     self.throttle_callback = lambda: True
     self.SetThrottleBundlesRatio(None)
 
+    # An exponentially weighted estimate of the fraction of recent bundles we
+    # could not serve properly. This is sent to clients as a load hint.
+    self.load_estimate = 0.0
+
     # This object manages our crypto.
     self._communicator = ServerCommunicator(certificate=certificate,
                                             private_key=private_key,
@@ -191,6 +388,16 @@ class FrontEndServer(object):
         max_threads=config_lib.CONFIG["Threadpool.size"])
     self.thread_pool.Start()
 
+    # Limits the work we take on based on the health of the whole system.
+    self.admission_controller = AdmissionController(token=self.token,
+                                                    store=self.data_store)
+    if config_lib.CONFIG["Frontend.admission_control"]:
+      self.admission_thread = utils.InterruptableThread(
+          target=self.admission_controller.Update,
+          sleep_time=config_lib.CONFIG["Frontend.health_update_interval"],
+          name="AdmissionControl")
+      self.admission_thread.start()
+
     # Well known flows are run on the front end.
     self.well_known_flows = (
         flow.WellKnownFlow.GetAllWellKnownFlows(token=self.token))
@@ -269,6 +476,46 @@ class FrontEndServer(object):
 
     return should_throttle
 
+  def UpdateLoadEstimate(self, throttled):
+    """Folds the outcome of the latest bundle into the load estimate.
+
+    Args:
+      throttled: True if we could not give the client its tasks.
+
+    Returns:
+      The new load estimate, a value between 0 and 1.
+    """
+    decay = config_lib.CONFIG["Frontend.load_estimate_decay"]
+    self.load_estimate = ((1 - decay) * self.load_estimate +
+                          decay * float(bool(throttled)))
+    stats.STATS.SetGaugeValue("grr_frontendserver_load_estimate",
+                              self.load_estimate)
+
+    return self.load_estimate
+
+  def GetPollHints(self, tasks, fastpoll=False):
+    """Returns the load hints to send to the client.
+
+    Clients which were just given work or which asked to fast poll are never
+    slowed down, everyone else is asked to wait for a period proportional to
+    the current load.
+
+    Args:
+      tasks: The tasks we send the client in this response.
+      fastpoll: True if the client sent messages which require fast polling.
+
+    Returns:
+      A tuple (server_load, next_poll_delay).
+    """
+    # When the system as a whole is overloaded, clients are asked to back off
+    # so we accept less inbound data.
+    load = max(self.load_estimate,
+               1 - self.admission_controller.admission_factor)
+    if tasks or fastpoll:
+      return load, 0
+
+    return load, load * config_lib.CONFIG["Frontend.poll_hint_max_delay"]
+
   @stats.Counted("grr_frontendserver_handle_num")
   @stats.Timed("grr_frontendserver_handle_time")
   def HandleMessageBundles(self, request_comms, response_comms):
@@ -297,11 +544,14 @@ class FrontEndServer(object):
       # Receive messages in line.
       self.ReceiveMessages(source, messages)
 
-    # We send the client a maximum of self.max_queue_size messages
-    required_count = max(0, self.max_queue_size - request_comms.queue_size)
+    # We send the client a maximum of self.max_queue_size messages, fewer if
+    # the workers or the data store are overloaded.
+    required_count = self.admission_controller.AdmitTasks(
+        self.max_queue_size - request_comms.queue_size)
     tasks = []
 
     message_list = rdf_flows.MessageList()
+    throttled = True
     if self.UpdateAndCheckIfShouldThrottle(time.time()):
       stats.STATS.IncrementCounter("grr_frontendserver_handle_throttled_num")
 
@@ -311,10 +561,15 @@ class FrontEndServer(object):
       if time.time() - now < 10:
         tasks = self.DrainTaskSchedulerQueueForClient(source, required_count)
         message_list.job = tasks
+        throttled = False
 
     else:
       stats.STATS.IncrementCounter("grr_frontendserver_handle_throttled_num")
 
+    self.UpdateLoadEstimate(throttled)
+    server_load, next_poll_delay = self.GetPollHints(
+        tasks, fastpoll=any(msg.require_fastpoll for msg in messages))
+
     # Encode the message_list in the response_comms using the same API version
     # the client used.
     try:
@@ -322,7 +577,9 @@ class FrontEndServer(object):
                                         response_comms,
                                         destination=str(source),
                                         timestamp=timestamp,
-                                        api_version=request_comms.api_version)
+                                        api_version=request_comms.api_version,
+                                        server_load=server_load,
+                                        next_poll_delay=next_poll_delay)
     except communicator.UnknownClientCert:
       # We can not encode messages to the client yet because we do not have the
       # client certificate - return them to the queue so we can try again later.
@@ -331,6 +588,78 @@ class FrontEndServer(object):
 
     return source, len(messages)
 
+  @stats.Counted("grr_frontendserver_upload_num")
+  @stats.Timed("grr_frontendserver_upload_time")
+  def HandleUpload(self, request_comms, response_comms):
+    """Stores blobs posted to the upload endpoint.
+
+    Clients may send file buffers here instead of including them in their poll
+    bundles. Only messages for the TransferStore well known flow are accepted,
+    they are written to the blob store before we acknowledge the request. The
+    acknowledgement is an empty message list carrying the client's nonce. If
+    any blob can't be stored, the request fails without an acknowledgement so
+    the client sends the data again.
+
+    Args:
+       request_comms: A ClientCommunication rdfvalue with the blobs sent by the
+       client.
+
+       response_comms: A ClientCommunication rdfvalue which will hold the
+       acknowledgement.
+
+    Returns:
+       tuple of (source, message_count) where message_count is the number of
+       blobs received from the client with common name source.
+
+    Raises:
+       UploadError: if not all the blobs were stored.
+    """
+    messages, source, timestamp = self._communicator.DecodeMessages(
+        request_comms)
+
+    transfer_store = self.well_known_flows.get("TransferStore")
+    if transfer_store is None:
+      raise RuntimeError("TransferStore must run on the frontend to accept "
+                         "uploads.")
+
+    blob_messages = []
+    for msg in messages:
+      if msg.session_id.FlowName() != "TransferStore":
+        logging.warning("Dropping message for %s sent to the upload endpoint "
+                        "by %s.", msg.session_id, source)
+        continue
+
+      # TransferStore silently skips these, they must not be acknowledged.
+      if (msg.auth_state !=
+          rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED):
+        raise UploadError("Upload from %s is not authenticated." % source)
+      if not msg.payload.data:
+        raise UploadError("Empty blob uploaded by %s." % source)
+
+      blob_messages.append(msg)
+
+    start_time = time.time()
+    stored = transfer_store.ProcessMessages(blob_messages) or []
+    if blob_messages and not stored:
+      raise UploadError("No blobs stored for %s." % source)
+
+    missing = [digest for digest, exists in data_store.DB.BlobsExist(
+        stored, token=self.token).iteritems() if not exists]
+    if missing:
+      raise UploadError("Blobs %s uploaded by %s were not stored." %
+                        (missing, source))
+    self.admission_controller.blobstore_latency.Record(time.time() - start_time)
+    stats.STATS.IncrementCounter("grr_frontendserver_uploaded_blobs",
+                                 len(blob_messages))
+
+    self._communicator.EncodeMessages(rdf_flows.MessageList(),
+                                      response_comms,
+                                      destination=str(source),
+                                      timestamp=timestamp,
+                                      api_version=request_comms.api_version)
+
+    return source, len(blob_messages)
+
   def DrainTaskSchedulerQueueForClient(self, client, max_count):
     """Drains the client's Task Scheduler queue.
 
@@ -360,6 +689,7 @@ class FrontEndServer(object):
         queue=client.Queue(),
         limit=max_count,
         lease_seconds=self.message_expiry_time)
+    self.admission_controller.datastore_latency.Record(time.time() - start_time)
 
     initial_ttl = rdf_flows.GrrMessage().task_ttl
     check_before_sending = []
@@ -481,7 +811,11 @@ class FrontEndServer(object):
 
     for flow_name, msg_list in msgs_by_wkf.iteritems():
       wkf = self.well_known_flows[flow_name]
+      start_time = time.time()
       wkf.ProcessMessages(msg_list)
+      if flow_name == "TransferStore":
+        self.admission_controller.blobstore_latency.Record(time.time() -
+                                                           start_time)
 
     return result
 
@@ -514,5 +848,11 @@ class FrontendInit(registry.InitHook):
     stats.STATS.RegisterCounterMetric("grr_frontendserver_handle_num")
     stats.STATS.RegisterCounterMetric("grr_frontendserver_handle_throttled_num")
     stats.STATS.RegisterGaugeMetric("grr_frontendserver_throttle_setting", str)
+    stats.STATS.RegisterGaugeMetric("grr_frontendserver_load_estimate", float)
+    stats.STATS.RegisterGaugeMetric("grr_frontendserver_admission_factor",
+                                    float)
     stats.STATS.RegisterGaugeMetric("grr_frontendserver_client_cache_size", int)
     stats.STATS.RegisterCounterMetric("grr_messages_sent")
+    stats.STATS.RegisterEventMetric("grr_frontendserver_upload_time")
+    stats.STATS.RegisterCounterMetric("grr_frontendserver_upload_num")
+    stats.STATS.RegisterCounterMetric("grr_frontendserver_uploaded_blobs")
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+"""End to end throughput benchmarks for the frontend server.
+
+These benchmarks simulate a population of enrolled clients talking to a local
+FrontEndServer through real client and server communicators. Clients poll on a
+simulated clock, some of them are busy running flows and answer the tasks they
+receive with a mix of replies, status messages and file buffers, the rest are
+idle and poll rarely.
+
+For every scenario we report:
+
+- Polls per second the frontend handled.
+- p50/p99 latency of a poll as seen by the frontend.
+- CPU time spent per poll.
+- Top level data store operations per poll.
+
+The results are deterministic for a given seed, so they can be compared between
+revisions to catch frontend regressions before a rollout. Run with
+--labels=large.
+"""
+
+
+import heapq
+import random
+import resource
+import threading
+import time
+
+
+from grr.client import comms
+from grr.lib import aff4
+from grr.lib import config_lib
+from grr.lib import data_store
+from grr.lib import flags
+from grr.lib import front_end
+from grr.lib import queue_manager
+from grr.lib import queues
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+from grr.lib.aff4_objects import aff4_grr
+from grr.lib.data_stores import sqlite_data_store_test
+from grr.lib.rdfvalues import crypto as rdf_crypto
+from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import protodict as rdf_protodict
+
+
+class DataStoreOpCounter(object):
+  """A context which counts the top level calls made to the data store.
+
+  Calls made by the data store to itself (e.g. Set calling MultiSet) are not
+  counted separately.
+  """
+
+  METHODS = ["DeleteSubject", "DeleteSubjects", "Set", "MultiSet",
+             "MultiDeleteAttributes", "DeleteAttributes", "Resolve",
+             "ResolveMulti", "ResolvePrefix", "MultiResolvePrefix",
+             "ResolveRow", "ScanAttributes", "Transaction", "ReadBlobs",
+             "StoreBlobs", "BlobsExist"]
+
+  def __init__(self):
+    self.count = 0
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.db = None
+
+  def __enter__(self):
+    self.Start()
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.Stop()
+
+  def _Wrap(self, method):
+
+    def Counted(*args, **kwargs):
+      depth = getattr(self.local, "depth", 0)
+      if not depth:
+        with self.lock:
+          self.count += 1
+
+      self.local.depth = depth + 1
+      try:
+        return method(*args, **kwargs)
+      finally:
+        self.local.depth = depth
+
+    return Counted
+
+  def Start(self):
+    self.db = data_store.DB
+    for name in self.METHODS:
+      setattr(self.db, name, self._Wrap(getattr(self.db, name)))
+
+  def Stop(self):
+    # The wrappers are instance attributes, removing them restores the methods.
+    for name in self.METHODS:
+      self.db.__dict__.pop(name, None)
+
+
+class SimulatedClient(object):
+  """A client which talks to the frontend through its own communicator."""
+
+  def __init__(self, private_key, poll_interval, rand, reply_size=512,
+               replies_per_task=5, blob_size=64 * 1024):
+    self.communicator = comms.ClientCommunicator(private_key=private_key)
+    self.communicator.LoadServerCertificate(
+        server_certificate=config_lib.CONFIG["Frontend.certificate"],
+        ca_certificate=config_lib.CONFIG["CA.certificate"])
+    self.client_id = self.communicator.common_name
+    self.poll_interval = poll_interval
+    self.rand = rand
+    self.reply_size = reply_size
+    self.replies_per_task = replies_per_task
+    self.blob_size = blob_size
+
+    # Tasks received on the last poll which we answer on the next one.
+    self.pending_tasks = []
+    self.timestamp = None
+
+  def Enroll(self, token=None):
+    """Stores the client certificate so the frontend can talk to us."""
+    csr = self.communicator.GetCSR()
+    client_cert = rdf_crypto.RDFX509Cert.ClientCertFromCSR(csr)
+    with aff4.FACTORY.Create(self.client_id,
+                             aff4_grr.VFSGRRClient,
+                             token=token) as client:
+      client.Set(client.Schema.CERT, client_cert)
+
+  def _Data(self, size):
+    return "".join(chr(self.rand.randint(0, 255)) for _ in xrange(64)) * (
+        size / 64 + 1)
+
+  def _Answer(self, task, message_list):
+    """Adds the messages a real client would send in reply to a task."""
+    response_id = 1
+    if task.name == "TransferBuffer":
+      message_list.job.Append(
+          session_id=rdfvalue.SessionID(flow_name="TransferStore"),
+          payload=rdf_protodict.DataBlob(data=self._Data(self.blob_size)))
+
+    else:
+      for response_id in xrange(1, self.replies_per_task + 1):
+        message_list.job.Append(
+            session_id=task.session_id,
+            request_id=task.request_id,
+            response_id=response_id,
+            task_id=task.task_id,
+            payload=rdf_protodict.DataBlob(data=self._Data(self.reply_size)))
+
+    message_list.job.Append(
+        session_id=task.session_id,
+        request_id=task.request_id,
+        response_id=response_id + 1,
+        task_id=task.task_id,
+        type=rdf_flows.GrrMessage.Type.STATUS,
+        payload=rdf_flows.GrrStatus(
+            status=rdf_flows.GrrStatus.ReturnedStatus.OK))
+
+  def BuildRequest(self):
+    """Returns the ClientCommunication for the next poll."""
+    message_list = rdf_flows.MessageList()
+    for task in self.pending_tasks:
+      self._Answer(task, message_list)
+    self.pending_tasks = []
+
+    request_comms = rdf_flows.ClientCommunication()
+    self.timestamp = self.communicator.EncodeMessages(message_list,
+                                                      request_comms)
+    return request_comms
+
+  def ProcessResponse(self, response_comms):
+    messages, _, timestamp = self.communicator.DecodeMessages(response_comms)
+    if timestamp != self.timestamp:
+      raise RuntimeError("Frontend replied with the wrong nonce.")
+    self.pending_tasks.extend(messages)
+
+
+class FrontEndLoadGenerator(object):
+  """Drives a frontend with a population of simulated clients.
+
+  Busy clients have flows running on them: they start with a number of tasks
+  on their queue, poll every busy_poll_interval seconds and answer whatever
+  they received on the previous poll. Idle clients poll every
+  idle_poll_interval seconds starting at a random offset.
+
+  Polls are handed to the frontend in simulated time order but as fast as the
+  frontend can process them, so the measurements reflect frontend capacity.
+  """
+
+  TASK_MIX = ["ListDirectory", "StatFile", "TransferBuffer", "Find"]
+
+  def __init__(self, server, nr_clients=1000, busy_fraction=0.05,
+               tasks_per_busy_client=20, busy_poll_interval=1,
+               idle_poll_interval=600, key_bits=1024, seed=0, token=None):
+    self.server = server
+    self.token = token
+    self.rand = random.Random(seed)
+    self.clients = []
+
+    nr_busy = int(nr_clients * busy_fraction)
+    for i in xrange(nr_clients):
+      private_key = rdf_crypto.RSAPrivateKey.GenerateKey(bits=key_bits)
+      busy = i < nr_busy
+      client = SimulatedClient(
+          private_key,
+          busy_poll_interval if busy else idle_poll_interval,
+          self.rand)
+      client.Enroll(token=token)
+      if busy:
+        self.ScheduleTasks(client, tasks_per_busy_client)
+
+      self.clients.append(client)
+
+  def ScheduleTasks(self, client, count):
+    session_id = rdfvalue.SessionID(queue=queues.FLOWS,
+                                    flow_name="%X" % self.rand.getrandbits(32))
+    tasks = [rdf_flows.GrrMessage(session_id=session_id,
+                                  name=self.rand.choice(self.TASK_MIX),
+                                  request_id=i,
+                                  queue=client.client_id.Queue(),
+                                  payload=rdf_protodict.DataBlob(string="arg"))
+             for i in xrange(1, count + 1)]
+    with queue_manager.QueueManager(token=self.token) as manager:
+      manager.Schedule(tasks)
+
+  def Run(self, duration):
+    """Runs the simulation for duration simulated seconds.
+
+    Args:
+      duration: Simulated seconds to run for.
+
+    Returns:
+      A dict with the wall time, number of polls, latency percentiles, cpu time
+      per poll and data store operations per poll.
+    """
+    schedule = []
+    for i, client in enumerate(self.clients):
+      heapq.heappush(schedule,
+                     (self.rand.uniform(0, client.poll_interval), i))
+
+    latencies = []
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    with DataStoreOpCounter() as op_counter:
+      while schedule and schedule[0][0] < duration:
+        poll_time, i = heapq.heappop(schedule)
+        client = self.clients[i]
+
+        request_comms = client.BuildRequest()
+        response_comms = rdf_flows.ClientCommunication()
+
+        poll_start = time.time()
+        self.server.HandleMessageBundles(request_comms, response_comms)
+        latencies.append(time.time() - poll_start)
+
+        client.ProcessResponse(response_comms)
+        heapq.heappush(schedule, (poll_time + client.poll_interval, i))
+
+      data_store.DB.Flush()
+
+    wall_time = time.time() - start
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_time = ((end_usage.ru_utime - start_usage.ru_utime) +
+                (end_usage.ru_stime - start_usage.ru_stime))
+
+    polls = len(latencies) or 1
+    tracker = front_end.LatencyTracker(max_samples=polls)
+    for latency in latencies:
+      tracker.Record(latency)
+
+    return dict(wall_time=wall_time,
+                polls=len(latencies),
+                polls_per_second=len(latencies) / wall_time,
+                latency_p50=tracker.Percentile(50),
+                latency_p99=tracker.Percentile(99),
+                cpu_per_poll=cpu_time / polls,
+                ops_per_poll=float(op_counter.count) / polls)
+
+
+class FrontEndBenchmarks(test_lib.MicroBenchmarks):
+  """Frontend throughput benchmarks on the test data store."""
+
+  units = "s"
+
+  # Simulated seconds per scenario.
+  DURATION = 60
+
+  # The benchmark measures the frontend, not key generation.
+  KEY_BITS = 1024
+
+  def setUp(self):
+    super(FrontEndBenchmarks, self).setUp(
+        ["Polls", "Polls/s", "p50 (ms)", "p99 (ms)", "CPU/poll (ms)",
+         "DB ops/poll"],
+        ["<10", "<10", "<10", "<10", "<14", "<10"])
+    self.InitDatastore()
+
+    self.config_overrider = test_lib.ConfigOverrider({
+        "Frontend.admission_control": False})
+    self.config_overrider.Start()
+
+    self.server = front_end.FrontEndServer(
+        certificate=config_lib.CONFIG["Frontend.certificate"],
+        private_key=config_lib.CONFIG["PrivateKeys.server_key"],
+        threadpool_prefix="pool-%s" % self._testMethodName)
+
+  def tearDown(self):
+    # Every test gets a pool of its own, its threads must not outlive the test.
+    self.server.thread_pool.Stop()
+    self.config_overrider.Stop()
+    super(FrontEndBenchmarks, self).tearDown()
+    self.DestroyDatastore()
+
+  def InitDatastore(self):
+    """Initiates custom data store."""
+
+  def DestroyDatastore(self):
+    """Destroys custom data store."""
+
+  def RunScenario(self, name, **kwargs):
+    generator = FrontEndLoadGenerator(self.server,
+                                      key_bits=self.KEY_BITS,
+                                      token=self.token,
+                                      **kwargs)
+    result = generator.Run(self.DURATION)
+    self.AddResult(name, result["wall_time"], result["polls"],
+                   result["polls"],
+                   "%.1f" % result["polls_per_second"],
+                   "%.2f" % (result["latency_p50"] * 1e3),
+                   "%.2f" % (result["latency_p99"] * 1e3),
+                   "%.2f" % (result["cpu_per_poll"] * 1e3),
+                   "%.1f" % result["ops_per_poll"])
+    return result
+
+  def testIdleClients(self):
+    """Polls from a population where no flows are running."""
+    self.RunScenario("Idle 1000 clients", nr_clients=1000, busy_fraction=0)
+
+  def testMixedClients(self):
+    """Polls from a population with a few busy clients."""
+    self.RunScenario("Mixed 1000 clients", nr_clients=1000, busy_fraction=0.05)
+
+  def testLargePopulation(self):
+    """Polls from a large population with a few busy clients."""
+    self.RunScenario("Mixed 5000 clients", nr_clients=5000, busy_fraction=0.02)
+
+
+class SqliteFrontEndBenchmarks(sqlite_data_store_test.SqliteTestMixin,
+                               FrontEndBenchmarks):
+  """Frontend throughput benchmarks on the SQLite data store."""
+
+
+def main(args):
+  test_lib.main(args)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
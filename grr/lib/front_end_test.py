@@ -2,6 +2,7 @@
 """Unittest for grr frontend server."""
 
 
+import hashlib
 
 
 from grr.lib import communicator
@@ -17,6 +18,7 @@ from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import protodict as rdf_protodict
+from grr.lib.rdfvalues import stats as rdf_stats
 
 
 class SendingTestFlow(flow.GRRFlow):
@@ -349,6 +351,33 @@ class GRRFEServerTest(test_lib.FlowTestsBaseclass):
     result = self.server.UpdateAndCheckIfShouldThrottle(146)
     self.assertEqual(result, False)
 
+  def testLoadEstimateTracksThrottledBundles(self):
+    with test_lib.ConfigOverrider({"Frontend.load_estimate_decay": 0.5}):
+      self.assertEqual(self.server.UpdateLoadEstimate(True), 0.5)
+      self.assertEqual(self.server.UpdateLoadEstimate(True), 0.75)
+      self.assertEqual(self.server.UpdateLoadEstimate(False), 0.375)
+
+  def testPollHints(self):
+    self.server.load_estimate = 0.5
+
+    with test_lib.ConfigOverrider({"Frontend.poll_hint_max_delay": 600}):
+      # Clients without work are asked to back off.
+      self.assertEqual(self.server.GetPollHints([]), (0.5, 300))
+
+      # Clients we just gave work to are not slowed down.
+      self.assertEqual(self.server.GetPollHints([rdf_flows.GrrMessage()]),
+                       (0.5, 0))
+
+      # Neither are clients which asked to fast poll.
+      self.assertEqual(self.server.GetPollHints([], fastpoll=True), (0.5, 0))
+
+  def testPollHintsReflectAdmissionControl(self):
+    self.server.load_estimate = 0.0
+    self.server.admission_controller.admission_factor = 0.25
+
+    with test_lib.ConfigOverrider({"Frontend.poll_hint_max_delay": 600}):
+      self.assertEqual(self.server.GetPollHints([]), (0.75, 450))
+
   def testHandleMessageBundle(self):
     """Check that HandleMessageBundles() requeues messages if it failed.
 
@@ -401,6 +430,92 @@ class GRRFEServerTest(test_lib.FlowTestsBaseclass):
     # Since the server tried to send it, the ttl must be decremented
     self.assertEqual(tasks[0].task_ttl - new_tasks[0].task_ttl, 1)
 
+  def testHandleUpload(self):
+    """Check that uploaded blobs are stored and other messages dropped."""
+    client_id = rdf_client.ClientURN("C." + "2" * 16)
+    authenticated = rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED
+    messages = [
+        rdf_flows.GrrMessage(
+            session_id=rdfvalue.SessionID(flow_name="TransferStore"),
+            payload=rdf_protodict.DataBlob(data="uploaded blob"),
+            auth_state=authenticated),
+        rdf_flows.GrrMessage(
+            session_id=rdfvalue.SessionID(flow_name="Foreman"),
+            payload=rdf_protodict.DataBlob(data="some other data"),
+            auth_state=authenticated)
+    ]
+    encoded = []
+
+    class MockCommunicator(object):
+      """A fake that returns the upload messages."""
+
+      def DecodeMessages(self, *unused_args):
+        return (messages, client_id, 100)
+
+      def EncodeMessages(self, message_list, *unused_args, **kwargs):
+        encoded.append((message_list, kwargs))
+
+    self.server._communicator = MockCommunicator()
+    self.server.well_known_flows["TransferStore"] = (
+        flow.WellKnownFlow.GetAllWellKnownFlows(token=self.token)[
+            "TransferStore"])
+
+    source, count = self.server.HandleUpload(rdf_flows.ClientCommunication(),
+                                             rdf_flows.ClientCommunication())
+    self.assertEqual(source, client_id)
+    self.assertEqual(count, 1)
+
+    # Only the TransferStore blob made it into the blob store.
+    uploaded = hashlib.sha256("uploaded blob").hexdigest()
+    other = hashlib.sha256("some other data").hexdigest()
+    self.assertEqual(
+        data_store.DB.BlobsExist([uploaded, other], token=self.token),
+        {uploaded: True, other: False})
+
+    # The acknowledgement carries the client's nonce.
+    self.assertEqual(len(encoded), 1)
+    self.assertEqual(len(encoded[0][0]), 0)
+    self.assertEqual(encoded[0][1]["timestamp"], 100)
+
+  def testHandleUploadDoesNotAcknowledgeBlobsItCantStore(self):
+    client_id = rdf_client.ClientURN("C." + "2" * 16)
+    encoded = []
+
+    class MockCommunicator(object):
+      """A fake that returns the upload messages."""
+
+      def __init__(self, messages):
+        self.messages = messages
+
+      def DecodeMessages(self, *unused_args):
+        return (self.messages, client_id, 100)
+
+      def EncodeMessages(self, message_list, *unused_args, **kwargs):
+        encoded.append((message_list, kwargs))
+
+    self.server.well_known_flows["TransferStore"] = (
+        flow.WellKnownFlow.GetAllWellKnownFlows(token=self.token)[
+            "TransferStore"])
+
+    unauthenticated = rdf_flows.GrrMessage(
+        session_id=rdfvalue.SessionID(flow_name="TransferStore"),
+        payload=rdf_protodict.DataBlob(data="unauthenticated blob"),
+        auth_state=rdf_flows.GrrMessage.AuthorizationState.UNAUTHENTICATED)
+    empty = rdf_flows.GrrMessage(
+        session_id=rdfvalue.SessionID(flow_name="TransferStore"),
+        payload=rdf_protodict.DataBlob(data=""),
+        auth_state=rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
+
+    for message in [unauthenticated, empty]:
+      self.server._communicator = MockCommunicator([message])
+      self.assertRaises(front_end.UploadError, self.server.HandleUpload,
+                        rdf_flows.ClientCommunication(),
+                        rdf_flows.ClientCommunication())
+
+    self.assertEqual(encoded, [])
+    blob = hashlib.sha256("unauthenticated blob").hexdigest()
+    self.assertFalse(data_store.DB.BlobExists(blob, token=self.token))
+
   def _ScheduleResponseAndStatus(self, client_id, flow_id):
     with queue_manager.QueueManager(token=self.token) as flow_manager:
       # Schedule a response.
@@ -486,6 +601,157 @@ class GRRFEServerTest(test_lib.FlowTestsBaseclass):
         [True] * 2 + [False] * (rdf_flows.GrrMessage().task_ttl - 2))
 
 
+class LatencyTrackerTest(test_lib.GRRBaseTest):
+
+  def testPercentiles(self):
+    tracker = front_end.LatencyTracker(max_samples=100)
+    self.assertEqual(tracker.Percentile(99), 0)
+
+    for i in range(1, 201):
+      tracker.Record(i)
+
+    # Only the last 100 samples are kept.
+    self.assertEqual(tracker.Percentile(0), 101)
+    self.assertEqual(tracker.Percentile(50), 150)
+    self.assertEqual(tracker.Percentile(99), 199)
+    self.assertEqual(tracker.Percentile(100), 200)
+
+
+class AdmissionControllerTest(test_lib.GRRBaseTest):
+  """Tests the cluster wide admission control."""
+
+  def setUp(self):
+    super(AdmissionControllerTest, self).setUp()
+    self.config_overrider = test_lib.ConfigOverrider({
+        "Frontend.max_shard_backlog": 10,
+        "Frontend.max_datastore_latency": 1.0,
+        "Frontend.max_blobstore_latency": 2.0,
+        "Worker.queue_shards": 2
+    })
+    self.config_overrider.Start()
+
+  def tearDown(self):
+    self.config_overrider.Stop()
+    super(AdmissionControllerTest, self).tearDown()
+
+  def _Health(self, shard=0, backlog=0, ds_latency=0, bs_latency=0, age=0):
+    return rdf_stats.FrontendHealth(
+        timestamp=rdfvalue.RDFDatetime().Now() - rdfvalue.Duration(
+            "%ds" % age),
+        backlog_shard=shard,
+        backlog_size=backlog,
+        datastore_latency_p99=ds_latency,
+        blobstore_latency_p99=bs_latency)
+
+  def testAdmissionFactor(self):
+    controller = front_end.AdmissionController(token=self.token)
+    self.assertEqual(controller.ComputeAdmissionFactor([]), 1.0)
+
+    # Everything within limits.
+    self.assertEqual(
+        controller.ComputeAdmissionFactor([self._Health(backlog=5,
+                                                        ds_latency=0.5,
+                                                        bs_latency=1)]), 1.0)
+
+    # The worst signal determines the factor.
+    self.assertEqual(
+        controller.ComputeAdmissionFactor([self._Health(backlog=20,
+                                                        ds_latency=4,
+                                                        bs_latency=1)]), 0.25)
+
+    # The newest sample of a shard wins.
+    self.assertEqual(
+        controller.ComputeAdmissionFactor([self._Health(shard=1, backlog=40),
+                                           self._Health(shard=1,
+                                                        backlog=20,
+                                                        age=10)]), 0.25)
+
+  def testPublishAndReadHealth(self):
+    controllers = []
+    for i in range(3):
+      controller = front_end.AdmissionController(token=self.token,
+                                                 frontend_id="fe%d" % i)
+      controller.next_backlog_shard = i
+      controllers.append(controller)
+
+    with queue_manager.QueueManager(token=self.token) as manager:
+      for i in range(30):
+        manager.QueueNotification(session_id=rdfvalue.SessionID(
+            flow_name="Flow%d" % i))
+
+    with test_lib.ConfigOverrider({"Frontend.max_shard_backlog": 100}):
+      controllers[0].datastore_latency.Record(4)
+      for controller in controllers:
+        controller.PublishHealth()
+
+      records = controllers[0].ReadClusterHealth()
+      self.assertEqual(sorted(r.frontend_id for r in records),
+                       ["fe0", "fe1", "fe2"])
+
+      # Together, the frontends sampled all the shards.
+      backlogs = dict((r.backlog_shard, r.backlog_size) for r in records)
+      self.assertEqual(sorted(backlogs), [0, 1])
+      self.assertEqual(sum(backlogs.values()), 30)
+
+      # The median latency is used so one slow frontend does not throttle the
+      # whole cluster.
+      self.assertEqual(controllers[0].Update(), 1.0)
+
+      controllers[1].datastore_latency.Record(4)
+      controllers[1].PublishHealth()
+      self.assertEqual(controllers[0].Update(), 0.25)
+
+  def testStaleRecordsAreIgnored(self):
+    controller = front_end.AdmissionController(token=self.token,
+                                               frontend_id="fe1")
+    with test_lib.FakeTime(1000):
+      controller.PublishHealth()
+
+    with test_lib.FakeTime(1000 + 3600):
+      self.assertEqual(controller.ReadClusterHealth(), [])
+
+  def testShardBacklogIsOnlyCountedUpToTheLimit(self):
+    with test_lib.ConfigOverrider({"Worker.queue_shards": 1}):
+      with queue_manager.QueueManager(token=self.token) as manager:
+        for i in range(30):
+          manager.QueueNotification(session_id=rdfvalue.SessionID(
+              flow_name="Flow%d" % i))
+
+      controller = front_end.AdmissionController(token=self.token)
+      health = controller.PublishHealth()
+
+    # The limit is 10, so counting stops at 20.
+    self.assertEqual(health.backlog_size, 20)
+    self.assertEqual(controller.ComputeAdmissionFactor([health]), 0.5)
+
+  def testExpiredRecordsAreDeleted(self):
+    with test_lib.FakeTime(1000):
+      front_end.AdmissionController(token=self.token,
+                                    frontend_id="fe1").PublishHealth()
+
+    with test_lib.FakeTime(1000 + 3600):
+      controller = front_end.AdmissionController(token=self.token,
+                                                 frontend_id="fe2")
+      controller.PublishHealth()
+      self.assertEqual([r.frontend_id for r in controller.ReadClusterHealth()],
+                       ["fe2"])
+
+    attributes = [attribute for attribute, _, _ in data_store.DB.ResolvePrefix(
+        front_end.AdmissionController.HEALTH_URN,
+        front_end.AdmissionController.HEALTH_PREFIX,
+        token=self.token)]
+    self.assertEqual(attributes, ["health:fe2"])
+
+  def testAdmitTasks(self):
+    controller = front_end.AdmissionController(token=self.token)
+    self.assertEqual(controller.AdmitTasks(100), 100)
+    self.assertEqual(controller.AdmitTasks(-5), 0)
+
+    controller.admission_factor = 0.1
+    self.assertEqual(controller.AdmitTasks(100), 10)
+    self.assertEqual(controller.AdmitTasks(1), 1)
+
+
 def main(args):
   test_lib.main(args)
 
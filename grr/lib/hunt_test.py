@@ -16,6 +16,7 @@ from grr.lib import queues
 from grr.lib import rdfvalue
 from grr.lib import test_lib
 from grr.lib import utils
+from grr.lib.hunts import implementation
 from grr.server import foreman as rdf_foreman
 
 
@@ -494,6 +495,70 @@ class HuntTest(test_lib.FlowTestsBaseclass):
     # All of the clients that have the file should still finish eventually.
     self.assertEqual(finished, 5)
 
+  def testClientCountersMatchClientCollections(self):
+    client_ids = self.SetupClients(10)
+
+    client_rule_set = rdf_foreman.ForemanClientRuleSet(rules=[
+        rdf_foreman.ForemanClientRule(
+            rule_type=rdf_foreman.ForemanClientRule.Type.REGEX,
+            regex=rdf_foreman.ForemanRegexClientRule(
+                attribute_name="GRR client",
+                attribute_regex="GRR"))
+    ])
+
+    with test_lib.FakeTime(100):
+      with hunts.GRRHunt.StartHunt(hunt_name="BrokenSampleHunt",
+                                   client_rule_set=client_rule_set,
+                                   client_rate=0,
+                                   token=self.token) as hunt:
+        hunt.GetRunner().Start()
+
+    foreman = aff4.FACTORY.Open("aff4:/foreman", mode="rw", token=self.token)
+    client_mock = test_lib.SampleHuntMock()
+    for i, client_id in enumerate(client_ids):
+      with test_lib.FakeTime(130 + i * 10):
+        foreman.AssignTasksToClient(client_id)
+        test_lib.TestHuntHelper(client_mock, [client_id], False, self.token)
+
+    hunt_obj = aff4.FACTORY.Open(hunt.session_id, mode="r", token=self.token)
+    self.assertEqual(hunt_obj.GetClientsCounts(), (10, 5, 5))
+
+    # Every client was started, and possibly completed, in a second of its
+    # own.
+    histograms = hunt_obj.GetClientsHistograms()
+    counters = implementation.HuntClientCounters
+    started = histograms[counters.STARTED]
+    completed = histograms[counters.COMPLETED]
+    self.assertEqual(started, dict((130 + i * 10, 1) for i in range(10)))
+    self.assertEqual(sum(completed.values()), 5)
+    self.assertTrue(set(completed).issubset(started))
+
+    # Hunts without counters count their clients from the collections.
+    hunt_obj.state.context.has_client_counters = False
+    self.assertIsNone(hunt_obj.GetClientsHistograms())
+    self.assertEqual(hunt_obj.GetClientsCounts(), (10, 5, 5))
+
+  def testClientCounterHistogramBucketsGrowWithHuntAge(self):
+    counters = implementation.HuntClientCounters(
+        "aff4:/hunts/H:123456",
+        start_time=rdfvalue.RDFDatetime().FromSecondsFromEpoch(1000),
+        token=self.token)
+
+    # Buckets are a second wide at first, then twice as wide per doubling.
+    self.assertEqual(counters.GetBucket(1150), 1150)
+    self.assertEqual(counters.GetBucketEnd(1150), 1151)
+    self.assertEqual(counters.GetBucket(1251), 1250)
+    self.assertEqual(counters.GetBucketEnd(1250), 1252)
+    self.assertEqual(counters.GetBucket(2005), 2000)
+    self.assertEqual(counters.GetBucketEnd(2000), 2008)
+    # Clients with clocks behind the hunt's creation go into the first bucket.
+    self.assertEqual(counters.GetBucket(900), 1000)
+
+    # A week long hunt has less than 1500 buckets, not one per second.
+    buckets = set(counters.GetBucket(1000 + offset)
+                  for offset in xrange(0, 7 * 24 * 3600))
+    self.assertLess(len(buckets), 1500)
+
   def testHuntNotifications(self):
     """This tests the Hunt notification event."""
     TestHuntListener.received_events = []
@@ -608,6 +673,71 @@ class HuntTest(test_lib.FlowTestsBaseclass):
           worker_mock.Simulate()
       self.assertEqual(len(DummyHunt.client_ids), 1)
 
+  def _StartDummyHuntAndAssignClients(self, client_ids, client_rate, start_time,
+                                      clients_time):
+    client_rule_set = rdf_foreman.ForemanClientRuleSet(rules=[
+        rdf_foreman.ForemanClientRule(
+            rule_type=rdf_foreman.ForemanClientRule.Type.REGEX,
+            regex=rdf_foreman.ForemanRegexClientRule(
+                attribute_name="GRR client",
+                attribute_regex="GRR"))
+    ])
+
+    with test_lib.FakeTime(start_time):
+      with hunts.GRRHunt.StartHunt(hunt_name="DummyHunt",
+                                   client_rule_set=client_rule_set,
+                                   client_rate=client_rate,
+                                   token=self.token) as hunt:
+        hunt.Run()
+
+    with test_lib.FakeTime(clients_time):
+      foreman = aff4.FACTORY.Open("aff4:/foreman", mode="rw", token=self.token)
+      for client_id in client_ids:
+        foreman.AssignTasksToClient(client_id)
+
+    return test_lib.MockWorker(check_flow_errors=True,
+                               queues=queues.HUNTS,
+                               token=self.token)
+
+  def testHuntClientRateDoesNotCatchUpAfterIdlePeriod(self):
+    """Check that clients arriving late are not all started at once."""
+    client_ids = self.SetupClients(10)
+
+    # The clients only show up an hour after the hunt was started.
+    clients_time = 10 + 3600
+    worker_mock = self._StartDummyHuntAndAssignClients(
+        client_ids, client_rate=1, start_time=10, clients_time=clients_time)
+
+    # The start saved up while the hunt was idle is used right away.
+    with test_lib.FakeTime(clients_time):
+      worker_mock.Simulate()
+    self.assertEqual(len(DummyHunt.client_ids), 2)
+
+    with test_lib.FakeTime(clients_time + 59):
+      worker_mock.Simulate()
+    self.assertEqual(len(DummyHunt.client_ids), 2)
+
+    with test_lib.FakeTime(clients_time + 61):
+      worker_mock.Simulate()
+    self.assertEqual(len(DummyHunt.client_ids), 3)
+
+  def testMaxClientRateLimitsUnlimitedHunts(self):
+    client_ids = self.SetupClients(5)
+
+    with test_lib.ConfigOverrider({"Hunt.max_client_rate": 2}):
+      worker_mock = self._StartDummyHuntAndAssignClients(client_ids,
+                                                         client_rate=0,
+                                                         start_time=10,
+                                                         clients_time=10)
+
+      with test_lib.FakeTime(10):
+        worker_mock.Simulate()
+      self.assertEqual(len(DummyHunt.client_ids), 1)
+
+      with test_lib.FakeTime(41):
+        worker_mock.Simulate()
+      self.assertEqual(len(DummyHunt.client_ids), 2)
+
 
 def main(argv):
   test_lib.GrrTestProgram(argv=argv)
@@ -16,15 +16,19 @@ For this reason a hunt has its own runner - the HuntRunner.
 
 """
 
+import math
 import threading
+import time
 
 import logging
 
 from grr.lib import access_control
 from grr.lib import aff4
+from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import flow
 from grr.lib import flow_runner
+from grr.lib import front_end
 from grr.lib import output_plugin
 from grr.lib import queue_manager
 from grr.lib import rdfvalue
@@ -92,6 +96,280 @@ class HuntResultsMetadata(aff4.AFF4Object):
         versioned=False)
 
 
+class HuntClientScheduler(object):
+  """Decides when new clients of a hunt are started.
+
+  Client starts are spaced out by a token bucket which refills at the hunt's
+  target rate. While no clients arrive, the bucket saves up at most
+  Hunt.client_start_burst tokens on top of the one being refilled. The bucket
+  is kept in the hunt's context (as the time the next token becomes
+  available), so it's shared by all workers processing the hunt.
+
+  The target rate is the hunt's client_rate, capped by Hunt.max_client_rate
+  and scaled down by the cluster's admission factor when frontend admission
+  control is enabled. Since the bucket never holds more than a few tokens,
+  clients that poll together after an outage are started gradually instead of
+  catching up on all the start slots missed in the meantime.
+  """
+
+  # Client starts decay out of the measured start rate with this time constant
+  # in seconds.
+  RATE_WINDOW = 60.0
+
+  _admission_lock = threading.Lock()
+  _admission_factor = 1.0
+  _admission_factor_updated = 0
+
+  def __init__(self, context, token=None):
+    self.context = context
+    self.token = token
+
+  @classmethod
+  def GetAdmissionFactor(cls, token=None):
+    """Returns the share of the usual work the cluster can take on right now."""
+    if not config_lib.CONFIG["Frontend.admission_control"]:
+      return 1.0
+
+    now = time.time()
+    with cls._admission_lock:
+      if (now - cls._admission_factor_updated <
+          config_lib.CONFIG["Frontend.health_update_interval"]):
+        return cls._admission_factor
+
+      cls._admission_factor_updated = now
+      try:
+        controller = front_end.AdmissionController(token=token)
+        cls._admission_factor = controller.ComputeAdmissionFactor(
+            controller.ReadClusterHealth())
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception("Unable to read cluster health: %s", e)
+
+      return cls._admission_factor
+
+  def GetTargetRate(self):
+    """Returns the number of clients to start per minute, 0 for no limit."""
+    rates = [rate for rate in (self.context.args.client_rate,
+                               config_lib.CONFIG["Hunt.max_client_rate"])
+             if rate > 0]
+    if not rates:
+      return 0
+
+    return min(rates) * self.GetAdmissionFactor(token=self.token)
+
+  def GetCurrentRate(self, now=None):
+    """Returns the number of clients started per minute recently."""
+    rate = self.context.get("client_start_rate", 0.0)
+    if not rate:
+      return 0.0
+
+    now = now or rdfvalue.RDFDatetime().Now()
+    elapsed = max(0, int(now) - self.context.last_client_start) / 1e6
+    return rate * math.exp(-elapsed / self.RATE_WINDOW)
+
+  def ScheduleClient(self, now=None):
+    """Takes a token from the bucket for a new client.
+
+    Args:
+      now: The current time, as RDFDatetime.
+
+    Returns:
+      The time the client should be started at or None if the hunt isn't rate
+      limited.
+    """
+    rate = self.GetTargetRate()
+    if rate <= 0:
+      return None
+
+    now = now or rdfvalue.RDFDatetime().Now()
+    interval = 60.0 / rate
+    burst = max(0, config_lib.CONFIG["Hunt.client_start_burst"])
+
+    # While no clients arrive the bucket fills up, but only to its capacity.
+    next_token = max(self.context.next_client_due, now - burst * interval)
+    self.context.next_client_due = next_token + interval
+
+    return max(now, next_token)
+
+  def RecordClientStart(self, now=None):
+    """Accounts for a started client in the current rate."""
+    now = now or rdfvalue.RDFDatetime().Now()
+    self.context.client_start_rate = (self.GetCurrentRate(now) +
+                                      60.0 / self.RATE_WINDOW)
+    self.context.last_client_start = int(now)
+
+
+class HuntClientCounters(object):
+  """Counts the clients of a hunt without reading its client collections.
+
+  Each registered client increments a counter in one of NUM_SHARDS rows, picked
+  at random so that workers processing the same hunt rarely wait for each
+  other's transactions. Reading the counts therefore takes NUM_SHARDS rows and
+  a fixed number of attributes, however many clients the hunt has.
+
+  Client starts and completions are also added to histograms, binned by the
+  time since the hunt started. Buckets are a second wide for the first
+  2 * FINE_BUCKETS seconds and get twice as wide whenever the hunt's age
+  doubles after that. A histogram therefore has FINE_BUCKETS buckets per
+  doubling of the hunt's age, and every bucket spans at most 1 / FINE_BUCKETS
+  of the time since the start.
+  """
+
+  NUM_SHARDS = 16
+
+  FINE_BUCKETS = 100
+
+  STARTED = "started"
+  COMPLETED = "completed"
+  ERRORS = "errors"
+
+  ATTRIBUTE_PREFIX = "aff4:hunt_clients/"
+  COUNT_ATTRIBUTE = ATTRIBUTE_PREFIX + "count/%s"
+  HISTOGRAM_ATTRIBUTE = ATTRIBUTE_PREFIX + "histogram/%s/%d"
+
+  def __init__(self, hunt_urn, start_time=None, token=None):
+    """Constructor.
+
+    Args:
+      hunt_urn: The urn of the hunt.
+      start_time: The RDFDatetime the hunt was created at, the origin of the
+        histogram buckets.
+      token: The security token to use.
+    """
+    self.urn = rdfvalue.RDFURN(hunt_urn).Add("ClientCounters")
+    self.start = start_time.AsSecondsFromEpoch() if start_time else 0
+    self.token = token
+
+  @property
+  def shard_urns(self):
+    return [self.urn.Add("%02d" % shard) for shard in range(self.NUM_SHARDS)]
+
+  def _BucketWidth(self, offset):
+    width = 1
+    while offset >= 2 * self.FINE_BUCKETS * width:
+      width *= 2
+    return width
+
+  def GetBucket(self, seconds):
+    """Returns the start of the histogram bucket seconds since epoch are in."""
+    offset = max(0, seconds - self.start)
+    width = self._BucketWidth(offset)
+    return self.start + offset // width * width
+
+  def GetBucketEnd(self, bucket):
+    """Returns the end of the histogram bucket starting at bucket."""
+    return bucket + self._BucketWidth(bucket - self.start)
+
+  def Increment(self, kind, timestamp=None, histogram=True):
+    """Counts another client.
+
+    Args:
+      kind: One of STARTED, COMPLETED or ERRORS.
+      timestamp: The time the client got to this state, as RDFDatetime.
+      histogram: If True, the client is also added to the kind's histogram.
+    """
+    attributes = [self.COUNT_ATTRIBUTE % kind]
+    if histogram:
+      timestamp = timestamp or rdfvalue.RDFDatetime().Now()
+      bucket = self.GetBucket(timestamp.AsSecondsFromEpoch())
+      attributes.append(self.HISTOGRAM_ATTRIBUTE % (kind, bucket))
+
+    shard = utils.PRNG.GetULong() % self.NUM_SHARDS
+    data_store.DB.RetryWrapper(self.shard_urns[shard],
+                               self._IncrementAttributes,
+                               attributes=attributes,
+                               token=self.token)
+
+  def _IncrementAttributes(self, transaction, attributes=None):
+    for attribute in attributes:
+      value, _ = transaction.Resolve(attribute)
+      transaction.Set(attribute, int(value or 0) + 1)
+
+  def _ReadShards(self, prefix):
+    """Sums up the values of all shards by attribute, for attribute prefix."""
+    totals = {}
+    for _, values in data_store.DB.MultiResolvePrefix(
+        self.shard_urns, prefix, token=self.token):
+      for attribute, value, _ in values:
+        totals[attribute] = totals.get(attribute, 0) + int(value)
+
+    return totals
+
+  def GetCounts(self):
+    """Returns the numbers of started, completed and failed clients."""
+    totals = self._ReadShards(self.ATTRIBUTE_PREFIX + "count/")
+    return tuple(totals.get(self.COUNT_ATTRIBUTE % kind, 0)
+                 for kind in (self.STARTED, self.COMPLETED, self.ERRORS))
+
+  def GetHistograms(self):
+    """Returns the clients started and completed per histogram bucket.
+
+    Returns:
+      A dict with the STARTED and COMPLETED histograms, each a dict mapping the
+      start of a bucket in seconds since the epoch to a number of clients.
+    """
+    histograms = {self.STARTED: {}, self.COMPLETED: {}}
+    prefix = self.ATTRIBUTE_PREFIX + "histogram/"
+    for attribute, count in self._ReadShards(prefix).iteritems():
+      kind, bucket = attribute[len(prefix):].split("/")
+      if kind in histograms:
+        histograms[kind][int(bucket)] = count
+
+    return histograms
+
+
+class HuntClientResourcesStats(object):
+  """Resource usage stats of a hunt's clients, kept in sharded partials.
+
+  Each client's resources are added to the ClientResourcesStats of one of
+  NUM_SHARDS rows, picked at random like in HuntClientCounters, so client
+  completions don't contend on the hunt object. The partials are merged when
+  the stats are read. Their distributions are summarized by mergeable
+  quantile sketches, so partials stay small however many clients report.
+  """
+
+  NUM_SHARDS = 16
+
+  STATS_ATTRIBUTE = "aff4:hunt_resources/stats"
+
+  def __init__(self, hunt_urn, token=None):
+    self.urn = rdfvalue.RDFURN(hunt_urn).Add("ResourcesStats")
+    self.token = token
+
+  @property
+  def shard_urns(self):
+    return [self.urn.Add("%02d" % shard) for shard in range(self.NUM_SHARDS)]
+
+  def RegisterResources(self, client_resources):
+    """Adds the resources used by a client to one of the partials."""
+    shard = utils.PRNG.GetULong() % self.NUM_SHARDS
+    data_store.DB.RetryWrapper(self.shard_urns[shard],
+                               self._RegisterResources,
+                               client_resources=client_resources,
+                               token=self.token)
+
+  def _RegisterResources(self, transaction, client_resources=None):
+    value, _ = transaction.Resolve(self.STATS_ATTRIBUTE)
+    partial = rdf_stats.ClientResourcesStats(value or None)
+    partial.RegisterResources(client_resources)
+    partial.user_cpu_stats.quantiles.RegisterValue(
+        client_resources.cpu_usage.user_cpu_time)
+    partial.system_cpu_stats.quantiles.RegisterValue(
+        client_resources.cpu_usage.system_cpu_time)
+    partial.network_bytes_sent_stats.quantiles.RegisterValue(
+        client_resources.network_bytes_sent)
+    transaction.Set(self.STATS_ATTRIBUTE, partial)
+
+  def GetStats(self):
+    """Returns the merged ClientResourcesStats of all partials."""
+    result = rdf_stats.ClientResourcesStats()
+    for _, values in data_store.DB.MultiResolvePrefix(
+        self.shard_urns, self.STATS_ATTRIBUTE, token=self.token):
+      for _, value, _ in values:
+        result.Merge(rdf_stats.ClientResourcesStats(value))
+
+    return result
+
+
 class HuntRunner(flow_runner.FlowRunner):
   """The runner for hunts.
 
@@ -110,18 +388,18 @@ class HuntRunner(flow_runner.FlowRunner):
   process_requests_in_order = False
 
   def _AddClient(self, client_id):
-    next_client_due = self.flow_obj.state.context.next_client_due
-    if self.args.client_rate > 0:
-      self.flow_obj.state.context.next_client_due = (
-          next_client_due + 60 / self.args.client_rate)
+    scheduler = HuntClientScheduler(self.context, token=self.token)
+    start_time = scheduler.ScheduleClient()
+    if start_time is not None:
       self.CallState(messages=[client_id],
                      next_state="RegisterClient",
                      client_id=client_id,
-                     start_time=next_client_due)
+                     start_time=start_time)
     else:
       self._RegisterAndRunClient(client_id)
 
   def _RegisterAndRunClient(self, client_id):
+    HuntClientScheduler(self.context, token=self.token).RecordClientStart()
     self.flow_obj.RegisterClient(client_id)
     self.RunStateMethod("RunClient", direct_response=[client_id])
 
@@ -246,6 +524,12 @@ class HuntRunner(flow_runner.FlowRunner):
         create_time=rdfvalue.RDFDatetime().Now(),
         creator=self.token.username,
         expires=args.expiry_time.Expiry(),
+        # Hunts created before HuntClientCounters existed have to count their
+        # clients by reading the client collections.
+        has_client_counters=True,
+        # Likewise, older hunts keep their resource usage stats in usage_stats
+        # instead of HuntClientResourcesStats.
+        has_resources_stats_shards=True,
         # If not None, kill-stuck-flow notification is scheduled at the given
         # time.
         kill_timestamp=None,
@@ -633,11 +917,28 @@ class GRRHunt(flow.GRRFlow):
   def _ClientSymlinkUrn(self, client_id):
     return client_id.Add("flows").Add("%s:hunt" % (self.urn.Basename()))
 
+  @property
+  def client_counters(self):
+    """The HuntClientCounters of this hunt or None for older hunts."""
+    if not self.state.context.get("has_client_counters"):
+      return None
+
+    return HuntClientCounters(self.urn,
+                              start_time=self.state.context.create_time,
+                              token=self.token)
+
+  def _IncrementClientCounter(self, kind, histogram=True):
+    counters = self.client_counters
+    if counters is not None:
+      counters.Increment(kind, histogram=histogram)
+
   def RegisterClient(self, client_urn):
     self._AddURNToCollection(client_urn, self.all_clients_collection_urn)
+    self._IncrementClientCounter(HuntClientCounters.STARTED)
 
   def RegisterCompletedClient(self, client_urn):
     self._AddURNToCollection(client_urn, self.completed_clients_collection_urn)
+    self._IncrementClientCounter(HuntClientCounters.COMPLETED)
 
   def RegisterClientWithResults(self, client_urn):
     self._AddURNToCollection(client_urn,
@@ -649,6 +950,7 @@ class GRRHunt(flow.GRRFlow):
       error.log_message = utils.SmartUnicode(log_message)
 
     self._AddHuntErrorToCollection(error, self.clients_errors_collection_urn)
+    self._IncrementClientCounter(HuntClientCounters.ERRORS, histogram=False)
 
   def OnDelete(self, deletion_pool=None):
     super(GRRHunt, self).OnDelete(deletion_pool=deletion_pool)
@@ -993,6 +1295,11 @@ class GRRHunt(flow.GRRFlow):
     """
 
   def GetClientsCounts(self):
+    """Returns the numbers of started, completed and failed clients."""
+    counters = self.client_counters
+    if counters is not None:
+      return counters.GetCounts()
+
     collections = aff4.FACTORY.MultiOpen([self.all_clients_collection_urn,
                                           self.completed_clients_collection_urn,
                                           self.clients_errors_collection_urn],
@@ -1013,6 +1320,32 @@ class GRRHunt(flow.GRRFlow):
 
     return all_clients_count, completed_clients_count, clients_errors_count
 
+  def GetClientsHistograms(self):
+    """Returns the clients started and completed over time.
+
+    Returns:
+      A dict as returned by HuntClientCounters.GetHistograms() or None if the
+      hunt doesn't keep client counters.
+    """
+    counters = self.client_counters
+    if counters is not None:
+      return counters.GetHistograms()
+
+  def RegisterClientResources(self, client_resources):
+    """Adds the resources used by a client to the hunt's stats."""
+    if self.state.context.get("has_resources_stats_shards"):
+      HuntClientResourcesStats(self.urn, token=self.token).RegisterResources(
+          client_resources)
+    else:
+      self.state.context.usage_stats.RegisterResources(client_resources)
+
+  def GetClientResourcesStats(self):
+    """Returns the ClientResourcesStats of all clients of this hunt."""
+    if self.state.context.get("has_resources_stats_shards"):
+      return HuntClientResourcesStats(self.urn, token=self.token).GetStats()
+
+    return self.state.context.usage_stats
+
   def GetClientsErrors(self, client_id=None):
     errors = self._GetCollectionItems(self.clients_errors_collection_urn)
     if not client_id:
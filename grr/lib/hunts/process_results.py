@@ -2,13 +2,17 @@
 """Cron job to process hunt results.
 """
 
+import collections
 import logging
+import threading
+import time
 
 from grr.lib import aff4
 from grr.lib import flow
 from grr.lib import output_plugin
 from grr.lib import rdfvalue
 from grr.lib import stats
+from grr.lib import threadpool
 from grr.lib import utils
 
 from grr.lib.aff4_objects import cronjobs
@@ -43,6 +47,350 @@ class ResultsProcessingError(Exception):
     return "\n".join(messages)
 
 
+class ResultsBatch(object):
+  """Results claimed together, along with their notification ids."""
+
+  def __init__(self, record_ids, results):
+    self.record_ids = record_ids
+    self.results = results
+    # Number of plugins that haven't processed this batch yet.
+    self.remaining = 0
+    # Set if a plugin skipped the batch or its state couldn't be stored, the
+    # claims are released then.
+    self.skipped = False
+
+
+class OutputPluginPipeline(object):
+  """Feeds batches of results to a single output plugin.
+
+  A pipeline is kept for a whole cron flow run. Batches are queued in the
+  pipeline and processed in order by a task on a shared thread pool, with at
+  most one task per pipeline at a time, so a slow plugin only holds up its own
+  queue. After every batch the plugin is flushed and done_callback is called,
+  so that its state can be stored independently of the other plugins.
+
+  Results are passed to ProcessResponses in chunks that are sized after the
+  plugin's observed throughput, so that a call takes about TARGET_BATCH_TIME
+  seconds. The number of results queued but not yet processed by the plugin
+  is exported as the hunt_output_plugin_lag metric.
+  """
+
+  MAX_QUEUED_BATCHES = 4
+  INITIAL_BATCH_SIZE = 1000
+  MIN_BATCH_SIZE = 10
+  MAX_BATCH_SIZE = 10000
+  TARGET_BATCH_TIME = 5.0
+
+  def __init__(self,
+               plugin_def,
+               plugin,
+               pool,
+               condition,
+               done_callback,
+               should_stop=lambda: False):
+    """Constructor.
+
+    Args:
+      plugin_def: The plugin's OutputPluginDescriptor.
+      plugin: The output plugin.
+      pool: The thread pool to run the plugin on.
+      condition: A threading.Condition that is notified whenever a batch is
+        taken off the queue or the pipeline becomes idle.
+      done_callback: Called with (pipeline, batch, processed, exception) on
+        the pool thread after every batch.
+      should_stop: Checked before every batch. If it returns True, the batch
+        is skipped.
+    """
+    self.plugin_def = plugin_def
+    self.plugin = plugin
+    self.batch_size = self.INITIAL_BATCH_SIZE
+    self.lag = 0
+    # Incremented whenever a batch is taken off the queue or the pipeline
+    # becomes idle, guarded by condition.
+    self.progress = 0
+
+    self._pool = pool
+    self._condition = condition
+    self._done_callback = done_callback
+    self._should_stop = should_stop
+    self._lag_lock = threading.Lock()
+    self._batches = collections.deque()
+    self._running = False
+
+  def IsFull(self):
+    with self._condition:
+      return len(self._batches) >= self.MAX_QUEUED_BATCHES
+
+  def IsIdle(self):
+    with self._condition:
+      return not self._running
+
+  def Offer(self, batch):
+    """Queues a batch, callers should check IsFull() first."""
+    self._UpdateLag(len(batch.results))
+    with self._condition:
+      self._batches.append(batch)
+      start = not self._running
+      self._running = True
+
+    if start:
+      self._pool.AddTask(target=self._Run,
+                         args=(),
+                         name="OutputPluginPipeline_%s" %
+                         self.plugin_def.plugin_name,
+                         blocking=True,
+                         inline=False)
+
+  def _UpdateLag(self, delta):
+    with self._lag_lock:
+      self.lag += delta
+      stats.STATS.SetGaugeValue("hunt_output_plugin_lag",
+                                self.lag,
+                                fields=[self.plugin_def.plugin_name])
+
+  def _AdaptBatchSize(self, batch_size, elapsed):
+    if elapsed > 0:
+      target_size = int(batch_size * self.TARGET_BATCH_TIME / elapsed)
+    else:
+      target_size = self.MAX_BATCH_SIZE
+
+    # Only move halfway towards the target to dampen outliers.
+    self.batch_size = max(self.MIN_BATCH_SIZE,
+                          min(self.MAX_BATCH_SIZE,
+                              (self.batch_size + target_size) / 2))
+
+  def _Process(self, results):
+    """Runs the plugin on results and flushes it, returns any exception."""
+    try:
+      offset = 0
+      while offset < len(results):
+        chunk = results[offset:offset + self.batch_size]
+        start = time.time()
+        self.plugin.ProcessResponses(chunk)
+        elapsed = time.time() - start
+        self._AdaptBatchSize(len(chunk), elapsed)
+        stats.STATS.RecordEvent("hunt_output_plugin_batch_processing_time",
+                                elapsed,
+                                fields=[self.plugin_def.plugin_name])
+        offset += len(chunk)
+
+      self.plugin.Flush()
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error in output plugin %s",
+                        utils.SmartStr(self.plugin))
+      return e
+
+    return None
+
+  def _Run(self):
+    while True:
+      with self._condition:
+        self.progress += 1
+        self._condition.notify_all()
+        if not self._batches:
+          self._running = False
+          return
+
+        batch = self._batches.popleft()
+
+      if self._should_stop():
+        processed, exception = False, None
+      else:
+        processed, exception = True, self._Process(batch.results)
+      self._UpdateLag(-len(batch.results))
+
+      try:
+        self._done_callback(self, batch, processed, exception)
+      except Exception:  # pylint: disable=broad-except
+        logging.exception("Error storing the state of output plugin %s",
+                          utils.SmartStr(self.plugin))
+
+
+class HuntOutputPlugins(object):
+  """The output plugins of a single hunt, kept for a whole cron flow run.
+
+  Any number of workers can run the output plugins of the same hunt at the
+  same time, each on its own batches. The hunt's results metadata is only
+  locked briefly to merge a plugin's state after every batch it processed, so
+  merges are ordered and the notifications of a batch are only deleted once
+  all plugins have processed it and their state is stored.
+  """
+
+  # The metadata is only locked for a single state merge.
+  METADATA_LEASE_TIME = 60
+  METADATA_LOCK_TIMEOUT = 10
+  METADATA_LOCK_SLEEP_INTERVAL = 0.1
+
+  def __init__(self, hunt_urn, pool, condition, should_stop, token=None):
+    self.hunt_urn = hunt_urn
+    self.metadata_urn = hunt_urn.Add("ResultsMetadata")
+    self.token = token
+    self.exceptions_by_plugin = {}
+    # Batches that not all plugins are done with yet.
+    self.batches = []
+
+    self._lock = threading.RLock()
+
+    metadata_obj = aff4.FACTORY.Open(self.metadata_urn, token=token)
+    output_plugins = metadata_obj.Get(metadata_obj.Schema.OUTPUT_PLUGINS)
+
+    self.pipelines = []
+    self._plugin_ids = {}
+    for plugin_id, (plugin_def, state) in output_plugins.data.iteritems():
+      if not hasattr(plugin_def, "GetPluginForState"):
+        logging.error("Invalid plugin_def: %s", plugin_def)
+        continue
+
+      pipeline = OutputPluginPipeline(plugin_def,
+                                      plugin_def.GetPluginForState(state),
+                                      pool,
+                                      condition,
+                                      self._BatchDone,
+                                      should_stop=should_stop)
+      self.pipelines.append(pipeline)
+      self._plugin_ids[pipeline] = plugin_id
+
+  def IsFull(self):
+    return any(pipeline.IsFull() for pipeline in self.pipelines)
+
+  def IsIdle(self):
+    return all(pipeline.IsIdle() for pipeline in self.pipelines)
+
+  def Progress(self):
+    return sum(pipeline.progress for pipeline in self.pipelines)
+
+  def Offer(self, batch):
+    with self._lock:
+      batch.remaining = len(self.pipelines)
+      self.batches.append(batch)
+      if not self.pipelines:
+        if not self._MergeState(num_processed=len(batch.record_ids)):
+          batch.skipped = True
+        self._FinishBatch(batch)
+
+    for pipeline in self.pipelines:
+      pipeline.Offer(batch)
+
+  def RenewLeases(self, claim_lease_time):
+    with self._lock:
+      record_ids = [record_id
+                    for batch in self.batches for record_id in batch.record_ids]
+    if record_ids:
+      hunts_results.HuntResultQueue.RefreshNotifications(
+          record_ids, lease_time=claim_lease_time, token=self.token)
+
+  def _MergeState(self, pipeline=None, num_processed=0):
+    """Stores a plugin's state and counts processed results.
+
+    Args:
+      pipeline: If set, the state of this pipeline's plugin is stored.
+      num_processed: Added to the number of processed results.
+
+    Returns:
+      False if the metadata couldn't be locked, True otherwise.
+    """
+    try:
+      with aff4.FACTORY.OpenWithLock(
+          self.metadata_urn,
+          lease_time=self.METADATA_LEASE_TIME,
+          blocking=True,
+          blocking_lock_timeout=self.METADATA_LOCK_TIMEOUT,
+          blocking_sleep_interval=self.METADATA_LOCK_SLEEP_INTERVAL,
+          token=self.token) as metadata_obj:
+        if pipeline is not None:
+          # Other workers may have stored other plugins' states meanwhile, so
+          # only this plugin's entry is replaced.
+          output_plugins = metadata_obj.Get(
+              metadata_obj.Schema.OUTPUT_PLUGINS)
+          output_plugins.data[self._plugin_ids[pipeline]] = (
+              pipeline.plugin_def, pipeline.plugin.state.Copy())
+          metadata_obj.Set(metadata_obj.Schema.OUTPUT_PLUGINS(output_plugins))
+
+        if num_processed:
+          total = int(metadata_obj.Get(
+              metadata_obj.Schema.NUM_PROCESSED_RESULTS))
+          metadata_obj.Set(metadata_obj.Schema.NUM_PROCESSED_RESULTS(
+              total + num_processed))
+    except aff4.LockError as e:
+      logging.warning("Can't lock %s: %s", self.metadata_urn, e)
+      return False
+
+    return True
+
+  def _WriteStatus(self, plugin_def, plugin, batch, exception):
+    if exception is None:
+      plugin_status = output_plugin.OutputPluginBatchProcessingStatus(
+          plugin_descriptor=plugin_def,
+          status="SUCCESS",
+          batch_size=len(batch.results))
+      stats.STATS.IncrementCounter("hunt_results_ran_through_plugin",
+                                   delta=len(batch.results),
+                                   fields=[plugin_def.plugin_name])
+    else:
+      logging.error("Error processing hunt results: hunt %s, "
+                    "plugin %s: %s", self.hunt_urn, utils.SmartStr(plugin),
+                    exception)
+      stats.STATS.IncrementCounter("hunt_output_plugin_errors",
+                                   fields=[plugin_def.plugin_name])
+
+      plugin_status = output_plugin.OutputPluginBatchProcessingStatus(
+          plugin_descriptor=plugin_def,
+          status="ERROR",
+          summary=utils.SmartStr(exception),
+          batch_size=len(batch.results))
+
+    aff4.FACTORY.Open(
+        self.hunt_urn.Add("OutputPluginsStatus"),
+        hunts_implementation.PluginStatusCollection,
+        mode="w",
+        token=self.token).Add(plugin_status)
+    if plugin_status.status == plugin_status.Status.ERROR:
+      aff4.FACTORY.Open(
+          self.hunt_urn.Add("OutputPluginsErrors"),
+          hunts_implementation.PluginStatusCollection,
+          mode="w",
+          token=self.token).Add(plugin_status)
+
+  def _BatchDone(self, pipeline, batch, processed, exception):
+    """Stores a plugin's state once it has processed a batch."""
+    plugin_def, plugin = pipeline.plugin_def, pipeline.plugin
+    if processed:
+      self._WriteStatus(plugin_def, plugin, batch, exception)
+
+    with self._lock:
+      if exception is not None:
+        self.exceptions_by_plugin.setdefault(plugin_def, []).append(exception)
+
+      if not processed:
+        batch.skipped = True
+
+      batch.remaining -= 1
+      num_processed = 0
+      if not batch.remaining and not batch.skipped:
+        num_processed = len(batch.record_ids)
+
+      if processed and not self._MergeState(pipeline=pipeline,
+                                            num_processed=num_processed):
+        # The plugin's state wasn't stored, the batch has to be processed
+        # again.
+        batch.skipped = True
+
+      if not batch.remaining:
+        self._FinishBatch(batch)
+
+  def _FinishBatch(self, batch):
+    """Deletes (or releases) the notifications of a batch. Needs self._lock."""
+    self.batches.remove(batch)
+    if batch.skipped:
+      hunts_results.HuntResultQueue.ReleaseNotifications(batch.record_ids,
+                                                         token=self.token)
+      return
+
+    hunts_results.HuntResultQueue.DeleteNotifications(batch.record_ids,
+                                                      token=self.token)
+    logging.debug("Processed %d results.", len(batch.record_ids))
+
+
 class ProcessHuntResultCollectionsCronFlow(cronjobs.SystemCronFlow):
   """Periodic cron flow that processes hunt results.
 
@@ -58,6 +406,17 @@ class ProcessHuntResultCollectionsCronFlow(cronjobs.SystemCronFlow):
 
   DEFAULT_BATCH_SIZE = 5000
 
+  # Claims only cover a single batch, so they can be short-lived: results of a
+  # worker that died are picked up by others quickly. Claims are renewed every
+  # LEASE_RENEWAL_INTERVAL seconds while the output plugins are running.
+  CLAIM_LEASE_TIME = rdfvalue.Duration("10m")
+  LEASE_RENEWAL_INTERVAL = 60
+
+  # Output plugins of all hunts run on this pool, it's reused by all runs of
+  # this flow in a process.
+  THREADPOOL_NAME = "hunt_output_plugins"
+  THREADPOOL_SIZE = 10
+
   def CheckIfRunningTooLong(self):
     if self.state.args.max_running_time:
       elapsed = (rdfvalue.RDFDatetime().Now().AsSecondsFromEpoch() -
@@ -66,134 +425,148 @@ class ProcessHuntResultCollectionsCronFlow(cronjobs.SystemCronFlow):
         return True
     return False
 
-  def LoadPlugins(self, metadata_obj):
-    output_plugins = metadata_obj.Get(metadata_obj.Schema.OUTPUT_PLUGINS)
-    used_plugins = []
-    unused_plugins = []
-    for _, (plugin_def, state) in output_plugins.data.iteritems():
-      if not hasattr(plugin_def, "GetPluginForState"):
-        logging.error("Invalid plugin_def: %s", plugin_def)
-        continue
-      used_plugins.append((plugin_def, plugin_def.GetPluginForState(state)))
-    return output_plugins, used_plugins
-
-  def RunPlugins(self, hunt_urn, plugins, results, exceptions_by_plugin):
-    for plugin_def, plugin in plugins:
-      try:
-        plugin.ProcessResponses(results)
-        plugin.Flush()
-
-        plugin_status = output_plugin.OutputPluginBatchProcessingStatus(
-            plugin_descriptor=plugin_def,
-            status="SUCCESS",
-            batch_size=len(results))
-        stats.STATS.IncrementCounter("hunt_results_ran_through_plugin",
-                                     delta=len(results),
-                                     fields=[plugin_def.plugin_name])
-
-      except Exception as e:  # pylint: disable=broad-except
-        logging.exception("Error processing hunt results: hunt %s, "
-                          "plugin %s", hunt_urn, utils.SmartStr(plugin))
-        self.Log("Error processing hunt results (hunt %s, "
-                 "plugin %s): %s" % (hunt_urn, utils.SmartStr(plugin), e))
-        stats.STATS.IncrementCounter("hunt_output_plugin_errors",
-                                     fields=[plugin_def.plugin_name])
-
-        plugin_status = output_plugin.OutputPluginBatchProcessingStatus(
-            plugin_descriptor=plugin_def,
-            status="ERROR",
-            summary=utils.SmartStr(e),
-            batch_size=len(results))
-        exceptions_by_plugin.setdefault(plugin_def, []).append(e)
-
-      aff4.FACTORY.Open(
-          hunt_urn.Add("OutputPluginsStatus"),
-          hunts_implementation.PluginStatusCollection,
-          mode="w",
-          token=self.token).Add(plugin_status)
-      if plugin_status.status == plugin_status.Status.ERROR:
-        aff4.FACTORY.Open(
-            hunt_urn.Add("OutputPluginsErrors"),
-            hunts_implementation.PluginStatusCollection,
-            mode="w",
-            token=self.token).Add(plugin_status)
-
-  def ProcessOneHunt(self, exceptions_by_hunt):
-    """Reads results for one hunt and process them."""
-    hunt_results_urn, results = (
+  def RenewLeases(self, force=False):
+    """Extends the claims on pending batches.
+
+    Args:
+      force: If False, leases are only renewed once per
+        LEASE_RENEWAL_INTERVAL.
+    """
+    now = time.time()
+    if not force and now - self._last_renewal < self.LEASE_RENEWAL_INTERVAL:
+      return
+
+    self._last_renewal = now
+    for hunt in self.hunts.values():
+      hunt.RenewLeases(self.CLAIM_LEASE_TIME)
+    self.HeartBeat()
+
+  def Progress(self):
+    """Returns a counter that increases whenever any pipeline progresses."""
+    with self.condition:
+      return sum(hunt.Progress() for hunt in self.hunts.values())
+
+  def WaitUntil(self, predicate):
+    """Waits for the output plugins until predicate() is True."""
+    while True:
+      with self.condition:
+        if predicate():
+          return
+        self.condition.wait(self.LEASE_RENEWAL_INTERVAL)
+      self.RenewLeases()
+
+  def ProcessOneBatch(self, exclude_collections):
+    """Claims one batch of results and hands it to the hunt's output plugins.
+
+    Every batch is claimed separately from the notification queue, so any
+    number of cron flow runs (overlapping runs are allowed) and worker
+    processes can work through the results of many hunts, and of the same
+    hunt, in parallel. Neither the collection nor the hunt's results metadata
+    stay locked while the plugins run, see HuntOutputPlugins.
+
+    The batch is queued on the plugins' pipelines and this returns right
+    away.
+
+    Args:
+      exclude_collections: A set of result collection urns not to claim
+        results from.
+
+    Returns:
+      The number of results claimed, or None if there were no results left to
+      claim.
+    """
+    batch_size = self.state.args.batch_size or self.DEFAULT_BATCH_SIZE
+    hunt_results_urn, batch = (
         hunts_results.HuntResultQueue.ClaimNotificationsForCollection(
             start_time=self.args.start_processing_time,
             token=self.token,
-            lease_time=self.lifetime))
-    logging.debug("Found %d results for hunt %s", len(results),
+            lease_time=self.CLAIM_LEASE_TIME,
+            exclude_collections=exclude_collections,
+            limit=batch_size))
+    logging.debug("Claimed %d results for hunt %s", len(batch),
                   hunt_results_urn)
-    if not results:
-      return 0
-
-    hunt_urn = rdfvalue.RDFURN(hunt_results_urn.Dirname())
-    batch_size = self.state.args.batch_size or self.DEFAULT_BATCH_SIZE
-    metadata_urn = hunt_urn.Add("ResultsMetadata")
-    exceptions_by_plugin = {}
-    num_processed_for_hunt = 0
-    with aff4.FACTORY.OpenWithLock(hunt_results_urn,
-                                   aff4_type=hunts_results.HuntResultCollection,
-                                   lease_time=600,
-                                   token=self.token) as collection_obj:
-      with aff4.FACTORY.OpenWithLock(metadata_urn,
-                                     lease_time=600,
-                                     token=self.token) as metadata_obj:
-        all_plugins, used_plugins = self.LoadPlugins(metadata_obj)
-        num_processed = int(metadata_obj.Get(
-            metadata_obj.Schema.NUM_PROCESSED_RESULTS))
-        for batch in utils.Grouper(results, batch_size):
-          results = list(collection_obj.MultiResolve([(
-              ts, suffix) for (_, ts, suffix) in batch]))
-          self.RunPlugins(hunt_urn, used_plugins, results, exceptions_by_plugin)
-
-          hunts_results.HuntResultQueue.DeleteNotifications(
-              [record_id for (record_id, _, _) in batch],
-              token=self.token)
-          num_processed += len(batch)
-          num_processed_for_hunt += len(batch)
-          self.HeartBeat()
-          collection_obj.UpdateLease(600)
-          metadata_obj.Set(metadata_obj.Schema.NUM_PROCESSED_RESULTS(
-              num_processed))
-          metadata_obj.UpdateLease(600)
-          if self.CheckIfRunningTooLong():
-            logging.warning("Run too long, stopping.")
-            break
-
-        metadata_obj.Set(metadata_obj.Schema.OUTPUT_PLUGINS(all_plugins))
-        metadata_obj.Set(metadata_obj.Schema.NUM_PROCESSED_RESULTS(
-            num_processed))
-
-    if exceptions_by_plugin:
-      for plugin, exceptions in exceptions_by_plugin.items():
-        exceptions_by_hunt.setdefault(hunt_urn, {}).setdefault(
-            plugin, []).extend(exceptions)
-
-    logging.debug("Processed %d results.", num_processed_for_hunt)
-    return len(results)
+    if not batch:
+      return None
+
+    record_ids = [record_id for (record_id, _, _) in batch]
+    hunt = self.hunts.get(hunt_results_urn)
+    if hunt is None:
+      hunt = HuntOutputPlugins(rdfvalue.RDFURN(hunt_results_urn.Dirname()),
+                               self.pool,
+                               self.condition,
+                               self.CheckIfRunningTooLong,
+                               token=self.token)
+      self.hunts[hunt_results_urn] = hunt
+
+    collection_obj = aff4.FACTORY.Open(
+        hunt_results_urn,
+        aff4_type=hunts_results.HuntResultCollection,
+        token=self.token)
+    results = list(collection_obj.MultiResolve([(
+        ts, suffix) for (_, ts, suffix) in batch]))
+    self.HeartBeat()
+
+    hunt.Offer(ResultsBatch(record_ids, results))
+    return len(batch)
 
   @flow.StateHandler()
   def Start(self):
+    """Feeds hunt results to the output plugins until there are none left.
+
+    Each output plugin of every hunt has its own pipeline that is kept for
+    the whole run. Batches are claimed while the pipelines of their hunt have
+    room for more. When nothing can be claimed while pipelines are still
+    running, the flow waits for them to make progress and tries again: busy
+    hunts may take more results by then, finished batches no longer hide
+    unclaimed results from the claim scan and new results may have arrived.
+    The run ends once nothing is left to claim while all pipelines are idle.
+    """
     self.start_time = rdfvalue.RDFDatetime().Now()
+    self._last_renewal = 0
+    self.hunts = {}
+    self.condition = threading.Condition()
+    self.pool = threadpool.ThreadPool.Factory(self.THREADPOOL_NAME,
+                                              self.THREADPOOL_SIZE)
+    self.pool.Start()
 
-    exceptions_by_hunt = {}
     if not self.state.args.max_running_time:
       self.state.args.max_running_time = rdfvalue.Duration("%ds" % int(
           ProcessHuntResultCollectionsCronFlow.lifetime.seconds * 0.6))
 
-    while not self.CheckIfRunningTooLong():
-      count = self.ProcessOneHunt(exceptions_by_hunt)
-      if not count:
-        break
+    try:
+      while not self.CheckIfRunningTooLong():
+        # Results written before the pipelines went idle are visible to the
+        # claim below, so idleness has to be checked before claiming.
+        with self.condition:
+          progress = self.Progress()
+          idle = all(hunt.IsIdle() for hunt in self.hunts.values())
+
+        busy = set(urn for urn, hunt in self.hunts.items() if hunt.IsFull())
+        count = self.ProcessOneBatch(busy)
+        if count is not None:
+          self.RenewLeases()
+          continue
+
+        if idle:
+          break
+
+        self.WaitUntil(lambda: self.Progress() != progress)
+    finally:
+      self.WaitUntil(lambda: all(hunt.IsIdle()
+                                 for hunt in self.hunts.values()))
+
+    exceptions_by_hunt = {}
+    for hunt in self.hunts.values():
+      if hunt.exceptions_by_plugin:
+        exceptions_by_hunt[hunt.hunt_urn] = hunt.exceptions_by_plugin
 
     if exceptions_by_hunt:
       e = ResultsProcessingError()
       for hunt_urn, exceptions_by_plugin in exceptions_by_hunt.items():
         for plugin, exceptions in exceptions_by_plugin.items():
           for exception in exceptions:
+            self.Log("Error processing hunt results (hunt %s, "
+                     "plugin %s): %s" % (hunt_urn, plugin.plugin_name,
+                                         exception))
             e.RegisterSubException(hunt_urn, plugin, exception)
       raise e
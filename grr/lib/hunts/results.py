@@ -28,7 +28,9 @@ class HuntResultQueue(aff4_queue.Queue):
                                       token=None,
                                       start_time=None,
                                       lease_time=200,
-                                      collection=None):
+                                      collection=None,
+                                      exclude_collections=None,
+                                      limit=100000):
     """Return unclaimed hunt result notifications for collection.
 
     Args:
@@ -43,6 +45,13 @@ class HuntResultQueue(aff4_queue.Queue):
       collection: The urn of the collection to find notifications for. If unset,
         the earliest (unclaimed) notification will determine the collection.
 
+      exclude_collections: An optional set of collection urns to ignore when
+        collection is unset.
+
+      limit: The maximum number of notifications to claim. Claims are
+        disjoint, so several workers can process notifications for the same
+        collection at the same time.
+
     Returns:
       A pair (collection, results) where collection is the collection that
       notifications were retrieved for and results is a list of tuples (id,
@@ -54,27 +63,30 @@ class HuntResultQueue(aff4_queue.Queue):
 
     class CollectionFilter(object):
 
-      def __init__(self, collection):
+      def __init__(self, collection, exclude_collections):
         self.collection = collection
+        self.exclude_collections = exclude_collections or set()
 
       def FilterRecord(self, notification):
         if self.collection is None:
+          if notification.result_collection_urn in self.exclude_collections:
+            return True
           self.collection = notification.result_collection_urn
         return self.collection != notification.result_collection_urn
 
-    f = CollectionFilter(collection)
+    f = CollectionFilter(collection, exclude_collections)
     results = []
     with aff4.FACTORY.OpenWithLock(RESULT_NOTIFICATION_QUEUE,
                                    aff4_type=HuntResultQueue,
                                    lease_time=300,
                                    blocking=True,
-                                   blocking_sleep_interval=15,
+                                   blocking_sleep_interval=1,
                                    blocking_lock_timeout=600,
                                    token=token) as queue:
       for record_id, value in queue.ClaimRecords(record_filter=f.FilterRecord,
                                                  start_time=start_time,
                                                  timeout=lease_time,
-                                                 limit=100000):
+                                                 limit=limit):
         results.append((record_id, value.timestamp, value.suffix))
     return (f.collection, results)
 
@@ -86,10 +98,28 @@ class HuntResultQueue(aff4_queue.Queue):
                            token=token) as queue:
       queue.DeleteRecords(record_ids)
 
+  @classmethod
+  def RefreshNotifications(cls, record_ids, lease_time=200, token=None):
+    """Extend claims on hunt notifications by lease_time from now."""
+    with aff4.FACTORY.Open(RESULT_NOTIFICATION_QUEUE,
+                           aff4_type=HuntResultQueue,
+                           token=token) as queue:
+      queue.RefreshClaims(record_ids, timeout=lease_time)
+
+  @classmethod
+  def ReleaseNotifications(cls, record_ids, token=None):
+    """Release claims on hunt notifications so they can be claimed again."""
+    with aff4.FACTORY.Open(RESULT_NOTIFICATION_QUEUE,
+                           aff4_type=HuntResultQueue,
+                           token=token) as queue:
+      queue.ReleaseRecords(record_ids)
+
 
 class HuntResultCollection(sequential_collection.GrrMessageCollection):
   """Sequential HuntResultCollection."""
 
+  PACK_SEGMENTS = True
+
   @classmethod
   def StaticAdd(cls,
                 collection_urn,
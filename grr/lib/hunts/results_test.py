@@ -116,6 +116,95 @@ class ResultTest(test_lib.AFF4ObjectTest):
           token=self.token)
     self.assertEqual(0, len(results_2[1]))
 
+  def testNotificationsAreClaimedInDisjointBatches(self):
+    collection_urn = "aff4:/testNotificationsAreClaimedInDisjointBatches/c"
+    with aff4.FACTORY.Create(collection_urn,
+                             aff4_type=hunts_results.HuntResultCollection,
+                             mode="w",
+                             token=self.token):
+      pass
+    for i in range(10):
+      hunts_results.HuntResultCollection.StaticAdd(
+          collection_urn,
+          self.token,
+          rdf_flows.GrrMessage(request_id=i))
+
+    results_1 = hunts_results.HuntResultQueue.ClaimNotificationsForCollection(
+        token=self.token, limit=4)
+    results_2 = hunts_results.HuntResultQueue.ClaimNotificationsForCollection(
+        token=self.token, limit=4)
+    self.assertEqual(4, len(results_1[1]))
+    self.assertEqual(4, len(results_2[1]))
+    ids_1 = set(record_id for (record_id, _, _) in results_1[1])
+    ids_2 = set(record_id for (record_id, _, _) in results_2[1])
+    self.assertFalse(ids_1 & ids_2)
+
+    # Released notifications can be claimed again right away.
+    hunts_results.HuntResultQueue.ReleaseNotifications(
+        list(ids_1), token=self.token)
+    results_3 = hunts_results.HuntResultQueue.ClaimNotificationsForCollection(
+        token=self.token)
+    self.assertEqual(6, len(results_3[1]))
+    ids_3 = set(record_id for (record_id, _, _) in results_3[1])
+    self.assertTrue(ids_1 <= ids_3)
+
+  def testRefreshedNotificationsStayClaimed(self):
+    collection_urn = "aff4:/testRefreshedNotificationsStayClaimed/collection"
+    with aff4.FACTORY.Create(collection_urn,
+                             aff4_type=hunts_results.HuntResultCollection,
+                             mode="w",
+                             token=self.token):
+      pass
+    for i in range(5):
+      hunts_results.HuntResultCollection.StaticAdd(
+          collection_urn,
+          self.token,
+          rdf_flows.GrrMessage(request_id=i))
+
+    results_1 = hunts_results.HuntResultQueue.ClaimNotificationsForCollection(
+        token=self.token, lease_time=rdfvalue.Duration("10m"))
+    self.assertEqual(5, len(results_1[1]))
+
+    with test_lib.FakeTime(rdfvalue.RDFDatetime().Now() + rdfvalue.Duration(
+        "5m")):
+      hunts_results.HuntResultQueue.RefreshNotifications(
+          [record_id for (record_id, _, _) in results_1[1]],
+          lease_time=rdfvalue.Duration("10m"),
+          token=self.token)
+
+    # The original claim would have expired by now, the refreshed one hasn't.
+    with test_lib.FakeTime(rdfvalue.RDFDatetime().Now() + rdfvalue.Duration(
+        "12m")):
+      results_2 = hunts_results.HuntResultQueue.ClaimNotificationsForCollection(
+          token=self.token)
+    self.assertEqual(0, len(results_2[1]))
+
+  def testExcludedCollectionsAreSkipped(self):
+    collection_urn_1 = "aff4:/testExcludedCollectionsAreSkipped/collection_1"
+    collection_urn_2 = "aff4:/testExcludedCollectionsAreSkipped/collection_2"
+    for urn in [collection_urn_1, collection_urn_2]:
+      with aff4.FACTORY.Create(urn,
+                               aff4_type=hunts_results.HuntResultCollection,
+                               mode="w",
+                               token=self.token):
+        pass
+
+    for i in range(5):
+      hunts_results.HuntResultCollection.StaticAdd(
+          collection_urn_1,
+          self.token,
+          rdf_flows.GrrMessage(request_id=i))
+      hunts_results.HuntResultCollection.StaticAdd(
+          collection_urn_2,
+          self.token,
+          rdf_flows.GrrMessage(request_id=100 + i))
+
+    results = hunts_results.HuntResultQueue.ClaimNotificationsForCollection(
+        token=self.token,
+        exclude_collections=set([rdfvalue.RDFURN(collection_urn_1)]))
+    self.assertEqual(collection_urn_2, results[0])
+    self.assertEqual(5, len(results[1]))
+
   def testNotificationsSplitByCollection(self):
     # Create two HuntResultCollections.
     collection_urn_1 = "aff4:/testNotificationsSplitByCollection/collection_1"
@@ -595,7 +595,7 @@ class GenericHunt(implementation.GRRHunt):
     resources.cpu_usage.user_cpu_time = status.cpu_time_used.user_cpu_time
     resources.cpu_usage.system_cpu_time = status.cpu_time_used.system_cpu_time
     resources.network_bytes_sent = status.network_bytes_sent
-    self.state.context.usage_stats.RegisterResources(resources)
+    self.RegisterClientResources(resources)
 
   @flow.StateHandler()
   def MarkDone(self, responses):
@@ -813,5 +813,10 @@ class StandardHuntInitHook(registry.InitHook):
                                       fields=[("plugin", str)])
     stats.STATS.RegisterCounterMetric("hunt_results_ran_through_plugin",
                                       fields=[("plugin", str)])
+    stats.STATS.RegisterGaugeMetric("hunt_output_plugin_lag",
+                                    int,
+                                    fields=[("plugin", str)])
+    stats.STATS.RegisterEventMetric("hunt_output_plugin_batch_processing_time",
+                                    fields=[("plugin", str)])
     stats.STATS.RegisterCounterMetric("hunt_results_compacted")
     stats.STATS.RegisterCounterMetric("hunt_results_compaction_locking_errors")
@@ -4,6 +4,7 @@
 
 
 import math
+import threading
 import time
 
 
@@ -32,6 +33,7 @@ from grr.lib.flows.general import administrative
 from grr.lib.flows.general import transfer
 from grr.lib.hunts import implementation
 from grr.lib.hunts import process_results
+from grr.lib.hunts import results as hunts_results
 from grr.lib.hunts import standard
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import paths as rdf_paths
@@ -62,6 +64,27 @@ class FailingInFlushDummyHuntOutputPlugin(output_plugin.OutputPlugin):
     raise RuntimeError("Flush, oh no!")
 
 
+class BlockingDummyHuntOutputPlugin(output_plugin.OutputPlugin):
+  """Blocks on its first batch until released."""
+  release = threading.Event()
+  released_in_time = None
+
+  def ProcessResponses(self, unused_responses):
+    if BlockingDummyHuntOutputPlugin.released_in_time is None:
+      BlockingDummyHuntOutputPlugin.released_in_time = (
+          BlockingDummyHuntOutputPlugin.release.wait(10))
+
+
+class ReleasingDummyHuntOutputPlugin(output_plugin.OutputPlugin):
+  """Releases BlockingDummyHuntOutputPlugin after its third batch."""
+  num_calls = 0
+
+  def ProcessResponses(self, unused_responses):
+    ReleasingDummyHuntOutputPlugin.num_calls += 1
+    if ReleasingDummyHuntOutputPlugin.num_calls == 3:
+      BlockingDummyHuntOutputPlugin.release.set()
+
+
 class StatefulDummyHuntOutputPlugin(output_plugin.OutputPlugin):
   data = []
 
@@ -219,6 +242,9 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass, StandardHuntTestMixin):
     DummyHuntOutputPlugin.num_responses = 0
     StatefulDummyHuntOutputPlugin.data = []
     LongRunningDummyHuntOutputPlugin.num_calls = 0
+    BlockingDummyHuntOutputPlugin.release.clear()
+    BlockingDummyHuntOutputPlugin.released_in_time = None
+    ReleasingDummyHuntOutputPlugin.num_calls = 0
 
     with test_lib.FakeTime(0):
       # Clean up the foreman to remove any rules.
@@ -737,6 +763,79 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass, StandardHuntTestMixin):
     self.assertEqual(success_count - prev_success_count, 0)
     self.assertEqual(errors_count - prev_errors_count, 1)
 
+  def testOutputPluginsAreFedInBatches(self):
+    self.StartHunt(output_plugins=[output_plugin.OutputPluginDescriptor(
+        plugin_name="DummyHuntOutputPlugin")])
+    self.AssignTasksToClients()
+    self.RunHunt(failrate=-1)
+
+    pipeline_cls = process_results.OutputPluginPipeline
+    with utils.MultiStubber((pipeline_cls, "INITIAL_BATCH_SIZE", 3),
+                            (pipeline_cls, "MIN_BATCH_SIZE", 3),
+                            (pipeline_cls, "MAX_BATCH_SIZE", 3),
+                            (pipeline_cls, "MAX_QUEUED_BATCHES", 1)):
+      self.ProcessHuntOutputPlugins()
+
+    # 10 results in batches of 3.
+    self.assertEqual(DummyHuntOutputPlugin.num_calls, 4)
+    self.assertEqual(DummyHuntOutputPlugin.num_responses, 10)
+
+    # All results were processed, so the plugin isn't lagging behind.
+    self.assertEqual(
+        stats.STATS.GetMetricValue("hunt_output_plugin_lag",
+                                   fields=["DummyHuntOutputPlugin"]), 0)
+
+  def testSlowOutputPluginDoesNotHoldUpOtherPlugins(self):
+    self.StartHunt(output_plugins=[
+        output_plugin.OutputPluginDescriptor(
+            plugin_name="BlockingDummyHuntOutputPlugin"),
+        output_plugin.OutputPluginDescriptor(
+            plugin_name="ReleasingDummyHuntOutputPlugin")
+    ])
+    self.AssignTasksToClients()
+    self.RunHunt(failrate=-1)
+
+    self.ProcessHuntOutputPlugins(batch_size=1)
+
+    # The blocked plugin is only released once the other plugin has gone
+    # through three more batches.
+    self.assertTrue(BlockingDummyHuntOutputPlugin.released_in_time)
+    self.assertEqual(ReleasingDummyHuntOutputPlugin.num_calls, 10)
+
+    # Both plugins processed every result, so all notifications are gone.
+    _, notifications = (
+        hunts_results.HuntResultQueue.ClaimNotificationsForCollection(
+            token=self.token))
+    self.assertFalse(notifications)
+
+  def testResultsMetadataIsNotLockedWhileOutputPluginsRun(self):
+    hunt_urn = self.StartHunt(output_plugins=[
+        output_plugin.OutputPluginDescriptor(
+            plugin_name="DummyHuntOutputPlugin")
+    ])
+    self.AssignTasksToClients()
+    self.RunHunt(failrate=-1)
+
+    locked = []
+
+    def ProcessResponsesStub(_, unused_responses):
+      # Another worker processing the same hunt can lock the metadata.
+      with aff4.FACTORY.OpenWithLock(hunt_urn.Add("ResultsMetadata"),
+                                     blocking=False,
+                                     token=self.token):
+        locked.append(True)
+
+    with utils.Stubber(DummyHuntOutputPlugin, "ProcessResponses",
+                       ProcessResponsesStub):
+      self.ProcessHuntOutputPlugins()
+
+    self.assertEqual(locked, [True])
+    results_metadata = aff4.FACTORY.Open(
+        hunt_urn.Add("ResultsMetadata"), token=self.token)
+    self.assertEqual(
+        results_metadata.Get(results_metadata.Schema.NUM_PROCESSED_RESULTS),
+        10)
+
   def testOutputPluginsMaintainState(self):
     self.StartHunt(output_plugins=[output_plugin.OutputPluginDescriptor(
         plugin_name="StatefulDummyHuntOutputPlugin")])
@@ -1200,7 +1299,7 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass, StandardHuntTestMixin):
 
     # This is called once for each state method. Each flow above runs the
     # Start and the StoreResults methods.
-    usage_stats = hunt.state.context.usage_stats
+    usage_stats = hunt.GetClientResourcesStats()
     self.assertEqual(usage_stats.user_cpu_stats.num, 10)
     self.assertTrue(math.fabs(usage_stats.user_cpu_stats.mean - 5.5) < 1e-7)
     self.assertTrue(
@@ -1230,6 +1329,33 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass, StandardHuntTestMixin):
           p.cpu_usage.user_cpu_time + p.cpu_usage.system_cpu_time)
       prev = p
 
+  def testClientResourcesStatsIncludeQuantiles(self):
+    self.client_ids = self.SetupClients(10)
+    hunt_urn = self.StartHunt(output_plugins=[])
+    self.AssignTasksToClients()
+    self.RunHunt()
+
+    hunt = aff4.FACTORY.Open(hunt_urn,
+                             aff4_type=standard.GenericHunt,
+                             token=self.token)
+    usage_stats = hunt.GetClientResourcesStats()
+
+    self.assertEqual(usage_stats.user_cpu_stats.num, 10)
+    self.assertEqual(usage_stats.user_cpu_stats.quantiles.num, 10)
+    self.assertTrue(math.fabs(usage_stats.user_cpu_stats.mean - 5.5) < 1e-7)
+    self.assertAlmostEqual(usage_stats.user_cpu_stats.quantiles.Quantile(0.5),
+                           5.5)
+    self.assertEqual(usage_stats.system_cpu_stats.quantiles.min_value, 2)
+    self.assertEqual(usage_stats.system_cpu_stats.quantiles.max_value, 20)
+    self.assertAlmostEqual(
+        usage_stats.network_bytes_sent_stats.quantiles.Quantile(0.5), 16.5)
+    self.assertEqual(len(usage_stats.worst_performers), 10)
+
+    # Client completions don't write to the hunt object itself.
+    context_stats = hunt.state.context.usage_stats
+    self.assertEqual(context_stats.user_cpu_stats.num, 0)
+    self.assertFalse(context_stats.worst_performers)
+
   def testHuntCollectionLogging(self):
     """This tests running the hunt on some clients."""
     with hunts.GRRHunt.StartHunt(
@@ -841,6 +841,13 @@ class ByteSize(RDFInteger):
     self._value = int(value * multiplier)
 
 
+# Normalized paths of recently parsed URNs keyed by the string they were parsed
+# from. Normalized paths are also keyed by themselves, so all URNs with the same
+# path share a single string object.
+_NORMALIZED_URN_PATHS = {}
+_NORMALIZED_URN_PATHS_MAX_SIZE = 100000
+
+
 @functools.total_ordering
 class RDFURN(RDFValue):
   """An object to abstract URL manipulation."""
@@ -851,6 +858,13 @@ class RDFURN(RDFValue):
   # class for performance reasons.
   scheme = "aff4"
 
+  # Caches of values derived from the path. Each cache is only valid while the
+  # path is the exact object it was computed for.
+  _components = ()
+  _components_path = None
+  _hash = None
+  _hash_path = None
+
   def __init__(self, initializer=None, age=None):
     """Constructor.
 
@@ -877,11 +891,22 @@ class RDFURN(RDFValue):
     Args:
       initializer: url string
     """
-    # Strip off the aff4: prefix if necessary.
-    if initializer.startswith("aff4:/"):
-      initializer = initializer[5:]
+    path = _NORMALIZED_URN_PATHS.get(initializer)
+    if path is None:
+      # Strip off the aff4: prefix if necessary.
+      if initializer.startswith("aff4:/"):
+        path = utils.NormalizePath(initializer[5:])
+      else:
+        path = utils.NormalizePath(initializer)
 
-    self._string_urn = utils.NormalizePath(initializer)
+      if initializer.__class__ in (str, unicode):
+        if len(_NORMALIZED_URN_PATHS) >= _NORMALIZED_URN_PATHS_MAX_SIZE:
+          _NORMALIZED_URN_PATHS.clear()
+
+        path = _NORMALIZED_URN_PATHS.setdefault(path, path)
+        _NORMALIZED_URN_PATHS[initializer] = path
+
+    self._string_urn = path
 
   def SerializeToString(self):
     return str(self)
@@ -902,7 +927,7 @@ class RDFURN(RDFValue):
     return posixpath.dirname(self._string_urn)
 
   def Basename(self):
-    return posixpath.basename(self.Path())
+    return self.Path().rpartition("/")[2]
 
   def Add(self, path, age=None):
     """Add a relative stem to the current value and return a new RDFURN.
@@ -923,7 +948,17 @@ class RDFURN(RDFValue):
       raise ValueError("Only strings should be added to a URN.")
 
     result = self.Copy(age)
-    result.Update(path=utils.JoinPath(self._string_urn, path))
+
+    # Our own path is already normalized so a single path component can simply
+    # be appended to it.
+    if path and "/" not in path and path != "." and path != "..":
+      if self._string_urn == "/":
+        result.Update(path=u"/" + utils.SmartUnicode(path))
+      else:
+        result.Update(path=self._string_urn + u"/" + utils.SmartUnicode(path))
+
+    else:
+      result.Update(path=utils.JoinPath(self._string_urn, path))
 
     return result
 
@@ -970,6 +1005,13 @@ class RDFURN(RDFValue):
   def __lt__(self, other):
     return self._string_urn < other
 
+  def __hash__(self):
+    if self._hash_path is not self._string_urn:
+      self._hash = hash(self.SerializeToString())
+      self._hash_path = self._string_urn
+
+    return self._hash
+
   def Path(self):
     """Return the path of the urn."""
     return self._string_urn
@@ -995,7 +1037,11 @@ class RDFURN(RDFValue):
       return result
 
     else:
-      return filter(None, self._string_urn.split("/"))
+      if self._components_path is not self._string_urn:
+        self._components = tuple(filter(None, self._string_urn.split("/")))
+        self._components_path = self._string_urn
+
+      return list(self._components)
 
   def RelativeName(self, volume):
     """Given a volume URN return the relative URN as a unicode string.
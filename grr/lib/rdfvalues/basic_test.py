@@ -218,6 +218,35 @@ class RDFURNTest(test_base.RDFValueTestCase):
     for path in ["aff4:/test/?#asd", "aff4:/test/#asd", "aff4:/test/?#"]:
       self.assertEqual(path, str(rdfvalue.RDFURN(path)))
 
+  def testPathsAreShared(self):
+    urn1 = rdfvalue.RDFURN("aff4:/C.0000000000000001/fs/os")
+    urn2 = rdfvalue.RDFURN("/C.0000000000000001/fs//os/")
+    self.assertTrue(urn1.Path() is urn2.Path())
+
+  def testAddNormalizesComponents(self):
+    urn = rdfvalue.RDFURN("aff4:/")
+    self.assertEqual(urn.Add("foo").Path(), "/foo")
+    self.assertEqual(urn.Add("foo").Add("bar").Path(), "/foo/bar")
+    self.assertEqual(urn.Add("foo").Add("..").Path(), "/foo")
+    self.assertEqual(urn.Add("foo").Add("bar/../baz").Path(), "/foo/baz")
+    self.assertEqual(urn.Add("foo").Add("/bar//").Path(), "/foo/bar")
+
+  def testCachedComponents(self):
+    urn = rdfvalue.RDFURN("aff4:/foo/bar")
+    self.assertEqual(urn.Split(), ["foo", "bar"])
+    self.assertEqual(urn.Basename(), "bar")
+
+    # Modifying the returned list does not change the cache.
+    urn.Split().append("baz")
+    self.assertEqual(urn.Split(), ["foo", "bar"])
+
+    hash_value = hash(urn)
+    urn.Update(url="aff4:/foo/baz")
+    self.assertEqual(urn.Split(), ["foo", "baz"])
+    self.assertEqual(urn.Basename(), "baz")
+    self.assertNotEqual(hash(urn), hash_value)
+    self.assertEqual(hash(urn), hash("aff4:/foo/baz"))
+
   def testComparison(self):
     urn = rdfvalue.RDFURN("aff4:/abc/def")
     self.assertEqual(urn, str(urn))
@@ -3,9 +3,13 @@
 
 
 
+from grr.lib import rdfvalue
 from grr.lib import test_lib
 from grr.lib import type_info
 from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import paths as rdf_paths
+from grr.lib.rdfvalues import protodict as rdf_protodict
 from grr.lib.rdfvalues import structs as rdf_structs
 from grr.proto import jobs_pb2
 from grr.proto import knowledge_base_pb2
@@ -350,3 +354,112 @@ class RDFValueBenchmark(test_lib.AverageMicroBenchmarks):
 
     self.TimeIt(RDFStructDecodeEncode)
     self.TimeIt(ProtoDecodeEncode)
+
+  def testRDFURN(self):
+    """Time the URN operations used when walking the AFF4 tree."""
+    path = "aff4:/C.1234567812345678/fs/os/usr/lib/python2.7/site-packages"
+    urn = rdfvalue.RDFURN(path)
+
+    def Parse():
+      rdfvalue.RDFURN(path)
+
+    def Add():
+      urn.Add("foo").Add("bar")
+
+    def Split():
+      urn.Split()
+
+    def Hash():
+      set([urn, urn.Add("foo")])
+
+    self.TimeIt(Parse, "RDFURN parse")
+    self.TimeIt(Add, "RDFURN add")
+    self.TimeIt(Split, "RDFURN split")
+    self.TimeIt(Hash, "RDFURN hash")
+
+  def _CompiledCodecsBenchmark(self, name, value, classes, check):
+    """Times decoding and encoding of value with compiled and generic codecs."""
+    data = value.SerializeToString()
+
+    def Decode():
+      check(value.__class__(data))
+
+    def Encode():
+      # value was created from keywords so all fields are converted each time.
+      value.SerializeToString()
+
+    self.TimeIt(Decode, "Compiled %s decode" % name)
+    self.TimeIt(Encode, "Compiled %s encode" % name)
+
+    try:
+      for cls in classes:
+        cls.compile_codecs = False
+        cls.CompileCodecs()
+
+      # Both codecs must produce the same serialization.
+      self.assertEqual(value.__class__(value.SerializeToString()), value)
+
+      self.TimeIt(Decode, "Generic %s decode" % name)
+      self.TimeIt(Encode, "Generic %s encode" % name)
+
+    finally:
+      for cls in classes:
+        cls.compile_codecs = True
+        cls.CompileCodecs()
+
+  def testCompiledCodecs(self):
+    """Compare the compiled per class codecs to the generic ones."""
+    message = rdf_flows.GrrMessage(
+        session_id="aff4:/C.0000000000000001/flows/W:ABCDEF",
+        name="ListDirectory",
+        request_id=1,
+        response_id=2,
+        task_id=123456789,
+        source="C.0000000000000001",
+        payload=rdf_protodict.DataBlob(string="foobar"))
+
+    def CheckMessage(decoded):
+      self.assertEqual(decoded.request_id, 1)
+      self.assertEqual(decoded.name, "ListDirectory")
+
+    self._CompiledCodecsBenchmark("GrrMessage", message,
+                                  [rdf_flows.GrrMessage], CheckMessage)
+
+    stat_entry = rdf_client.StatEntry(
+        aff4path="aff4:/C.0000000000000001/fs/os/etc/passwd",
+        st_mode=33261,
+        st_ino=1026267,
+        st_dev=51713,
+        st_nlink=1,
+        st_uid=0,
+        st_gid=0,
+        st_size=60064,
+        st_atime=1308964274,
+        st_mtime=1285093975,
+        st_ctime=1299502221,
+        st_blocks=128,
+        st_blksize=4096,
+        pathspec=rdf_paths.PathSpec(path="/etc/passwd", pathtype="OS"))
+
+    def CheckStatEntry(decoded):
+      self.assertEqual(decoded.st_size, 60064)
+      self.assertEqual(decoded.pathspec.path, "/etc/passwd")
+
+    self._CompiledCodecsBenchmark("StatEntry", stat_entry,
+                                  [rdf_client.StatEntry, rdf_paths.PathSpec],
+                                  CheckStatEntry)
+
+    message_list = rdf_flows.MessageList()
+    for i in range(100):
+      message_list.job.Append(session_id="aff4:/flows/W:ABCDEF",
+                              name="ListDirectory",
+                              request_id=i,
+                              task_id=i)
+
+    def CheckMessageList(decoded):
+      for i, job in enumerate(decoded.job):
+        self.assertEqual(job.request_id, i)
+
+    self._CompiledCodecsBenchmark("MessageList", message_list,
+                                  [rdf_flows.MessageList, rdf_flows.GrrMessage],
+                                  CheckMessageList)
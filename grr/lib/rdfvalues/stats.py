@@ -38,6 +38,121 @@ class StatsHistogram(rdf_structs.RDFProtoStruct):
 
       self.bins[-1].num += 1
 
+  def Merge(self, other):
+    """Adds the counts of a histogram with the same bins to this one."""
+    if not self.bins:
+      self.bins = [StatsHistogramBin(b) for b in other.bins]
+      return
+
+    if len(self.bins) != len(other.bins):
+      raise ValueError("Can't merge histograms with different bins.")
+
+    for b, other_b in zip(self.bins, other.bins):
+      b.num += other_b.num
+
+
+class QuantileSketchCentroid(rdf_structs.RDFProtoStruct):
+  protobuf = jobs_pb2.QuantileSketchCentroid
+
+
+class QuantileSketch(rdf_structs.RDFProtoStruct):
+  """Mergeable sketch of a distribution to estimate its quantiles.
+
+  Every value starts out as a centroid of its own. Once there are more than
+  twice compression centroids, neighbouring ones are merged as long as the
+  merged centroid doesn't span more than a share of the values which shrinks
+  towards both tails of the distribution (the t-digest's arcsine scale). This
+  leaves about compression centroids. Sketches of different parts of the data
+  can be merged in any order.
+  """
+  protobuf = jobs_pb2.QuantileSketch
+
+  @property
+  def num(self):
+    return sum(c.count for c in self.centroids)
+
+  def RegisterValue(self, value):
+    self._UpdateRange(value, value)
+    self.centroids.Append(QuantileSketchCentroid(mean=value, count=1))
+
+    if len(self.centroids) > 2 * self.compression:
+      self._Compress(self._Centroids())
+
+  def Merge(self, other):
+    """Adds the values summarized by another sketch to this one."""
+    if not other.centroids:
+      return
+
+    self._UpdateRange(other.min_value, other.max_value)
+    self._Compress(self._Centroids() + other._Centroids())
+
+  def Quantile(self, q):
+    """Estimates the value below which the share q of all values lie."""
+    centroids = sorted(self._Centroids())
+    if not centroids:
+      return 0
+
+    total = sum(count for _, count in centroids)
+    target = min(max(q, 0.0), 1.0) * total
+
+    # Each centroid's mean is taken to sit in the middle of its values, the
+    # estimate is interpolated between the neighbouring means.
+    prev_position, prev_mean = 0.0, self.min_value
+    position = 0
+    for mean, count in centroids:
+      center = position + count / 2.0
+      if target < center:
+        return prev_mean + ((mean - prev_mean) * (target - prev_position) /
+                            (center - prev_position))
+
+      prev_position, prev_mean = center, mean
+      position += count
+
+    if total == prev_position:
+      return self.max_value
+
+    return prev_mean + ((self.max_value - prev_mean) *
+                        (target - prev_position) / (total - prev_position))
+
+  def _UpdateRange(self, min_value, max_value):
+    if self.centroids:
+      self.min_value = min(self.min_value, min_value)
+      self.max_value = max(self.max_value, max_value)
+    else:
+      self.min_value = min_value
+      self.max_value = max_value
+
+  def _Centroids(self):
+    return [(c.mean, c.count) for c in self.centroids]
+
+  def _Scale(self, q):
+    """Maps quantiles so that a centroid may span at most one unit."""
+    return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+  def _Compress(self, centroids):
+    """Replaces the centroids with the given ones, merged where possible."""
+    centroids.sort()
+    total = float(sum(count for _, count in centroids))
+
+    result = []
+    merged = 0
+    left_scale = self._Scale(0.0)
+    mean, count = centroids[0]
+    for next_mean, next_count in centroids[1:]:
+      right_scale = self._Scale((merged + count + next_count) / total)
+      if right_scale - left_scale <= 1:
+        count += next_count
+        mean += (next_mean - mean) * next_count / float(count)
+      else:
+        result.append((mean, count))
+        merged += count
+        left_scale = self._Scale(merged / total)
+        mean, count = next_mean, next_count
+
+    result.append((mean, count))
+    self.centroids = [QuantileSketchCentroid(mean=m, count=c)
+                      for m, c in result]
+
 
 class RunningStats(rdf_structs.RDFProtoStruct):
   """Class for collecting running stats: mean, stdev and histogram data."""
@@ -50,6 +165,15 @@ class RunningStats(rdf_structs.RDFProtoStruct):
 
     self.histogram.RegisterValue(value)
 
+  def Merge(self, other):
+    """Adds the values registered with another RunningStats to this one."""
+    self.num += other.num
+    self.sum += other.sum
+    self.sum_sq += other.sum_sq
+
+    self.histogram.Merge(other.histogram)
+    self.quantiles.Merge(other.quantiles)
+
   @property
   def mean(self):
     if self.num == 0:
@@ -80,9 +204,13 @@ class ClientResourcesStats(rdf_structs.RDFProtoStruct):
     super(ClientResourcesStats, self).__init__(initializer=initializer,
                                                **kwargs)
 
-    self.user_cpu_stats.histogram = self.CPU_STATS_BINS
-    self.system_cpu_stats.histogram = self.CPU_STATS_BINS
-    self.network_bytes_sent_stats.histogram = self.NETWORK_STATS_BINS
+    # Stats parsed from their serialized form already have their bins.
+    if not self.user_cpu_stats.histogram.bins:
+      self.user_cpu_stats.histogram = self.CPU_STATS_BINS
+    if not self.system_cpu_stats.histogram.bins:
+      self.system_cpu_stats.histogram = self.CPU_STATS_BINS
+    if not self.network_bytes_sent_stats.histogram.bins:
+      self.network_bytes_sent_stats.histogram = self.NETWORK_STATS_BINS
 
     self.lock = threading.RLock()
 
@@ -106,6 +234,19 @@ class ClientResourcesStats(rdf_structs.RDFProtoStruct):
         client_resources.network_bytes_sent)
 
     self.worst_performers.Append(client_resources)
+    self._TrimWorstPerformers()
+
+  @utils.Synchronized
+  def Merge(self, other):
+    """Adds the stats of another set of clients to these stats."""
+    self.user_cpu_stats.Merge(other.user_cpu_stats)
+    self.system_cpu_stats.Merge(other.system_cpu_stats)
+    self.network_bytes_sent_stats.Merge(other.network_bytes_sent_stats)
+
+    self.worst_performers.Extend(other.worst_performers)
+    self._TrimWorstPerformers()
+
+  def _TrimWorstPerformers(self):
     new_worst_performers = sorted(
         self.worst_performers,
         key=lambda s: s.cpu_usage.user_cpu_time + s.cpu_usage.system_cpu_time,
@@ -113,6 +254,11 @@ class ClientResourcesStats(rdf_structs.RDFProtoStruct):
     self.worst_performers = new_worst_performers
 
 
+class FrontendHealth(rdf_structs.RDFProtoStruct):
+  """Health signals published by a frontend for admission control."""
+  protobuf = jobs_pb2.FrontendHealth
+
+
 class Sample(rdf_structs.RDFProtoStruct):
   """A Graph sample is a single data point."""
   protobuf = analysis_pb2.Sample
@@ -66,6 +66,81 @@ class RunningStatsTest(test_base.RDFValueTestCase):
     self.assertAlmostEquals(stats.histogram.bins[2].range_max_value, 10.0)
     self.assertEqual(stats.histogram.bins[2].num, 4)
 
+  def testMergeAddsUpStats(self):
+    stats = stats_rdf.RunningStats()
+    stats.histogram = stats_rdf.StatsHistogram(initializer=[2.0, 4.0, 10.0])
+    other = stats_rdf.RunningStats()
+    other.histogram = stats_rdf.StatsHistogram(initializer=[2.0, 4.0, 10.0])
+
+    for v in range(50):
+      stats.RegisterValue(v)
+      stats.quantiles.RegisterValue(v)
+    for v in range(50, 100):
+      other.RegisterValue(v)
+      other.quantiles.RegisterValue(v)
+
+    stats.Merge(other)
+    self.assertEqual(stats.num, 100)
+    self.assertTrue(math.fabs(stats.mean - 49.5) < 1e-7)
+    self.assertTrue(math.fabs(stats.std - 28.86607004) < 1e-7)
+    self.assertEqual([b.num for b in stats.histogram.bins], [2, 2, 96])
+    self.assertAlmostEqual(stats.quantiles.Quantile(0.5), 49.5)
+
+
+class QuantileSketchTest(test_base.RDFValueTestCase):
+  rdfvalue_class = stats_rdf.QuantileSketch
+
+  def GenerateSample(self, number=0):
+    value = stats_rdf.QuantileSketch()
+    value.RegisterValue(number)
+    value.RegisterValue(number * 2)
+    return value
+
+  def _Values(self, count):
+    # A skewed distribution, like most resource usage is.
+    return [(i % 997)**2 / 1000.0 for i in range(count)]
+
+  def _AssertQuantilesAreClose(self, sketch, values):
+    values = sorted(values)
+    for q in [0.01, 0.1, 0.5, 0.9, 0.99]:
+      expected = values[int(q * len(values))]
+      self.assertLess(abs(sketch.Quantile(q) - expected),
+                      0.01 * (values[-1] - values[0]))
+
+  def testQuantilesOfFewValuesAreExact(self):
+    sketch = stats_rdf.QuantileSketch()
+    for v in range(100):
+      sketch.RegisterValue(v)
+
+    self.assertEqual(sketch.Quantile(0), 0)
+    self.assertAlmostEqual(sketch.Quantile(0.5), 49.5)
+    self.assertEqual(sketch.Quantile(1), 99)
+
+  def testSketchStaysSmall(self):
+    sketch = stats_rdf.QuantileSketch()
+    values = self._Values(10000)
+    for v in values:
+      sketch.RegisterValue(v)
+
+    self.assertEqual(sketch.num, 10000)
+    self.assertLessEqual(len(sketch.centroids), 2 * sketch.compression)
+    self._AssertQuantilesAreClose(sketch, values)
+
+  def testMergedSketchesEstimateQuantilesOfAllValues(self):
+    values = self._Values(10000)
+    sketches = [stats_rdf.QuantileSketch() for _ in range(8)]
+    for i, v in enumerate(values):
+      sketches[i % len(sketches)].RegisterValue(v)
+
+    merged = stats_rdf.QuantileSketch()
+    for sketch in sketches:
+      merged.Merge(sketch)
+
+    self.assertEqual(merged.num, 10000)
+    self.assertEqual(merged.min_value, min(values))
+    self.assertEqual(merged.max_value, max(values))
+    self._AssertQuantilesAreClose(merged, values)
+
 
 def main(argv):
   test_lib.GrrTestProgram(argv=argv)
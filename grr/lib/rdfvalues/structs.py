@@ -200,7 +200,7 @@ def SerializeEntries(entries):
 
     output.extend(wire_format)
 
-  return "".join(output)
+  return JoinWireFormat(output)
 
 
 def ReadIntoObject(buff, index, value_obj, length=0):
@@ -253,6 +253,253 @@ if _semantic:
 # pylint: enable=invalid-name
 
 
+# Code templates used to compile the per class decoders. Reading a field only
+# splits off its wire format, the field is still converted lazily on access.
+_READ_TAG_TEMPLATE = """
+    start = index
+    try:
+      while ORD_MAP_AND_0X80[buff[index]]:
+        index += 1
+    except IndexError:
+      raise ValueError("Invalid tag")
+    index += 1
+    tag = buff[start:index]
+"""
+
+_READ_FIELD_TEMPLATES = {
+    WIRETYPE_VARINT: """
+start = index
+while ORD_MAP_AND_0X80[buff[index]]:
+  index += 1
+index += 1
+if index - start > 10:
+  raise DecodeError("Too many bytes when decoding varint.")
+wire_format = (tag, "", buff[start:index])
+""",
+    WIRETYPE_FIXED64: """
+wire_format = (tag, "", buff[index:index + 8])
+index += 8
+""",
+    WIRETYPE_FIXED32: """
+wire_format = (tag, "", buff[index:index + 4])
+index += 4
+""",
+    WIRETYPE_LENGTH_DELIMITED: """
+field_length, start = VarintReader(buff, index)
+wire_format = (tag, buff[index:start], buff[start:start + field_length])
+index = start + field_length
+""",
+}
+
+# Nested protobufs are only read as a view into the decoded buffer. The view is
+# decoded when the field is accessed and is replaced by a fresh serialization
+# once the nested protobuf is modified, so the buffer itself is never copied.
+_READ_EMBEDDED_TEMPLATE = """
+field_length, start = VarintReader(buff, index)
+wire_format = (tag, buff[index:start], buffer(buff, start, field_length))
+index = start + field_length
+"""
+
+
+def _Indent(code, depth):
+  return "".join("  " * depth + line + "\n" for line in code.splitlines()
+                 if line)
+
+
+def _CompileFunction(source, name, namespace):
+  namespace = dict(namespace)
+  exec compile(source, "<compiled %s>" % name, "exec") in namespace
+  return namespace[name]
+
+
+def _CompiledFields(cls):
+  """Returns the type infos of cls in field order, None if not compilable."""
+  type_infos = sorted(cls.type_infos_by_encoded_tag.itervalues(),
+                      key=lambda x: x.field_number)
+  for type_info_obj in type_infos:
+    if type_info_obj.wire_type not in _READ_FIELD_TEMPLATES:
+      return None
+
+  return type_infos
+
+
+def _IsEmbedded(type_info_obj):
+  """Can the wire format of this field be kept as a view into the buffer?"""
+  if type_info_obj.__class__ is ProtoList:
+    type_info_obj = type_info_obj.delegate
+
+  return type_info_obj.__class__ is ProtoEmbedded
+
+
+def JoinWireFormat(parts):
+  """Joins serialized parts, some of which may be views into a buffer."""
+  try:
+    return "".join(parts)
+  except TypeError:
+    return "".join([str(part) for part in parts])
+
+
+def CompileDecoder(cls):
+  """Generates a decoder specialized for the fields of an RDFStruct class.
+
+  The decoder has the same semantics as ReadIntoObject() but compares the tags
+  directly against the known fields and reads each of them according to its
+  known wire type, instead of splitting the buffer generically and looking up
+  the type info of each tag. Nested protobufs, including repeated ones, are
+  kept as buffer views and do not copy their part of the buffer.
+
+  Args:
+    cls: The RDFStruct class.
+
+  Returns:
+    A function to be used as the class' _DecodeFields() method or None if the
+    class can not be compiled.
+  """
+  type_infos = _CompiledFields(cls)
+  if type_infos is None:
+    return None
+
+  namespace = dict(ORD_MAP=ORD_MAP,
+                   ORD_MAP_AND_0X80=ORD_MAP_AND_0X80,
+                   TAG_TYPE_MASK=TAG_TYPE_MASK,
+                   VarintReader=VarintReader,
+                   DecodeError=rdfvalue.DecodeError)
+
+  source = ["def Decode(self, buff, index=0, length=0):",
+            "  raw_data = self._data",
+            "  buffer_len = length or len(buff)",
+            "  count = 0"]
+  for i, type_info_obj in enumerate(type_infos):
+    if type_info_obj.__class__ is ProtoList:
+      source.append("  list_%d = None" % i)
+
+  source.append("  while index < buffer_len:")
+  source.append(_READ_TAG_TEMPLATE.rstrip())
+
+  for i, type_info_obj in enumerate(type_infos):
+    namespace["tag_%d" % i] = type_info_obj.encoded_tag
+    namespace["name_%d" % i] = type_info_obj.name
+    namespace["type_info_%d" % i] = type_info_obj
+
+    source.append("    %s tag == tag_%d:" % ("elif" if i else "if", i))
+    if _IsEmbedded(type_info_obj):
+      source.append(_Indent(_READ_EMBEDDED_TEMPLATE, 3))
+    else:
+      source.append(_Indent(_READ_FIELD_TEMPLATES[type_info_obj.wire_type], 3))
+    if type_info_obj.__class__ is ProtoList:
+      source.append(_Indent("""
+if list_%(i)d is None:
+  list_%(i)d = self.Get(name_%(i)d).wrapped_list
+list_%(i)d.append((None, wire_format))
+""" % dict(i=i), 3))
+    else:
+      source.append(
+          "      raw_data[name_%d] = (None, wire_format, type_info_%d)" % (i, i))
+
+  # Unknown fields are kept in the raw data so they are written back unchanged.
+  unknown_field = ["tag_type = ORD_MAP[tag[0]] & TAG_TYPE_MASK"]
+  for i, wire_type in enumerate(sorted(_READ_FIELD_TEMPLATES)):
+    unknown_field.append("%s tag_type == %d:" % ("elif" if i else "if",
+                                                 wire_type))
+    unknown_field.append(_Indent(_READ_FIELD_TEMPLATES[wire_type], 1))
+
+  unknown_field.append("""
+else:
+  raise DecodeError("Unexpected Tag.")
+raw_data[count] = (None, wire_format, None)
+count += 1
+""")
+
+  if type_infos:
+    source.append("    else:")
+    source.append(_Indent("\n".join(unknown_field), 3))
+  else:
+    source.append(_Indent("\n".join(unknown_field), 2))
+
+  return _CompileFunction("\n".join(source), "Decode", namespace)
+
+
+def CompileEncoder(cls):
+  """Generates an encoder specialized for the fields of an RDFStruct class.
+
+  Known fields are emitted in field number order followed by any unknown or
+  suppressed fields in the raw data, whatever order they were parsed in. The
+  dirty check is only made for fields whose python format can change behind
+  our back (e.g. nested protobufs).
+
+  Args:
+    cls: The RDFStruct class.
+
+  Returns:
+    A function to be used as the class' _EncodeFields() method or None if the
+    class can not be compiled.
+  """
+  type_infos = _CompiledFields(cls)
+  if type_infos is None:
+    return None
+
+  namespace = dict(known_names=frozenset(x.name for x in type_infos),
+                   JoinWireFormat=JoinWireFormat,
+                   SerializeEntries=SerializeEntries)
+
+  source = ["def Encode(self):",
+            "  data = self._data",
+            "  output = []",
+            "  extend = output.extend",
+            "  found = 0"]
+
+  for i, type_info_obj in enumerate(type_infos):
+    namespace["name_%d" % i] = type_info_obj.name
+    namespace["type_info_%d" % i] = type_info_obj
+
+    if type_info_obj.__class__.IsDirty.im_func is ProtoType.IsDirty.im_func:
+      # This field never becomes dirty unless the raw data holds a foreign
+      # type descriptor for it.
+      dirty_check = ("type_descriptor is not type_info_%d and python_format "
+                     "and type_descriptor.IsDirty(python_format)" % i)
+    else:
+      dirty_check = "python_format and type_descriptor.IsDirty(python_format)"
+
+    source.append(_Indent("""
+entry = data.get(name_%(i)d)
+if entry is not None:
+  found += 1
+  python_format, wire_format, type_descriptor = entry
+  if wire_format is None or (%(dirty_check)s):
+    wire_format = type_descriptor.ConvertToWireFormat(python_format)
+  extend(wire_format)
+""" % dict(i=i, dirty_check=dirty_check), 1))
+
+  source.append(_Indent("""
+if found < len(data):
+  extend(SerializeEntries(entry for key, entry in data.iteritems()
+                          if key not in known_names))
+return JoinWireFormat(output)
+""", 1))
+
+  return _CompileFunction("\n".join(source), "Encode", namespace)
+
+
+def _GenericDecodeFields(self, buff, index=0, length=0):
+  ReadIntoObject(buff, index, self, length=length)
+
+
+def _GenericEncodeFields(self):
+  return SerializeEntries(self._data.itervalues())
+
+
+def _LazyDecodeFields(self, buff, index=0, length=0):
+  """Compiles the codecs of a class whose fields changed and decodes."""
+  self.__class__.CompileCodecs()
+  return self._DecodeFields(buff, index=index, length=length)
+
+
+def _LazyEncodeFields(self):
+  """Compiles the codecs of a class whose fields changed and encodes."""
+  self.__class__.CompileCodecs()
+  return self._EncodeFields()
+
+
 class ProtoType(type_info.TypeInfoObject):
   """A specific type descriptor for protobuf fields.
 
@@ -889,13 +1136,13 @@ class ProtoEmbedded(ProtoType):
   def ConvertFromWireFormat(self, value, container=None):
     """The wire format is simply a string."""
     result = self.type()
-    ReadIntoObject(value[2], 0, result)
+    result._DecodeFields(value[2])  # pylint: disable=protected-access
 
     return result
 
   def ConvertToWireFormat(self, value):
     """Encode the nested protobuf into wire format."""
-    output = SerializeEntries(value.GetRawData().itervalues())
+    output = value._EncodeFields()  # pylint: disable=protected-access
     return (self.encoded_tag, VarintEncode(len(output)), output)
 
   def LateBind(self, target=None):
@@ -1030,7 +1277,7 @@ class ProtoDynamicAnyValueEmbedded(ProtoDynamicEmbedded):
   def ConvertFromWireFormat(self, value, container=None):
     """The wire format is an AnyValue message."""
     result = AnyValue()
-    ReadIntoObject(value[2], 0, result)
+    result._DecodeFields(value[2])  # pylint: disable=protected-access
 
     # TODO(user): Type stored in type_url is currently ignored when value is
     # decoded. We should use it to deserialize the value and then check
@@ -1041,7 +1288,7 @@ class ProtoDynamicAnyValueEmbedded(ProtoDynamicEmbedded):
     """Encode the nested protobuf into wire format."""
     data = value.SerializeToString()
     any_value = AnyValue(type_url=value.__class__.__name__, value=data)
-    output = SerializeEntries(any_value.GetRawData().itervalues())
+    output = any_value._EncodeFields()  # pylint: disable=protected-access
 
     return (self.encoded_tag, VarintEncode(len(output)), output)
 
@@ -1495,6 +1742,8 @@ class RDFStructMetaclass(rdfvalue.RDFValueMetaclass):
 
     cls._class_attributes = set(dir(cls))
 
+    cls.CompileCodecs()
+
 
 class RDFStruct(rdfvalue.RDFValue):
   """An RDFValue object which contains fields like a struct.
@@ -1550,9 +1799,13 @@ class RDFStruct(rdfvalue.RDFValue):
   # set.
   suppressions = []
 
+  # Set to False to serialize this class with the generic codecs.
+  compile_codecs = True
+
   def __init__(self, initializer=None, age=None, **kwargs):
-    # Maintain the order so that parsing and serializing a proto does not change
-    # the serialized form.
+    # The raw data is not ordered. The compiled encoder writes known fields in
+    # field number order, so serializing a parsed proto gives its canonical
+    # form, which is not necessarily the input it was parsed from.
     self._data = {}
     self._age = age
 
@@ -1678,12 +1931,38 @@ class RDFStruct(rdfvalue.RDFValue):
     self.dirty = True
 
   def SerializeToString(self):
-    return SerializeEntries(self._data.itervalues())
+    return self._EncodeFields()
 
   def ParseFromString(self, string):
-    ReadIntoObject(string, 0, self)
+    self._DecodeFields(string)
     self.dirty = True
 
+  # The generic codecs. CompileCodecs() replaces these with versions specialized
+  # for the fields of each class.
+  _EncodeFields = _GenericEncodeFields
+  _DecodeFields = _GenericDecodeFields
+
+  @classmethod
+  def CompileCodecs(cls):
+    """Compiles the encoder and decoder for the current fields of the class.
+
+    Classes which can not be compiled, or set compile_codecs to False, use the
+    generic codecs.
+    """
+    encoder = decoder = None
+    if cls.compile_codecs:
+      encoder = CompileEncoder(cls)
+      decoder = CompileDecoder(cls)
+
+    cls._EncodeFields = encoder or _GenericEncodeFields
+    cls._DecodeFields = decoder or _GenericDecodeFields
+
+  @classmethod
+  def _InvalidateCodecs(cls):
+    """Recompiles the codecs on next use after the fields have changed."""
+    cls._EncodeFields = _LazyEncodeFields
+    cls._DecodeFields = _LazyDecodeFields
+
   def __eq__(self, other):
     if not isinstance(other, self.__class__):
       return False
@@ -1849,6 +2128,7 @@ class RDFStruct(rdfvalue.RDFValue):
 
     cls.type_infos_by_field_number[field_desc.field_number] = field_desc
     cls.type_infos.Append(field_desc)
+    cls._InvalidateCodecs()
 
   def __getstate__(self):
     """Support the pickle protocol."""
@@ -2174,6 +2454,7 @@ class RDFProtoStruct(RDFStruct):
 
     cls.type_infos.Append(field_desc)
     cls.late_bound_type_infos.pop(field_desc.name, None)
+    cls._InvalidateCodecs()
 
     # Add direct accessors only if the class does not already have them.
     if not hasattr(cls, field_desc.name):
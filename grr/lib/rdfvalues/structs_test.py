@@ -515,6 +515,110 @@ class RDFStructsTest(test_base.RDFValueTestCase):
     self.assertEqual(tested.repeated[0], "foo")
     self.assertEqual(type(tested.repeated[0]), UndefinedRDFValue2)
 
+  def testCompiledCodecs(self):
+    """The compiled codecs are compatible with the generic ones."""
+    tested = self.GenerateSample(5)
+    # Unlike the sample's value, this one survives the float32 round trip.
+    tested.float = 7.25
+    tested.repeated = ["a", "b"]
+    tested.nested.foobar = "nested"
+    tested.repeat_nested.Append(foobar="repeated nested")
+
+    # Data written by the compiled encoder is read by the generic decoder.
+    data = tested.SerializeToString()
+    generic = TestStruct()
+    structs.ReadIntoObject(data, 0, generic)
+    self.assertEqual(generic, tested)
+
+    # And the other way around.
+    data = structs.SerializeEntries(tested.GetRawData().itervalues())
+    self.assertEqual(TestStruct(data), tested)
+
+    # Unknown fields survive a decode/encode cycle.
+    reduced = PartialTest1(data)
+    self.assertEqual(TestStruct(reduced.SerializeToString()), tested)
+
+    # Fields are written in field number order, like the protobuf library does.
+    stat = rdf_client.StatEntry.protobuf(st_mode=16877,
+                                         st_size=10,
+                                         aff4path="aff4:/foo",
+                                         symlink="bar")
+    self.assertEqual(
+        rdf_client.StatEntry(st_mode=16877,
+                             st_size=10,
+                             aff4path="aff4:/foo",
+                             symlink="bar").SerializeToString(),
+        stat.SerializeToString())
+
+    # Input with fields out of order is serialized in field number order.
+    reordered = (
+        rdf_client.StatEntry.protobuf(symlink="bar").SerializeToString() +
+        rdf_client.StatEntry.protobuf(st_mode=16877).SerializeToString())
+    self.assertEqual(
+        rdf_client.StatEntry(reordered).SerializeToString(),
+        rdf_client.StatEntry.protobuf(st_mode=16877,
+                                      symlink="bar").SerializeToString())
+
+  def testNestedFieldsAreDecodedAsViews(self):
+    message_list = rdf_flows.MessageList()
+    for i in range(10):
+      message_list.job.Append(session_id="aff4:/flows/W:ABCDEF",
+                              name="ListDirectory",
+                              request_id=i)
+
+    data = message_list.SerializeToString()
+    tested = rdf_flows.MessageList(data)
+
+    # The repeated nested protobufs are not copied out of the buffer.
+    for _, wire_format in tested.job.wrapped_list:
+      self.assertEqual(type(wire_format[2]), buffer)
+
+    # Serializing an untouched message writes the views back unchanged.
+    self.assertEqual(tested.SerializeToString(), data)
+
+    # Modifying a nested protobuf serializes it again.
+    tested.job[3].request_id = 100
+    decoded = rdf_flows.MessageList(tested.SerializeToString())
+    self.assertEqual([job.request_id for job in decoded.job],
+                     [0, 1, 2, 100, 4, 5, 6, 7, 8, 9])
+
+    # Non repeated nested protobufs too.
+    stat = rdf_client.StatEntry(pathspec=rdf_paths.PathSpec(path="/etc/passwd",
+                                                            pathtype="OS"),
+                                st_size=10)
+    tested = rdf_client.StatEntry(stat.SerializeToString())
+    self.assertEqual(type(tested.GetRawData()["pathspec"][1][2]), buffer)
+    self.assertEqual(tested.pathspec.path, "/etc/passwd")
+    self.assertEqual(tested.SerializeToString(), stat.SerializeToString())
+
+  def testCompiledCodecsFollowLateBinding(self):
+
+    class LateBoundNested(structs.RDFProtoStruct):
+      type_description = type_info.TypeDescriptorSet(type_info.ProtoString(
+          name="foobar",
+          field_number=1))
+
+    late_nested = type_info.ProtoEmbedded(name="late_nested",
+                                          field_number=8,
+                                          nested=LateBoundNested)
+
+    class LateBoundSource(structs.RDFProtoStruct):
+      type_description = type_info.TypeDescriptorSet(late_nested)
+
+    data = LateBoundSource(late_nested=LateBoundNested(
+        foobar="foo")).SerializeToString()
+
+    # The field is not known yet.
+    self.assertRaises(AttributeError, LateBindingTest(data).Get, "late_nested")
+
+    # Adding a field after the class was compiled updates the codecs.
+    LateBindingTest.AddDescriptor(late_nested.Copy())
+
+    tested = LateBindingTest(data)
+    self.assertEqual(tested.late_nested.foobar, "foo")
+    self.assertEqual(LateBindingTest(tested.SerializeToString()).late_nested,
+                     tested.late_nested)
+
   def testRDFValueParsing(self):
     stat = rdf_client.StatEntry.protobuf(st_mode=16877)
     data = stat.SerializeToString()
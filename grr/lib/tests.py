@@ -27,6 +27,7 @@ from grr.lib import export_test
 from grr.lib import export_utils_test
 from grr.lib import flow_test
 from grr.lib import flow_utils_test
+from grr.lib import front_end_benchmark_test
 from grr.lib import front_end_test
 from grr.lib import fuse_mount_test
 from grr.lib import hunt_test
@@ -47,6 +48,7 @@ from grr.lib import utils_test
 
 from grr.lib.aff4_objects import tests
 from grr.lib.authorization import tests
+from grr.lib.blob_stores import tests
 from grr.lib.builders import tests
 from grr.lib.checks import tests
 from grr.lib.data_stores import tests
@@ -792,6 +792,8 @@ def Start(db,
   reqhandler_cls.CMDTABLE = {
       cmd.DELETE_ATTRIBUTES: (reqhandler_cls.SERVICE.DeleteAttributes, "w"),
       cmd.DELETE_SUBJECT: (reqhandler_cls.SERVICE.DeleteSubject, "w"),
+      cmd.DELETE_SUBJECT_PREFIX: (reqhandler_cls.SERVICE.DeleteSubjectPrefix,
+                                  "w"),
       cmd.MULTI_SET: (reqhandler_cls.SERVICE.MultiSet, "w"),
       cmd.MULTI_RESOLVE_PREFIX: (reqhandler_cls.SERVICE.MultiResolvePrefix,
                                  "r"),
@@ -213,6 +213,12 @@ class DataStoreService(object):
     token = request.token
     self.db.DeleteSubject(subject, token=token)
 
+  @RPCWrapper
+  def DeleteSubjectPrefix(self, request, unused_response):
+    subject_prefix = request.subject[0]
+    token = request.token
+    self.db.DeleteSubjectPrefix(subject_prefix, token=token)
+
   def _NewTransaction(self, subject, duration, response):
     transid = utils.SmartStr(uuid.uuid4())
     now = time.time()
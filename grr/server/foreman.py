@@ -3,6 +3,7 @@
 """RDFValue instances related to the foreman implementation."""
 
 
+import collections
 import itertools
 
 from grr.lib import aff4
@@ -12,6 +13,12 @@ from grr.lib.rdfvalues import structs as rdf_structs
 from grr.proto import jobs_pb2
 
 
+def _AttributesByName(names):
+  """Returns the aff4 attributes with the given names, skipping unknown ones."""
+  return [aff4.Attribute.NAMES[name] for name in names
+          if name in aff4.Attribute.NAMES]
+
+
 class ForemanClientRuleSet(rdf_structs.RDFProtoStruct):
   """This proto holds rules and the strategy used to evaluate them."""
   protobuf = jobs_pb2.ForemanClientRuleSet
@@ -21,6 +28,11 @@ class ForemanClientRuleSet(rdf_structs.RDFProtoStruct):
     return set(itertools.chain.from_iterable(rule.GetPathsToCheck()
                                              for rule in self.rules))
 
+  def GetAttributesToCheck(self):
+    """Returns aff4 attributes read by Evaluate from the opened objects."""
+    return set(itertools.chain.from_iterable(rule.GetAttributesToCheck()
+                                             for rule in self.rules))
+
   def Evaluate(self, objects, client_id):
     """Evaluates rules held in the rule set.
 
@@ -64,6 +76,17 @@ class ForemanClientRuleBase(rdf_structs.RDFProtoStruct):
     """
     return ["/"]
 
+  def GetAttributesToCheck(self):
+    """Returns aff4 attributes read by Evaluate from the opened objects.
+
+    Objects passed to Evaluate may be opened with only these attributes
+    loaded. Others are still available, but cost a data store round trip.
+
+    Returns:
+      An iterable filled with aff4.Attribute instances.
+    """
+    return []
+
   def Evaluate(self, objects, client_id):
     """Evaluates the rule represented by this object.
 
@@ -89,6 +112,9 @@ class ForemanClientRule(ForemanClientRuleBase):
   def GetPathsToCheck(self):
     return self.UnionCast().GetPathsToCheck()
 
+  def GetAttributesToCheck(self):
+    return self.UnionCast().GetAttributesToCheck()
+
   def Evaluate(self, objects, client_id):
     return self.UnionCast().Evaluate(objects, client_id)
 
@@ -100,6 +126,15 @@ class ForemanOsClientRule(ForemanClientRuleBase):
   """This rule will fire if the client OS is marked as true in the proto."""
   protobuf = jobs_pb2.ForemanOsClientRule
 
+  def GetOsNames(self):
+    """Returns the prefixes of the "System" attribute this rule fires for."""
+    return [name for enabled, name in ((self.os_windows, "Windows"),
+                                       (self.os_linux, "Linux"),
+                                       (self.os_darwin, "Darwin")) if enabled]
+
+  def GetAttributesToCheck(self):
+    return _AttributesByName(["System"])
+
   def Evaluate(self, objects, client_id):
     try:
       fd = objects[client_id]
@@ -109,9 +144,7 @@ class ForemanOsClientRule(ForemanClientRuleBase):
 
     value = utils.SmartStr(fd.Get(attribute))
 
-    return ((self.os_windows and value.startswith("Windows")) or
-            (self.os_linux and value.startswith("Linux")) or
-            (self.os_darwin and value.startswith("Darwin")))
+    return any(value.startswith(name) for name in self.GetOsNames())
 
   def Validate(self):
     pass
@@ -121,6 +154,9 @@ class ForemanLabelClientRule(ForemanClientRuleBase):
   """This rule will fire if the client has the selected label."""
   protobuf = jobs_pb2.ForemanLabelClientRule
 
+  def GetAttributesToCheck(self):
+    return [aff4.AFF4Object.SchemaCls.LABELS]
+
   def Evaluate(self, objects, client_id):
     try:
       fd = objects[client_id]
@@ -153,6 +189,9 @@ class ForemanRegexClientRule(ForemanClientRuleBase):
   def GetPathsToCheck(self):
     return [self.path]
 
+  def GetAttributesToCheck(self):
+    return _AttributesByName([self.attribute_name])
+
   def Evaluate(self, objects, client_id):
     path = client_id.Add(self.path)
     try:
@@ -181,6 +220,9 @@ class ForemanIntegerClientRule(ForemanClientRuleBase):
   def GetPathsToCheck(self):
     return [self.path]
 
+  def GetAttributesToCheck(self):
+    return _AttributesByName([self.attribute_name])
+
   def Evaluate(self, objects, client_id):
     path = client_id.Add(self.path)
     try:
@@ -236,3 +278,85 @@ class ForemanRule(rdf_structs.RDFProtoStruct):
 class ForemanRules(rdf_protodict.RDFValueArray):
   """A list of rules that the foreman will apply."""
   rdf_type = ForemanRule
+
+
+class ForemanRulesIndex(object):
+  """Foreman rules indexed by the OS and labels their rule sets require.
+
+  Most hunts only target clients of one OS or with particular labels. The index
+  returns just the rules that can possibly match a given client, so the
+  remaining rules don't have to be evaluated at all.
+  """
+
+  OS_NAMES = ["Windows", "Linux", "Darwin"]
+
+  def __init__(self, rules):
+    """Constructor.
+
+    Args:
+      rules: A ForemanRules list.
+    """
+    self.rules = list(rules)
+
+    # Clients are checked against rules created up to this time.
+    self.version = max([rule.created for rule in self.rules] or [0])
+
+    self.paths = set()
+    self.attributes = set()
+    self._unindexed = []
+    self._by_os = collections.defaultdict(list)
+    self._by_label = collections.defaultdict(list)
+
+    for position, rule in enumerate(self.rules):
+      rule_set = rule.client_rule_set
+      self.paths.update(rule_set.GetPathsToCheck())
+      self.attributes.update(rule_set.GetAttributesToCheck())
+      self._AddRuleSet(position, rule_set)
+
+  def _AddRuleSet(self, position, rule_set):
+    """Indexes the rule set by the first OS or label rule that must match."""
+    if (rule_set.match_mode == ForemanClientRuleSet.MatchMode.MATCH_ALL or
+        len(rule_set.rules) == 1):
+      client_rules = [rule.UnionCast() for rule in rule_set.rules]
+
+      for rule in client_rules:
+        if isinstance(rule, ForemanOsClientRule):
+          for os_name in rule.GetOsNames():
+            self._by_os[os_name].append(position)
+          return
+
+      for rule in client_rules:
+        if (isinstance(rule, ForemanLabelClientRule) and rule.label_names and
+            rule.match_mode in [ForemanLabelClientRule.MatchMode.MATCH_ALL,
+                                ForemanLabelClientRule.MatchMode.MATCH_ANY]):
+          for label_name in set(rule.label_names):
+            self._by_label[label_name].append(position)
+          return
+
+    self._unindexed.append(position)
+
+  def GetCandidates(self, client):
+    """Returns the rules that may match a client, in their original order.
+
+    Args:
+      client: The client's aff4 object or None if the client doesn't exist.
+
+    Returns:
+      A list of ForemanRule objects.
+    """
+    positions = set(self._unindexed)
+
+    # The client's OS and labels are only looked up if some rules need them,
+    # they may not have been read with the rest of the client's attributes.
+    if client is not None and self._by_os:
+      for attribute in _AttributesByName(["System"]):
+        system = utils.SmartStr(client.Get(attribute))
+        for os_name in self.OS_NAMES:
+          if system.startswith(os_name):
+            positions.update(self._by_os.get(os_name, []))
+
+    if client is not None and self._by_label:
+      for label_name in client.GetLabelsNames():
+        positions.update(self._by_label.get(label_name, []))
+
+    return [self.rules[position] for position in sorted(positions)]
@@ -113,12 +113,25 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
   def do_POST(self):
     """Process encrypted message bundles."""
-    self.Control()
+    if self.path.startswith("/upload"):
+      self.Upload()
+    else:
+      self.Control()
 
   @stats.Counted("frontend_request_count", fields=["http"])
   @stats.Timed("frontend_request_latency", fields=["http"])
   def Control(self):
     """Handle POSTS."""
+    self._HandleComms(self.server.frontend.HandleMessageBundles)
+
+  @stats.Counted("frontend_request_count", fields=["http_upload"])
+  @stats.Timed("frontend_request_latency", fields=["http_upload"])
+  def Upload(self):
+    """Handle blob uploads which are sent outside the poll loop."""
+    self._HandleComms(self.server.frontend.HandleUpload)
+
+  def _HandleComms(self, handler):
+    """Decodes the posted ClientCommunication and passes it to the handler."""
     if not master.MASTER_WATCHER.IsMaster():
       # We shouldn't be getting requests from the client unless we
       # are the active instance.
@@ -164,8 +177,7 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
           source_ip=utils.SmartStr(source_ip))
 
       request_start_time = time.ctime()
-      source, nr_messages = self.server.frontend.HandleMessageBundles(
-          request_comms, responses_comms)
+      source, nr_messages = handler(request_comms, responses_comms)
 
       logging.info(
           "HTTP request from %s (%s) @ %s, %d bytes - %d messages received,"
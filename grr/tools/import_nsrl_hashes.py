@@ -92,6 +92,7 @@ def main(unused_argv):
                            mode="rw",
                            token=aff4.FACTORY.root_token) as store:
     imported = ImportFile(store, filename, flags.FLAGS.start)
+    store.GetHashFilter().Flush()
     data_store.DB.Flush()
     print "Imported %d hashes" % imported
 